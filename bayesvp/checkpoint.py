@@ -0,0 +1,114 @@
+################################################################################
+#
+# checkpoint.py     (c) Cameron Liang
+#                   University of Chicago
+#                   jwliang@oddjob.uchicago.edu
+#
+# Streaming of the MCMC chain to disk during sampling. The chain is
+# appended to a standard .npy file (shape (nsteps,nwalkers,ndim)) whose
+# header is rewritten in place after each chunk, so that the file can be
+# read (or memory-mapped) with np.load at any time. The positions and
+# random number generator state of the sampler are saved with each chunk
+# to resume an interrupted run (bvpfit --resume).
+################################################################################
+
+import numpy as np
+import os
+import pickle
+
+
+class ChainWriter(object):
+    """
+    Appendable .npy file of the chain
+
+    Parameters:
+    ----------
+    fname: str
+        Full path of the .npy file
+    nwalkers: int
+        Number of walkers
+    ndim: int
+        Number of parameters
+    n_steps: int
+        Number of steps to keep from an existing file (resumed run);
+        0 to start a new file. Steps written after the last
+        checkpoint are discarded.
+
+    Attributes:
+    -----------
+    n_steps: int
+        Number of steps in the file
+    """
+    # Fixed header length so that it can be rewritten in place
+    header_size = 128
+    dtype = np.dtype('<f8')
+
+    def __init__(self,fname,nwalkers,ndim,n_steps=0):
+        self.fname = fname
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+
+        if n_steps > 0:
+            chain = np.load(fname,mmap_mode='r')
+            if chain.shape[1:] != (nwalkers,ndim) or len(chain) < n_steps:
+                raise ValueError('Chain file %s does not match the checkpoint' % fname)
+            del chain
+            self._file = open(fname,'r+b')
+            self._file.truncate(self.header_size + n_steps*self._step_size())
+        else:
+            self._file = open(fname,'w+b')
+        self.n_steps = n_steps
+        self._write_header()
+
+    def _step_size(self):
+        return self.nwalkers*self.ndim*self.dtype.itemsize
+
+    def _write_header(self):
+        header = ("{'descr': '%s', 'fortran_order': False, 'shape': (%i, %i, %i), }" %
+                  (self.dtype.str,self.n_steps,self.nwalkers,self.ndim))
+        # magic string, version 1.0, header length; padded with spaces
+        prefix = b'\x93NUMPY\x01\x00' + np.array(self.header_size-10,'<u2').tobytes()
+        header = header.ljust(self.header_size-len(prefix)-1) + '\n'
+        self._file.seek(0)
+        self._file.write(prefix + header.encode('latin1'))
+        self._file.flush()
+
+    def append(self,samples):
+        """
+        Parameters:
+        ----------
+        samples: array
+            Positions of the walkers with shape (n,nwalkers,ndim)
+        """
+        samples = np.asarray(samples,dtype=self.dtype)
+        self._file.seek(0,os.SEEK_END)
+        self._file.write(samples.tobytes())
+        self.n_steps += len(samples)
+        self._write_header()
+
+    def close(self):
+        self._file.close()
+
+
+def save_checkpoint(fname,state):
+    """
+    Save the sampler state (dict) to file; the file is replaced
+    only after it is completely written
+    """
+    with open(fname + '.tmp','wb') as f:
+        pickle.dump(state,f)
+    os.replace(fname + '.tmp',fname)
+
+
+def load_checkpoint(fname):
+    """
+    Returns:
+    ----------
+    state: dict
+        Sampler state saved by save_checkpoint; None if there
+        is no checkpoint
+    """
+    if not os.path.isfile(fname):
+        return None
+    with open(fname,'rb') as f:
+        return pickle.load(f)
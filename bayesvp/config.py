@@ -15,7 +15,114 @@ import re
 import sys
 import ntpath
 
-from bayesvp.utilities import get_transitions_params, MyParser
+from bayesvp.utilities import get_transitions_params, MyParser, LSFKernel, LSFOperator
+from bayesvp.vp_model import FrequencyGrid, PolyContinuum
+
+
+class FitPlan:
+    """
+    Immutable description of how the sampled parameters map onto 
+    the Voigt profile model. It is built once from the parsed config 
+    file so that the model does not re-parse flags, fixed values and 
+    transitions on every likelihood call.
+
+    Attributes:
+    -----------
+    n_component: int
+        Number of Voigt components
+    param_index: array_like
+        Index into alpha for each (logN, b, z) of each component; 
+        shape = (n_component,3). -1 if the parameter is fixed
+    free_mask: array_like
+        True if the (logN, b, z) parameter is free or tied
+    fixed_values: array_like
+        Values of the fixed parameters (0 where free); 
+        shape = (n_component,3)
+    n_lines: int
+        Number of valid (component, transition) pairs
+    line_component: array_like
+        Component index of each line; shape = (n_lines,)
+    line_params: array_like
+        [oscillator strength, rest wavelength, damping coefficient, mass]
+        of each line; shape = (n_lines,4)
+    region_slices: tuple
+        Slices of the pixels in each selected wavelength region
+    pixel_width: array_like
+        Width [A] of each pixel from the spacing of its neighbours
+    """
+
+    def __init__(self,vp_params,vp_params_flags,transitions_params_array,
+                 wave,wave_begins,wave_ends):
+
+        n_component = len(vp_params)
+        component_flags = np.asarray(vp_params_flags).reshape(n_component,3)
+
+        free_mask = ~np.isnan(component_flags)
+        param_index = np.where(free_mask,component_flags,-1).astype(int)
+
+        # Fixed values are stored in the config with a trailing upper case letter
+        fixed_values = np.zeros((n_component,3))
+        for i in range(n_component):
+            for j in range(3):
+                if not free_mask[i][j]:
+                    fixed_values[i][j] = float(vp_params[i][j][:-1])
+
+        # Flatten (component, region, transition) into a table of valid lines
+        line_component = []; line_params = []
+        for i in range(n_component):
+            for k in range(len(transitions_params_array[i])):
+                for transition in transitions_params_array[i][k]:
+                    if not np.isnan(transition).any():
+                        line_component.append(i)
+                        line_params.append(transition)
+
+        region_slices = []
+        for k in range(len(wave_begins)):
+            wave_ind0 = np.where(wave>=wave_begins[k])[0][0]
+            wave_ind1 = np.where(wave<=wave_ends[k])[0][-1]
+            region_slices.append(slice(wave_ind0,wave_ind1+1))
+
+        pixel_width = np.zeros(len(wave))
+        for region in region_slices:
+            if region.stop - region.start > 1:
+                pixel_width[region] = np.gradient(wave[region])
+
+        self.n_component    = n_component
+        self.param_index    = param_index
+        self.free_mask      = free_mask
+        self.fixed_values   = fixed_values
+        self.n_lines        = len(line_component)
+        self.line_component = np.array(line_component,dtype=int)
+        self.line_params    = np.array(line_params,dtype=float).reshape(-1,4)
+        self.region_slices  = tuple(region_slices)
+        self.pixel_width    = pixel_width
+
+        # gather index with fixed parameters pointing at a dummy position
+        self._gather_index = np.where(free_mask,param_index,0)
+
+        for arr in (self.param_index,self.free_mask,self.fixed_values,
+                    self.line_component,self.line_params,self.pixel_width,
+                    self._gather_index):
+            arr.flags.writeable = False
+
+    def component_params(self,alpha):
+        """
+        Re-group the sampled parameters into [logN, b, z] for each component
+
+        Parameters:
+        ----------
+        alpha: array_like
+            Parameters with shape (n_params,) or (n_walkers,n_params);
+            continuum parameters at the end are ignored
+
+        Returns:
+        ----------
+        params: array_like
+            shape = (n_component,3) or (n_walkers,n_component,3)
+        """
+        alpha = np.asarray(alpha,dtype=float)
+        return np.where(self.free_mask,alpha[...,self._gather_index],
+                        self.fixed_values)
 
 
 class DefineParams:
@@ -50,6 +157,41 @@ class DefineParams:
         Number of steps for each walker
     nthreads: int
         Number of parallel threads
+    vectorize: bool
+        True if the sampler evaluates the posterior of all 
+        walkers with one call
+    jit: bool
+        True to compute the likelihood with the compiled fused 
+        loop when numba is installed and the Humlicek Voigt function 
+        is accepted (voigt_backend or voigt_tol); see fused.py
+    walker_init: str
+        'uniform' to start the walkers uniformly within the 
+        priors or 'map' to start them around the maximum a 
+        posteriori found by an optimiser
+    checkpoint_steps: int
+        Number of steps between writes of the chain and sampler 
+        state to disk; see checkpoint.py
+    gr_stop: tuple
+        (n_steps, threshold): sampling stops before nsteps once the 
+        Gelman-Rubin indicators of all parameters have stayed below 
+        threshold for n_steps steps; None to always run nsteps
+    ess_stop: float
+        Sampling stops before nsteps once the effective sample size 
+        of all parameters after burn-in is at least ess_stop; None 
+        to always run nsteps
+    model_processes: int
+        Number of component counts fitted in parallel processes in 
+        automatic mode (! auto); the threads of each fit are reduced 
+        so that all fits share the cores
+    burnin_method: str
+        'gr' (default) for the burn-in from the Gelman-Rubin 
+        indicators or 'rhat' for the rank-normalised split R-hat; 
+        see diagnostics.py
+    burnin_threshold: float
+        Convergence threshold of burnin_method
+    seed: int
+        Seed of the random numbers of the walker initialization and 
+        sampler; None for a different run each time
     wave: array
         Selected region of the input spectral data
     flux: array
@@ -73,12 +215,54 @@ class DefineParams:
         Number of Vogit components defined for the model
     lsf: array_like
         Line spread function to be convolved with the model
+    lsf_kernels: list
+        LSFKernel of each wavelength region with cached kernel FFT
+    cos_lsf: tuple
+        (lsf_table, disptab, cenwave, detector) of the wavelength 
+        dependent COS LSF; None if not used
+    lsf_operator: LSFOperator
+        Sparse operator of the COS LSF; None if not used
     cont_normalize: bool
         True if user choose to include continuum fit
     cont_nparams: int
         Number of parameters from the polynomial continuum model
     cont_prior: array_like
         All continuum parameters are limited by +/- this value
+    cont_marginalize: bool
+        True if the continuum parameters are marginalized 
+        analytically (with Gaussian priors of width cont_prior) 
+        instead of being sampled; n_params then excludes them
+    cont_model: PolyContinuum
+        Precomputed design matrix of the continuum polynomial; None 
+        if no continuum is fitted
+    voigt_window: tuple
+        (n_doppler, n_lorentz) half width of the pixel window around 
+        each line centre where the Voigt profile is evaluated; 
+        None to evaluate over all pixels
+    voigt_tol: float
+        Maximum absolute error of the Voigt function H(a,x); 
+        None for the exact Faddeeva function
+    voigt_backend: str
+        Name of the Voigt function backend (e.g 'table'); overrides 
+        voigt_tol. See voigt.py
+    oversample: tuple
+        (n_sub, threshold): lines with Doppler width below threshold 
+        pixels are averaged over n_sub sub-pixels; None to disable
+    precision: str
+        'float64' (default) or 'float32' precision of the model, flux 
+        and errors; the likelihood is always summed in float64
+    dtype: numpy dtype
+        Data type of the precision
+    mask_ranges: array
+        (n_masks, 2) wavelength ranges [begin, end] excluded from 
+        the likelihood (e.g geocoronal lines); empty if not used
+    good_pixels: array
+        Boolean mask of the pixels used in the likelihood: finite 
+        flux and positive, finite error outside of mask_ranges
+    nu_grid: FrequencyGrid
+        Pixel frequencies for the float32 model; None for float64
+    fit_plan: FitPlan
+        Pre-compiled mapping from the sampled parameters to the model
     """
 
     def __init__(self,config_fname):
@@ -106,7 +290,30 @@ class DefineParams:
         self.cont_normalize = False
         self.cont_nparams = 0
         self.cont_prior   = 1.0
+        self.cont_marginalize = False
         self.self_bvp_test = False
+        # Voigt profiles are evaluated over all pixels unless a window is set
+        self.voigt_window = None
+        # Exact Voigt function unless a tolerance is set; see voigt.py
+        self.voigt_tol = None
+        self.voigt_backend = None
+        # Sub-pixel sampling of unresolved lines 
+        self.oversample = None
+        # Precision of the model; see vp_model.FrequencyGrid
+        self.precision = 'float64'
+        # Wavelength ranges excluded from the likelihood
+        self.mask_ranges = np.zeros((0,2))
+        # Chain and sampler state written to disk every checkpoint_steps
+        self.checkpoint_steps = 100
+        self.seed = None
+        # Sampling stops early once converged; (n_steps, GR threshold)
+        self.gr_stop = None
+        self.ess_stop = None
+        # Number of component counts fitted at once in automatic mode
+        self.model_processes = 1
+        # Burn-in of the data products; see utilities.compute_burnin_GR
+        self.burnin_method = 'gr'
+        self.burnin_threshold = 1.005
 
         # Paths and fname strings
         for line in self.lines:
@@ -128,6 +335,12 @@ class DefineParams:
             elif 'continuum' in line or 'contdegree' in line:
                 self.cont_normalize  = True
                 self.cont_nparams = int(line[1]) + 1 # n_param = poly degree + 1 (offset)
+                if len(line) > 2:
+                    if line[2] != 'marginalize':
+                        sys.exit('Error! In config file, format for continuum:\n'
+                                 ' continuum degree [marginalize]\nExiting program...')
+                    # solve for the coefficients instead of sampling them
+                    self.cont_marginalize = True
 
             elif 'cont_prior' in line or 'contprior' in line:
                 if self.cont_normalize and self.cont_nparams>0:
@@ -147,6 +360,98 @@ class DefineParams:
                 else:
                     sys.exit('Continuum fit is not set or degree is less than 0.\n')
 
+            elif 'voigt_window' in line:
+                # Half width of the window in Doppler and Lorentz widths;
+                # both are required since the Lorentz widths (~1e-5 A) 
+                # need far larger multiples to keep the damping wings
+                n_widths = [float(i) for i in line[1:]]
+                if len(n_widths) != 2 or min(n_widths) < 0:
+                    sys.exit('Error! In config file, format for Voigt window:\n'
+                            ' voigt_window n_doppler n_lorentz\nExiting program...')
+                self.voigt_window = tuple(n_widths)
+
+            elif 'voigt_tol' in line:
+                self.voigt_tol = float(line[1])
+
+            elif 'voigt_backend' in line:
+                from bayesvp.voigt import VOIGT_BACKENDS
+                if line[1] not in VOIGT_BACKENDS:
+                    sys.exit('Error! Voigt backend must be one of: %s\nExiting program...' 
+                             % ', '.join(sorted(VOIGT_BACKENDS)))
+                self.voigt_backend = line[1]
+
+            elif 'oversample' in line:
+                # oversample n_sub [threshold in pixels]
+                if len(line) not in (2,3) or int(line[1]) < 1:
+                    sys.exit('Error! In config file, format for oversampling:\n'
+                             ' oversample n_sub [threshold]\nExiting program...')
+                threshold = 3.0
+                if len(line) == 3:
+                    threshold = float(line[2])
+                self.oversample = (int(line[1]),threshold)
+
+            elif 'mask' in line:
+                # mask wave_begin1 wave_end1 wave_begin2 wave_end2 ...
+                if len(line) < 3 or len(line[1:]) % 2 != 0:
+                    sys.exit('Error! In config file, format for masks:\n'
+                             ' mask wave_begin1 wave_end1 ...\nExiting program...')
+                ranges = np.array(line[1:]).astype(float).reshape(-1,2)
+                if np.any(ranges[:,0] >= ranges[:,1]):
+                    sys.exit('Error! Starting wavelength of a mask must be smaller than '
+                             'its ending wavelength.\nExiting program...')
+                self.mask_ranges = np.concatenate((self.mask_ranges,ranges))
+
+            elif 'precision' in line:
+                if len(line) != 2 or line[1] not in ('float32','float64'):
+                    sys.exit('Error! In config file, format for precision:\n'
+                             ' precision float32|float64\nExiting program...')
+                self.precision = line[1]
+
+            elif 'checkpoint' in line:
+                # checkpoint n_steps
+                if len(line) != 2 or int(line[1]) < 1:
+                    sys.exit('Error! In config file, format for checkpoints:\n'
+                             ' checkpoint n_steps\nExiting program...')
+                self.checkpoint_steps = int(line[1])
+
+            elif 'gr_stop' in line:
+                # gr_stop n_steps [threshold]
+                if len(line) not in (2,3) or int(line[1]) < 1:
+                    sys.exit('Error! In config file, format for early stopping:\n'
+                             ' gr_stop n_steps [threshold]\nExiting program...')
+                threshold = 1.005
+                if len(line) == 3:
+                    threshold = float(line[2])
+                self.gr_stop = (int(line[1]),threshold)
+
+            elif 'model_processes' in line:
+                if len(line) != 2 or int(line[1]) < 1:
+                    sys.exit('Error! In config file, format for parallel models:\n'
+                             ' model_processes n\nExiting program...')
+                self.model_processes = int(line[1])
+
+            elif 'convergence' in line:
+                # convergence gr|rhat [threshold]
+                if len(line) not in (2,3) or line[1] not in ('gr','rhat'):
+                    sys.exit('Error! In config file, format for convergence:\n'
+                             ' convergence gr|rhat [threshold]\nExiting program...')
+                self.burnin_method = line[1]
+                self.burnin_threshold = 1.005 if line[1] == 'gr' else 1.01
+                if len(line) == 3:
+                    self.burnin_threshold = float(line[2])
+
+            elif 'ess_stop' in line:
+                if len(line) != 2 or float(line[1]) <= 0:
+                    sys.exit('Error! In config file, format for early stopping:\n'
+                             ' ess_stop n_samples\nExiting program...')
+                self.ess_stop = float(line[1])
+
+            elif 'seed' in line:
+                if len(line) != 2:
+                    sys.exit('Error! In config file, format for the random seed:\n'
+                             ' seed n\nExiting program...')
+                self.seed = int(line[1])
+
             elif 'mcmc_params' in line or 'mcmc' in line:
                 self.nwalkers = int(line[1])
                 self.nsteps   = int(line[2])
@@ -155,13 +460,25 @@ class DefineParams:
                 # Default
                 self.model_selection = 'bic'      
                 self.mcmc_sampler    = 'kombine'
+                self.vectorize       = False
+                self.jit             = False
+                self.walker_init     = 'uniform'
 
                 # Change keys if defined in config 
                 for key in line[3:]:
-                    if key in ['kombine','emcee']:
+                    if key in ['kombine','emcee','hmc']:
                         self.mcmc_sampler = key
                     elif key in ['aic','bic','bf']:
                         self.model_selection = key  
+                    elif key == 'vectorize':
+                        # evaluate posterior of all walkers at once
+                        self.vectorize = True
+                    elif key == 'numba':
+                        # compiled likelihood; see fused.py
+                        self.jit = True
+                    elif key == 'map':
+                        # walkers start around the optimised MAP
+                        self.walker_init = 'map'
         
         ########################################################################
         # Get the spectral data specified by the config file
@@ -201,7 +518,7 @@ class DefineParams:
             inds = np.where(np.logical_and(wave>=self.wave_begins[i], wave<=self.wave_ends[i]))[0]
             all_inds.append(inds)
 
-        all_inds = np.hstack(np.asarray(all_inds))
+        all_inds = np.hstack(all_inds)
         wave = wave[all_inds]; flux = flux[all_inds]; dflux = dflux[all_inds]
         
         # Remove NaN pixels in flux
@@ -215,6 +532,19 @@ class DefineParams:
         if len(self.wave) == 0 or len(self.flux) == 0 or len(self.dflux) == 0:
             raise ValueError('No data within specified wavelength range.' \
                              'Please check config file and spectrum.')
+
+        # Pixels used in the likelihood; zero errors would give inf/NaN
+        self.good_pixels = np.isfinite(self.flux) & np.isfinite(self.dflux) & (self.dflux > 0)
+        for wave_begin,wave_end in self.mask_ranges:
+            self.good_pixels &= ~((self.wave >= wave_begin) & (self.wave <= wave_end))
+        if not np.any(self.good_pixels):
+            raise ValueError('No unmasked pixels with positive errors. '
+                             'Please check config file and spectrum.')
+
+        # Flux and errors in the model precision; wave stays in float64 
+        # since it sets the positions of the lines
+        self.dtype = np.dtype(self.precision)
+        self.flux = self.flux.astype(self.dtype); self.dflux = self.dflux.astype(self.dtype)
             
 
         ########################################################################
@@ -315,8 +645,22 @@ class DefineParams:
         self.vp_params_type  = np.array(vp_params_type)
         self.vp_params_flags = np.array(flags)
         self.n_params        = n_free_params_counter
+        self.cont_model = None
         if self.cont_normalize:
-            self.n_params = self.n_params + self.cont_nparams
+            self.cont_prior = np.ones(self.cont_nparams)*self.cont_prior
+            self.cont_model = PolyContinuum(self.wave,self.flux,self.cont_nparams)
+            if not self.cont_marginalize:
+                self.n_params = self.n_params + self.cont_nparams
+
+        # Pre-compiled mapping from alpha to the model; see FitPlan
+        self.fit_plan = FitPlan(self.vp_params,self.vp_params_flags,
+                                self.transitions_params_array,self.wave,
+                                self.wave_begins,self.wave_ends)
+
+        # Pixel frequencies for the reduced precision model
+        self.nu_grid = None
+        if self.dtype != np.float64:
+            self.nu_grid = FrequencyGrid(self.wave,self.fit_plan.region_slices,self.dtype)
 
         # Make directories for data products
         if self.self_bvp_test:
@@ -364,14 +708,24 @@ class DefineParams:
 
         # Check if LSF is specified in config file
         defined_lsf = False
+        cos_lsf_line = None
         for line in self.lines:
-            if re.search('lsf',line) or re.search('LSF',line):
-                lsf_line = line.split(' ')[1:]
+            tokens = list(filter(None,line.split(' ')))
+            if tokens[0] in ('lsf','LSF'):
+                lsf_line = tokens[1:]
                 defined_lsf = True
-                if not os.path.isdir(self.spec_path + '/database'):
-                    os.mkdir(self.spec_path + '/database')
-                    sys.exit('Require LSF file to be in %s' % self.spec_path + '/database\n Exiting program...')
-                break
+            elif tokens[0] == 'cos_lsf':
+                # cos_lsf lsf_table disptab cenwave [detector]
+                if len(tokens) not in (4,5):
+                    sys.exit('Error! In config file, format for COS LSF:\n'
+                             ' cos_lsf lsf_table disptab cenwave [detector]\nExiting program...')
+                cos_lsf_line = tokens[1:]
+            else:
+                continue
+
+            if not os.path.isdir(self.spec_path + '/database'):
+                os.mkdir(self.spec_path + '/database')
+                sys.exit('Require LSF file to be in %s' % self.spec_path + '/database\n Exiting program...')
 
         # Get the LSF function from directory 'database'
         if defined_lsf:
@@ -383,16 +737,35 @@ class DefineParams:
                     self.lsf.append(np.loadtxt(fname))
                     #print(fname)
             elif len(lsf_line) == 1:
-                for lsf_fname in lsf_line:
-                    # assume lsf file has one column 
-                    fname = self.spec_path + '/database/' + lsf_fname
-                    self.lsf = np.loadtxt(fname)
+                # Same LSF for all wavelength regions
+                fname = self.spec_path + '/database/' + lsf_line[0]
+                self.lsf = [np.loadtxt(fname)] * len(self.wave_begins)
             else:
                 sys.exit('Please check if number of LSF matches wavelength regions. Exiting program...')
         else:
             # Convolve with LSF = 1
             self.lsf = np.ones(len(self.wave_begins))
 
+        # LSF of each region with its kernel spectrum at the padded FFT length
+        self.lsf_kernels = [LSFKernel(self.lsf[k],region.stop-region.start,self.dtype)
+                            for k,region in enumerate(self.fit_plan.region_slices)]
+
+        # Wavelength dependent COS LSF from the LSF table and DISPTAB file,
+        # built once as a sparse operator on the model flux
+        self.cos_lsf = None
+        self.lsf_operator = None
+        if cos_lsf_line is not None:
+            if defined_lsf:
+                sys.exit('Error! Specify either lsf or cos_lsf in config file. Exiting program...')
+            detector = 'FUV'
+            if len(cos_lsf_line) == 4:
+                detector = cos_lsf_line[3].upper()
+            self.cos_lsf = (cos_lsf_line[0],cos_lsf_line[1],int(cos_lsf_line[2]),detector)
+            self.lsf_operator = LSFOperator(self.wave,self.fit_plan.region_slices,
+                                            self.spec_path + '/database/' + self.cos_lsf[0],
+                                            self.spec_path + '/database/' + self.cos_lsf[1],
+                                            self.cos_lsf[2],detector,self.dtype)
+
         
         #######################################################################
         # Read priors and use them for walker initialization 
@@ -476,9 +849,54 @@ class DefineParams:
         for i in range(len(self.wave_begins)):
             f_logging.write('    [%.3f, %.3f]\n' % (self.wave_begins[i],self.wave_ends[i])) 
         
+        if self.voigt_window is not None:
+            f_logging.write('Voigt window [Doppler, Lorentz widths]: %.1f, %.1f\n' % self.voigt_window)
+
+        if self.cos_lsf is not None:
+            f_logging.write('COS LSF table, DISPTAB, cenwave, detector: %s, %s, %i, %s\n' 
+                            % self.cos_lsf)
+
+        if self.precision != 'float64':
+            f_logging.write('Model precision: %s\n' % self.precision)
+
+        if len(self.mask_ranges) > 0:
+            f_logging.write('Masked wavelength ranges:\n')
+            for wave_begin,wave_end in self.mask_ranges:
+                f_logging.write('    [%.3f, %.3f]\n' % (wave_begin,wave_end))
+        f_logging.write('Pixels in likelihood: %i of %i\n' 
+                        % (np.sum(self.good_pixels),len(self.good_pixels)))
+
+        if self.oversample is not None:
+            f_logging.write('Oversampling [sub-pixels, threshold pixels]: %i, %.1f\n' 
+                            % self.oversample)
+
+        if self.voigt_tol is not None:
+            f_logging.write('Voigt function tolerance: %.1e\n' % self.voigt_tol)
+        if self.voigt_backend is not None:
+            f_logging.write('Voigt function backend: %s\n' % self.voigt_backend)
+
         f_logging.write('MCMC Sampler: %s\n' % self.mcmc_sampler)
+        if self.vectorize:
+            f_logging.write('Posterior of all walkers evaluated at once (vectorize)\n')
+        if self.jit:
+            f_logging.write('Likelihood from compiled fused loop (numba)\n')
+        if self.walker_init == 'map':
+            f_logging.write('Walkers initialized around the MAP (map)\n')
+        f_logging.write('Checkpoint every %i steps\n' % self.checkpoint_steps)
+        if self.seed is not None:
+            f_logging.write('Random seed: %i\n' % self.seed)
+        if self.gr_stop is not None:
+            f_logging.write('Stop when converged [steps, GR threshold]: %i, %.4f\n' 
+                            % self.gr_stop)
+        if self.burnin_method != 'gr':
+            f_logging.write('Burn-in from %s < %.4f\n' % (self.burnin_method,self.burnin_threshold))
+        if self.ess_stop is not None:
+            f_logging.write('Stop when effective sample size >= %.0f\n' % self.ess_stop)
         f_logging.write('Model selection method (if needed): %s\n' % self.model_selection)
         f_logging.write('Walkers,steps,threads : %i,%i,%i\n' % (self.nwalkers,self.nsteps,self.nthreads))
+        if self.model_processes > 1:
+            f_logging.write('Component counts fitted in parallel (auto mode): %i\n' 
+                            % self.model_processes)
         f_logging.write('Priors: ')
         f_logging.write('logN: [min,   max] = [%.3f, %.3f]\n' % (self.priors[0][0],self.priors[0][1]))
         f_logging.write('b:            [min,   max] = [%.3f, %.3f]\n' % (self.priors[1][0],self.priors[1][1]))
@@ -486,7 +904,10 @@ class DefineParams:
         
         if self.cont_normalize:
             f_logging.write('Continuum polynomial degree: %i\n'     % (self.cont_nparams-1))
-            f_logging.write('Continuum priors with +/- a_i: ')
+            if self.cont_marginalize:
+                f_logging.write('Continuum parameters marginalized; Gaussian priors with sigma a_i: ')
+            else:
+                f_logging.write('Continuum priors with +/- a_i: ')
             for i in range(len(self.cont_prior)):
                 f_logging.write('%f\t' % self.cont_prior[i])
             f_logging.write('\n')
@@ -0,0 +1,196 @@
+################################################################################
+#
+# diagnostics.py    (c) Cameron Liang
+#                   University of Chicago
+#                   jwliang@oddjob.uchicago.edu
+#
+# Convergence diagnostics of MCMC chains with shape (nsteps,nwalkers,ndim):
+# rank-normalised split R-hat and bulk/tail effective sample sizes
+# (Vehtari et al. 2021, Bayesian Analysis 16, 667), computed for all
+# parameters at once. Each walker is treated as a chain; split R-hat also
+# compares the first and second half of every walker, which detects
+# drifts within walkers missed by utilities.gr_indicator.
+################################################################################
+
+import numpy as np
+
+from scipy import fft as sp_fft
+from scipy.special import ndtri
+from scipy.stats import rankdata
+
+
+def split_chains(chain):
+    """
+    Split every walker into its first and second half; the middle
+    step of an odd number of steps is dropped
+
+    Parameters:
+    ----------
+    chain: array_like
+        Chain with shape (nsteps,nwalkers,ndim)
+
+    Returns:
+    ----------
+    split: array
+        Chain with shape (nsteps//2,2*nwalkers,ndim)
+    """
+    chain = np.asarray(chain,dtype=float)
+    half = len(chain)//2
+    return np.concatenate((chain[:half],chain[len(chain)-half:]),axis=1)
+
+def rank_normalize(chain):
+    """
+    Replace the samples of each parameter by the normal quantiles of
+    their ranks over all steps and walkers
+    """
+    n,m,ndim = np.shape(chain)
+    ranks = rankdata(np.reshape(chain,(-1,ndim)),axis=0)
+    return ndtri((ranks - 0.375)/(n*m + 0.25)).reshape(n,m,ndim)
+
+def _rhat_from_moments(n,chain_means,chain_vars):
+    """
+    R-hat from the means and (ddof=1) variances of m chains of
+    length n; arrays with shape (m,ndim)
+    """
+    W = np.mean(chain_vars,axis=0)
+    B = n*np.var(chain_means,axis=0,ddof=1)
+    var_plus = (n-1.)/n*W + B/n
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return np.sqrt(var_plus/W)
+
+def _rhat(chain):
+    return _rhat_from_moments(len(chain),np.mean(chain,axis=0),np.var(chain,axis=0,ddof=1))
+
+def _ess(chain):
+    """
+    Effective sample size of the chains (n,m,ndim) from the
+    autocorrelation combined over chains, summed with Geyer's
+    initial monotone sequence
+    """
+    n,m,ndim = np.shape(chain)
+    x = chain - np.mean(chain,axis=0)
+    n_fft = sp_fft.next_fast_len(2*n)
+    x_fft = sp_fft.rfft(x,n=n_fft,axis=0)
+    acov = sp_fft.irfft(x_fft*np.conjugate(x_fft),n=n_fft,axis=0)[:n]/n
+
+    W = np.mean(acov[0],axis=0)*n/(n-1.)
+    var_plus = (n-1.)/n*W
+    if m > 1:
+        var_plus = var_plus + np.var(np.mean(chain,axis=0),axis=0,ddof=1)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        rho = 1 - (W - np.mean(acov,axis=1))/var_plus
+    rho[0] = 1
+
+    # Sums of consecutive pairs up to the first non-positive pair,
+    # forced to decrease monotonically
+    n_pairs = n//2
+    pairs = rho[0:2*n_pairs:2] + rho[1:2*n_pairs:2]
+    positive = np.logical_and.accumulate(pairs > 0,axis=0)
+    pairs = np.minimum.accumulate(np.where(positive,pairs,0),axis=0)
+    tau = np.maximum(-1 + 2*np.sum(pairs,axis=0),1/np.log10(n*m))
+    return n*m/tau
+
+def rhat(chain):
+    """
+    Rank-normalised split R-hat: the maximum of the bulk and the
+    folded (|x - median|) R-hat of each parameter
+
+    Parameters:
+    ----------
+    chain: array_like
+        Chain with shape (nsteps,nwalkers,ndim)
+
+    Returns:
+    ----------
+    rhat: array
+        R-hat with length of (ndim); close to 1 when converged
+    """
+    split = split_chains(chain)
+    median = np.median(split.reshape(-1,np.shape(split)[-1]),axis=0)
+    bulk = _rhat(rank_normalize(split))
+    folded = _rhat(rank_normalize(np.abs(split - median)))
+    return np.maximum(bulk,folded)
+
+def ess_bulk(chain):
+    """
+    Bulk effective sample size (of the rank-normalised split
+    chains) with length of (ndim)
+    """
+    return _ess(rank_normalize(split_chains(chain)))
+
+def ess_tail(chain,prob=0.05):
+    """
+    Tail effective sample size: the minimum of the effective sample
+    sizes of the indicators of the prob and 1-prob quantiles
+    """
+    split = split_chains(chain)
+    quantiles = np.quantile(split.reshape(-1,np.shape(split)[-1]),[prob,1-prob],axis=0)
+    return np.minimum(_ess((split <= quantiles[0]).astype(float)),
+                      _ess((split <= quantiles[1]).astype(float)))
+
+def convergence_summary(chain):
+    """
+    R-hat, bulk and tail effective sample sizes of each parameter
+
+    Returns:
+    ----------
+    summary: array
+        shape = (ndim,3) with columns rhat, ess_bulk, ess_tail
+    """
+    return np.c_[rhat(chain),ess_bulk(chain),ess_tail(chain)]
+
+def split_rhat_streaming(chain,block_size=10000):
+    """
+    Split R-hat (without rank normalisation) of a long chain read in
+    blocks of steps, e.g. a chain loaded with np.load(mmap_mode='r');
+    only the running mean and variance of every half walker are
+    kept in memory
+
+    Parameters:
+    ----------
+    chain: array_like
+        Chain with shape (nsteps,nwalkers,ndim)
+    block_size: int
+        Number of steps read at once
+
+    Returns:
+    ----------
+    rhat: array
+        Split R-hat with length of (ndim)
+    """
+    nsteps,nwalkers,ndim = np.shape(chain)
+    half = nsteps//2
+    means = []; variances = []
+    for start in (0,nsteps-half):
+        n = 0
+        mean = np.zeros((nwalkers,ndim)); m2 = np.zeros((nwalkers,ndim))
+        for i in range(start,start+half,block_size):
+            block = np.asarray(chain[i:min(i+block_size,start+half)],dtype=float)
+            # Merge the block into the running moments (Welford)
+            block_mean = np.mean(block,axis=0)
+            delta = block_mean - mean
+            total = n + len(block)
+            mean = mean + delta*len(block)/total
+            m2 = m2 + np.sum((block - block_mean)**2,axis=0) + delta**2*n*len(block)/total
+            n = total
+        means.append(mean); variances.append(m2/(half-1.))
+    return _rhat_from_moments(half,np.concatenate(means),np.concatenate(variances))
+
+def compute_burnin_rhat(chain,rhat_threshold=1.01,n_candidates=10):
+    """
+    Smallest burn-in among multiples of 5% of the steps (up to half
+    of the chain) after which the rank-normalised split R-hat of all
+    parameters is below rhat_threshold
+
+    Returns:
+    ----------
+    burnin_steps: int
+        Number of steps to discard; half of the chain if R-hat
+        never drops below the threshold
+    """
+    nsteps = len(chain)
+    for k in range(n_candidates):
+        burnin = (k*nsteps)//(2*n_candidates)
+        if np.all(rhat(chain[burnin:]) <= rhat_threshold):
+            return int(burnin)
+    return nsteps//2
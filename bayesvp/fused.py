@@ -0,0 +1,228 @@
+################################################################################
+#
+# fused.py   	    (c) Cameron Liang
+#						University of Chicago
+#     				    jwliang@oddjob.uchicago.edu
+#
+# Optional compiled (numba) likelihood. The Voigt profile, exp(-tau), LSF
+# convolution, continuum and Gaussian log-likelihood are computed in one
+# loop over pixels without intermediate full-length arrays. Selected by the
+# key 'numba' on the mcmc line of the config file together with voigt_backend
+# humlicek (or a voigt_tol that allows it); otherwise the NumPy model in
+# vp_model.py is used. likelihood.fused_report measures the speed-up.
+################################################################################
+
+import numpy as np
+
+from bayesvp.vp_model import c, km_cm, ang_cm, sigma0
+
+try:
+    import numba
+    numba_available = True
+except ImportError:
+    numba_available = False
+
+from bayesvp.voigt import VOIGT_BACKENDS
+
+# Maximum absolute error of H(a,x) in the fused loop
+humlicek_error_bound = VOIGT_BACKENDS['humlicek'].error_bound(np.inf)
+
+def fused_voigt_allowed(config_params):
+    """
+    True if the config accepts the Humlicek approximation of the 
+    fused loop: voigt_backend humlicek, or no backend and voigt_tol 
+    at least its error bound. The exact default (wofz) is not 
+    replaced silently.
+    """
+    if config_params.voigt_backend is not None:
+        return config_params.voigt_backend == 'humlicek'
+    return (config_params.voigt_tol is not None and 
+            config_params.voigt_tol >= humlicek_error_bound)
+
+def _jit(function):
+    if numba_available:
+        return numba.njit(cache=True)(function)
+    return function
+
+
+@_jit
+def _humlicek(x, a):
+    """
+    H(a,x) from the Humlicek (1982) W4 approximation; same as
+    voigt.humlicek_voigt for a single point
+    """
+    t = complex(a, -x)
+    s = abs(x) + a
+    if s >= 15:
+        w = t*0.5641896 / (0.5 + t*t)
+    elif s >= 5.5:
+        u2 = t*t
+        w = t*(1.410474 + u2*0.5641896) / (0.75 + u2*(3.0 + u2))
+    elif a >= 0.195*abs(x) - 0.176:
+        w = ((16.4955 + t*(20.20933 + t*(11.96482 + t*(3.778987 + t*0.5642236)))) /
+             (16.4955 + t*(38.82363 + t*(39.27121 + t*(21.69274 + t*(6.699398 + t))))))
+    else:
+        u2 = t*t
+        w = np.exp(u2) - t*(36183.31 - u2*(3321.9905 - u2*(1540.787 - u2*(219.0313 -
+            u2*(35.76683 - u2*(1.320522 - u2*0.56419)))))) / \
+            (32066.6 - u2*(24322.84 - u2*(9022.228 - u2*(2186.181 - u2*(364.2191 -
+            u2*(61.57037 - u2*(1.841439 - u2)))))))
+    return w.real
+
+@_jit
+def _fused_lnlike(line_amplitude, line_nu_center, line_doppler, line_damping,
+                  nu, region_starts, region_stops, kernels, kernel_lengths,
+                  kernel_norms, cont_params, cont_x, cont_offset, flux, inv_var, ring):
+    """
+    ln(likelihood) of one set of line parameters. For each region, the
+    absorbed fraction 1 - exp(-tau) of each pixel is written into a ring
+    buffer of the last K pixels, from which the convolved pixel K/2
+    behind is computed and compared with the data. The constant
+    normalisation of the likelihood is not included.
+    """
+    n_lines = len(line_amplitude)
+    n_cont = len(cont_params)
+    ln_likelihood = 0.0
+    for k in range(len(region_starts)):
+        start = region_starts[k]; n_pixels = region_stops[k] - start
+        n_kernel = kernel_lengths[k]
+        center = (n_kernel - 1) // 2
+        for p in range(n_pixels + center):
+            if p < n_pixels:
+                # Optical depth of all lines at pixel p
+                i = start + p
+                tau = 0.0
+                for n in range(n_lines):
+                    delta_nuD = line_doppler[n]*nu[i]
+                    x = (nu[i] - line_nu_center[n]) / delta_nuD
+                    a = line_damping[n] / delta_nuD
+                    tau += line_amplitude[n]*_humlicek(x,a)/delta_nuD
+                ring[p % n_kernel] = 1.0 - np.exp(-tau)
+
+            j0 = p - center
+            if j0 < 0:
+                continue
+            # Convolved absorption at pixel j0; zero beyond the region edges
+            absorbed = 0.0
+            for j in range(n_kernel):
+                q = p - j
+                if q < 0:
+                    break
+                if q < n_pixels:
+                    absorbed += kernels[k, j]*ring[q % n_kernel]
+            model_flux = 1.0 - absorbed/kernel_norms[k]
+
+            i = start + j0
+            if n_cont > 0:
+                continuum = 0.0
+                for l in range(n_cont-1,-1,-1):
+                    continuum = continuum*cont_x[i] + cont_params[l]
+                model_flux *= continuum + cont_offset
+
+            resid = flux[i] - model_flux
+            ln_likelihood -= 0.5*resid**2*inv_var[i]
+    if np.isnan(ln_likelihood):
+        return -np.inf
+    return ln_likelihood
+
+@_jit
+def _fused_lnlike_batch(line_amplitude, line_nu_center, line_doppler, line_damping,
+                        nu, region_starts, region_stops, kernels, kernel_lengths,
+                        kernel_norms, cont_params, cont_x, cont_offset, flux, inv_var):
+    n_walkers = line_amplitude.shape[0]
+    ln_likelihood = np.empty(n_walkers)
+    ring = np.empty(kernels.shape[1])
+    for w in range(n_walkers):
+        ln_likelihood[w] = _fused_lnlike(line_amplitude[w], line_nu_center[w],
+                                         line_doppler[w], line_damping[w], nu,
+                                         region_starts, region_stops, kernels,
+                                         kernel_lengths, kernel_norms, cont_params[w],
+                                         cont_x, cont_offset, flux, inv_var, ring)
+    return ln_likelihood
+
+
+class FusedLikelihood(object):
+    """
+    ln(likelihood) from the compiled fused loop. The Voigt function
+    is the Humlicek W4 approximation (voigt backend 'humlicek').
+
+    Parameters:
+    ----------
+    config_params: obj
+        Parameters object defined by the config file; LSF given by
+        the lsf line (cos_lsf, voigt_window and oversample are not
+        supported)
+    ln_norm: float
+        Normalisation of the likelihood over the good pixels
+    inv_var: array
+        Inverse variance of the pixels; zero for masked pixels
+    flux: array
+        Observed flux; finite at all pixels
+    """
+    def __init__(self,config_params,ln_norm,inv_var,flux):
+        self.config_params = config_params
+        self.plan = config_params.fit_plan
+        wave = np.asarray(config_params.wave,dtype=np.float64)
+
+        self.nu = c/(wave*ang_cm)
+        self.region_starts = np.array([r.start for r in self.plan.region_slices],dtype=np.int64)
+        self.region_stops  = np.array([r.stop for r in self.plan.region_slices],dtype=np.int64)
+
+        lsf_kernels = config_params.lsf_kernels
+        self.kernel_lengths = np.array([len(k.kernel) for k in lsf_kernels],dtype=np.int64)
+        self.kernels = np.zeros((len(lsf_kernels),np.max(self.kernel_lengths)))
+        for k,lsf_kernel in enumerate(lsf_kernels):
+            self.kernels[k,:len(lsf_kernel.kernel)] = lsf_kernel.kernel
+        self.kernel_norms = np.array([k.norm for k in lsf_kernels],dtype=np.float64)
+
+        # Polynomial continuum; see vp_model.PolyContinuum
+        self.n_cont = config_params.cont_nparams if config_params.cont_normalize else 0
+        if self.n_cont > 0:
+            self.cont_x = config_params.cont_model.x
+            self.cont_offset = float(config_params.cont_model.offset)
+        else:
+            self.cont_x = np.zeros(len(wave)); self.cont_offset = 0.0
+        self.ln_norm = ln_norm
+        self.inv_var = np.asarray(inv_var,dtype=np.float64)
+        self.flux = np.asarray(flux,dtype=np.float64)
+
+    def __call__(self,alpha):
+        """
+        Parameters:
+        ----------
+        alpha: array_like
+            Parameters with shape (n_params,) or (n_walkers,n_params)
+
+        Returns:
+        ----------
+        ln_likelihood: float or array with length n_walkers
+        """
+        single = np.ndim(alpha) == 1
+        alpha = np.atleast_2d(np.asarray(alpha,dtype=np.float64))
+        if self.n_cont > 0:
+            cont_params = np.ascontiguousarray(alpha[:,-self.n_cont:])
+            alpha = alpha[:,:-self.n_cont]
+        else:
+            cont_params = np.zeros((len(alpha),0))
+
+        # Per line quantities of general_intensity with shape (n_walkers,n_lines)
+        line_params = self.plan.component_params(alpha)[:,self.plan.line_component,:]
+        logN,b,z = np.moveaxis(line_params,-1,0)
+        f,wave0,gamma,mass = self.plan.line_params.T
+        line_amplitude = 10**logN*sigma0*f/np.sqrt(np.pi)
+        line_nu_center = c/(wave0*ang_cm)/(1+z)
+        line_doppler   = b*km_cm/c
+        line_damping   = np.broadcast_to(gamma/(4*np.pi),line_doppler.shape)
+
+        ln_likelihood = _fused_lnlike_batch(np.ascontiguousarray(line_amplitude),
+                                            np.ascontiguousarray(line_nu_center),
+                                            np.ascontiguousarray(line_doppler),
+                                            np.ascontiguousarray(line_damping),
+                                            self.nu,self.region_starts,self.region_stops,
+                                            self.kernels,self.kernel_lengths,self.kernel_norms,
+                                            cont_params,self.cont_x,self.cont_offset,
+                                            self.flux,self.inv_var)
+        ln_likelihood = self.ln_norm + ln_likelihood
+        if single:
+            return ln_likelihood[0]
+        return ln_likelihood
@@ -0,0 +1,280 @@
+################################################################################
+#
+# hmc.py   	        (c) Cameron Liang
+#						University of Chicago
+#     				    jwliang@oddjob.uchicago.edu
+#
+# Hamiltonian Monte Carlo sampler using the exact posterior gradient
+# (likelihood.Posterior.lnprob_and_grad). Each walker is an independent
+# chain; the leapfrog steps of all walkers are evaluated in one batched
+# call. The step size (dual averaging; Hoffman & Gelman 2014) and a
+# diagonal mass matrix are adapted during warm-up. Selected by the key
+# 'hmc' on the mcmc line of the config file.
+################################################################################
+
+import numpy as np
+
+
+class HMCSampler(object):
+    """
+    Hamiltonian Monte Carlo with a fixed number of (jittered)
+    leapfrog steps per trajectory.
+
+    Parameters:
+    ----------
+    nwalkers: int
+        Number of independent chains
+    ndim: int
+        Number of parameters
+    lnprob_and_grad: function
+        Returns (lnprob, grad) for parameters with shape
+        (nwalkers,ndim); lnprob = -inf outside of the priors
+    n_leapfrog: int
+        Number of leapfrog steps per trajectory
+    target_accept: float
+        Acceptance probability targeted by the step size adaptation
+    seed: int
+        Seed of the random number generator
+
+    Attributes:
+    -----------
+    chain: array
+        Samples after warm-up with shape (nsteps,nwalkers,ndim)
+    lnprobability: array
+        ln(posterior) of the samples with shape (nsteps,nwalkers)
+    acceptance_fraction: array
+        Fraction of accepted trajectories after warm-up for each walker
+    step_size: array
+        Adapted leapfrog step size of each walker
+    inv_mass: array
+        Adapted diagonal inverse mass matrix (ndim,)
+    n_evaluations: int
+        Number of batched posterior and gradient evaluations
+    """
+    # Dual averaging constants from Hoffman & Gelman (2014)
+    da_gamma = 0.05
+    da_t0    = 10.0
+    da_kappa = 0.75
+
+    def __init__(self,nwalkers,ndim,lnprob_and_grad,n_leapfrog=16,
+                 target_accept=0.8,seed=None):
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.lnprob_and_grad = lnprob_and_grad
+        self.n_leapfrog = n_leapfrog
+        self.target_accept = target_accept
+        self.random_state = np.random.default_rng(seed)
+
+        self.inv_mass = np.ones(ndim)
+        self.step_size = np.ones(nwalkers)
+        self.n_evaluations = 0
+
+    def _evaluate(self,position):
+        lnprob, grad = self.lnprob_and_grad(position)
+        lnprob = np.where(np.isnan(lnprob),-np.inf,lnprob)
+        self.n_evaluations += 1
+        return lnprob, grad
+
+    def _draw_momentum(self):
+        return (self.random_state.standard_normal((self.nwalkers,self.ndim)) /
+                np.sqrt(self.inv_mass))
+
+    def _kinetic(self,momentum):
+        return 0.5*np.sum(momentum**2*self.inv_mass,axis=1)
+
+    def _leapfrog(self,position,momentum,grad,step_size,n_steps):
+        """
+        Integrate n_steps leapfrog steps of all walkers; walkers
+        that leave the priors carry on with zero gradient and are
+        rejected at the end of the trajectory.
+        """
+        eps = step_size[:,np.newaxis]
+        momentum = momentum + 0.5*eps*grad
+        for i in range(n_steps):
+            position = position + eps*self.inv_mass*momentum
+            lnprob, grad = self._evaluate(position)
+            if i < n_steps - 1:
+                momentum = momentum + eps*grad
+        momentum = momentum + 0.5*eps*grad
+        return position, momentum, lnprob, grad
+
+    def _accept_probability(self,lnprob0,momentum0,lnprob1,momentum1):
+        with np.errstate(invalid='ignore',over='ignore'):
+            log_ratio = (lnprob1 - self._kinetic(momentum1)) - (lnprob0 - self._kinetic(momentum0))
+            log_ratio = np.where(np.isfinite(lnprob1) & ~np.isnan(log_ratio),log_ratio,-np.inf)
+        return np.exp(np.minimum(log_ratio,0.0))
+
+    def _initial_step_size(self,position,lnprob,grad):
+        """
+        Double or halve the step size of each walker until the
+        acceptance probability of a single leapfrog step crosses 0.5
+        """
+        step_size = np.ones(self.nwalkers)
+        momentum = self._draw_momentum()
+        _,p1,lnp1,_ = self._leapfrog(position,momentum,grad,step_size,1)
+        accept = self._accept_probability(lnprob,momentum,lnp1,p1)
+        direction = np.where(accept > 0.5,1.0,-1.0)
+        active = np.ones(self.nwalkers,dtype=bool)
+        for i in range(50):
+            step_size = np.where(active,step_size*2.0**direction,step_size)
+            _,p1,lnp1,_ = self._leapfrog(position,momentum,grad,step_size,1)
+            accept = self._accept_probability(lnprob,momentum,lnp1,p1)
+            active &= direction*(accept - 0.5) > 0
+            if not np.any(active):
+                break
+        return step_size
+
+    def _transition(self,position,lnprob,grad):
+        """One HMC trajectory for every walker"""
+        momentum = self._draw_momentum()
+        # Jitter the trajectory length to avoid periodic orbits
+        step_size = self.step_size*self.random_state.uniform(0.8,1.2,self.nwalkers)
+        new_position,new_momentum,new_lnprob,new_grad = self._leapfrog(position,momentum,grad,
+                                                                      step_size,self.n_leapfrog)
+        accept_prob = self._accept_probability(lnprob,momentum,new_lnprob,new_momentum)
+        accepted = self.random_state.uniform(size=self.nwalkers) < accept_prob
+
+        position = np.where(accepted[:,np.newaxis],new_position,position)
+        lnprob = np.where(accepted,new_lnprob,lnprob)
+        grad = np.where(accepted[:,np.newaxis],new_grad,grad)
+        return position, lnprob, grad, accept_prob, accepted
+
+    def _warmup_windows(self,n_warmup):
+        """
+        Ends of the windows in which the mass matrix is estimated;
+        the first 15% and last 10% of warm-up only adapt the step size
+        """
+        start = int(0.15*n_warmup); stop = int(0.9*n_warmup)
+        if stop - start < 20:
+            return []
+        middle = start + (stop - start)//3
+        return [(start,middle),(middle,stop)]
+
+    def run_mcmc(self,p0,nsteps,n_warmup=None):
+        """
+        Warm up the sampler and draw nsteps samples per walker
+
+        Parameters:
+        ----------
+        p0: array
+            Initial positions with shape (nwalkers,ndim); walkers
+            outside the priors restart from valid ones
+        nsteps: int
+            Number of samples per walker kept after warm-up
+        n_warmup: int
+            Number of adaptation steps (default: nsteps//2)
+
+        Returns:
+        ----------
+        position: array
+            Last positions of the walkers
+        """
+        if n_warmup is None:
+            n_warmup = nsteps//2
+        self.warmup(p0,n_warmup)
+
+        self.chain = np.empty((nsteps,self.nwalkers,self.ndim))
+        self.lnprobability = np.empty((nsteps,self.nwalkers))
+        n_accepted = np.zeros(self.nwalkers)
+        for i,(position,lnprob,accepted) in enumerate(self.sample(nsteps)):
+            self.chain[i] = position
+            self.lnprobability[i] = lnprob
+            n_accepted += accepted
+        self.acceptance_fraction = n_accepted/max(nsteps,1)
+        return self._position
+
+    def warmup(self,p0,n_warmup):
+        """
+        Adapt the step size and mass matrix from the initial 
+        positions p0 (see run_mcmc); the samples are not kept
+        """
+        position = np.array(p0,dtype=float)
+        lnprob, grad = self._evaluate(position)
+        valid = np.isfinite(lnprob)
+        if not np.any(valid):
+            raise ValueError('No initial position of the HMC walkers is inside the priors')
+        if not np.all(valid):
+            # Restart walkers outside the priors (e.g. swapped redshifts)
+            # from the positions of randomly chosen valid walkers
+            source = self.random_state.choice(np.where(valid)[0],size=np.sum(~valid))
+            position[~valid] = position[source]
+            lnprob[~valid] = lnprob[source]
+            grad[~valid] = grad[source]
+
+        # Start with the spread of the initial positions as the scale
+        if self.nwalkers > 1:
+            spread = np.var(position,axis=0)
+            self.inv_mass = np.where(spread > 0,spread,1.0)
+
+        windows = self._warmup_windows(n_warmup)
+        window_samples = []
+        self._restart_adaptation(position,lnprob,grad)
+        for m in range(n_warmup):
+            position,lnprob,grad,accept_prob,_ = self._transition(position,lnprob,grad)
+            self._adapt_step_size(accept_prob)
+
+            for start,stop in windows:
+                if start <= m < stop:
+                    window_samples.append(position)
+                if m == stop - 1:
+                    # Pooled within-chain variance of the window
+                    samples = np.array(window_samples)
+                    variance = np.mean(np.var(samples,axis=0),axis=0)
+                    self.inv_mass = np.where(variance > 0,variance,self.inv_mass)
+                    window_samples = []
+                    self._restart_adaptation(position,lnprob,grad)
+        if n_warmup > 0:
+            self.step_size = np.exp(self._log_step_bar)
+        self._position, self._lnprob, self._grad = position, lnprob, grad
+
+    def sample(self,nsteps):
+        """
+        Generator of nsteps transitions with the adapted step size, 
+        continuing from the last positions (after warmup or set_state)
+
+        Yields:
+        ----------
+        position: array
+            Positions of the walkers (nwalkers,ndim)
+        lnprob: array
+            ln(posterior) of the positions
+        accepted: array
+            True for the walkers that moved
+        """
+        for i in range(nsteps):
+            position,lnprob,grad,_,accepted = self._transition(self._position,self._lnprob,
+                                                               self._grad)
+            self._position, self._lnprob, self._grad = position, lnprob, grad
+            yield position, lnprob, accepted
+
+    def get_state(self):
+        """State after warm-up needed to continue sampling (see set_state)"""
+        return {'position': self._position, 'lnprob': self._lnprob, 'grad': self._grad,
+                'step_size': self.step_size, 'inv_mass': self.inv_mass,
+                'n_evaluations': self.n_evaluations,
+                'random_state': self.random_state.bit_generator.state}
+
+    def set_state(self,state):
+        self._position, self._lnprob, self._grad = state['position'], state['lnprob'], state['grad']
+        self.step_size = state['step_size']
+        self.inv_mass = state['inv_mass']
+        self.n_evaluations = state['n_evaluations']
+        self.random_state.bit_generator.state = state['random_state']
+
+    def _restart_adaptation(self,position,lnprob,grad):
+        self.step_size = self._initial_step_size(position,lnprob,grad)
+        self._da_mu = np.log(10*self.step_size)
+        self._da_count = 0
+        self._da_h_bar = np.zeros(self.nwalkers)
+        self._log_step_bar = np.log(self.step_size)
+
+    def _adapt_step_size(self,accept_prob):
+        """Dual averaging update of the step size of each walker"""
+        self._da_count += 1
+        m = self._da_count
+        weight = 1.0/(m + self.da_t0)
+        self._da_h_bar = (1-weight)*self._da_h_bar + weight*(self.target_accept - accept_prob)
+        log_step = self._da_mu - np.sqrt(m)/self.da_gamma*self._da_h_bar
+        eta = m**(-self.da_kappa)
+        self._log_step_bar = eta*log_step + (1-eta)*self._log_step_bar
+        self.step_size = np.exp(log_step)
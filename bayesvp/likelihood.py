@@ -10,16 +10,11 @@
 
 import numpy as np
 
-from bayesvp.vp_model import continuum_model_flux
+from bayesvp.vp_model import continuum_model_flux, continuum_model_flux_jacobian,\
+                             generic_prediction, generic_prediction_jacobian
 
 np.seterr(all='ignore') # Ignore floating point warnings.
 
-def tophat_prior(model_x, x_left,x_right):
-	if model_x >= x_left and model_x < x_right:
-		return 0
-	else:
-		return -np.inf
-
 class Posterior(object):
     """
     Define the natural log of the posterior distribution
@@ -33,11 +28,56 @@ class Posterior(object):
     -----------
     lnprob: function
         The posterior distribution as a function of the 
-        input parameters given the spectral data
+        input parameters given the spectral data. Parameters 
+        with shape (n_walkers, n_params) are evaluated for 
+        all walkers at once (e.g emcee with vectorize=True)
     """
     def __init__(self,config_params):
         self.config_params = config_params
 
+        # Constant parts of the likelihood over the good pixels; masked 
+        # pixels have zero weight (and flux set to 0 to avoid NaN)
+        self.good_pixels = config_params.good_pixels
+        dflux = np.asarray(config_params.dflux,dtype=np.float64)
+        self.inv_var = np.zeros(len(dflux))
+        self.inv_var[self.good_pixels] = 1/dflux[self.good_pixels]**2
+        self.ln_norm = np.sum(0.5*np.log(2*np.pi*dflux[self.good_pixels]**2))
+        self.flux = np.where(self.good_pixels,config_params.flux,0).astype(config_params.dtype)
+
+        self._compile_priors()
+
+        # Continuum coefficients solved for at each call; the continuum 
+        # is cont_offset + design.a with Gaussian priors on a
+        self.cont_marginalize = config_params.cont_normalize and config_params.cont_marginalize
+        if self.cont_marginalize:
+            self.cont_design = config_params.cont_model.design
+            self.cont_offset = float(config_params.cont_model.offset)
+            cont_sigma = np.asarray(config_params.cont_prior,dtype=np.float64)[::-1]
+            self.cont_prior_precision = np.diag(1/cont_sigma**2)
+            self.cont_ln_norm = -np.sum(np.log(cont_sigma))
+
+        # Compiled likelihood if requested and supported; see fused.py
+        self.fused_lnlike = None
+        if getattr(config_params,'jit',False):
+            from bayesvp.fused import FusedLikelihood, numba_available,\
+                                      fused_voigt_allowed, humlicek_error_bound
+            if not numba_available:
+                print('numba is not installed; using the NumPy likelihood.')
+            elif (config_params.lsf_operator is not None or config_params.oversample 
+                  is not None or config_params.voigt_window is not None or 
+                  self.cont_marginalize):
+                print('numba likelihood does not support cos_lsf, voigt_window, '
+                      'oversample or a marginalized continuum; using the NumPy likelihood.')
+            elif not fused_voigt_allowed(config_params):
+                # The loop uses the Humlicek approximation; only taken when 
+                # the config accepts its error
+                print('Warning: numba likelihood uses the Humlicek Voigt approximation; '
+                      'set voigt_backend humlicek or voigt_tol >= %.0e to use it. '
+                      'Using the NumPy likelihood.' % humlicek_error_bound)
+            else:
+                self.fused_lnlike = FusedLikelihood(config_params,self.ln_norm,
+                                                    self.inv_var,self.flux)
+
     def lnlike(self,alpha):
         """
         Likelihood assumes flux follow a Gaussian
@@ -45,27 +85,145 @@ class Posterior(object):
         Returns
         --------
         ln_likelihood: float
-            Natural log of the likelihood
+            Natural log of the likelihood; array with length
+            n_walkers for 2D alpha
         """
 
+        if self.fused_lnlike is not None:
+            return self.fused_lnlike(alpha)
+
+        if self.cont_marginalize:
+            model_flux = generic_prediction(alpha,self.config_params)
+            return self._marginalize_continuum(model_flux)[0]
+
         # Flux of the model
         model_flux = continuum_model_flux(alpha,self.config_params)
         
-        resid = self.config_params.flux - model_flux
+        resid = self.flux - model_flux
 
-        # Natural log of gaussian likelihood with normalization included 
-        ln_likelihood = np.sum(0.5*np.log(2*np.pi*self.config_params.dflux**2)
-                              -0.5*resid**2/self.config_params.dflux**2)
+        # Natural log of gaussian likelihood with normalization included; 
+        # summed in float64 for any model precision
+        ln_likelihood = self.ln_norm - 0.5*np.dot(resid**2,self.inv_var)
 
-        if np.isnan(ln_likelihood):
+        if np.ndim(ln_likelihood) > 0:
+            return np.where(np.isnan(ln_likelihood),-np.inf,ln_likelihood)
+        elif np.isnan(ln_likelihood):
             return -np.inf
         else:
             return ln_likelihood
 
+    def _marginalize_continuum(self,model_flux):
+        """
+        Integrate the likelihood over the continuum coefficients a, 
+        which enter linearly: flux = model_flux*(cont_offset + X.a) 
+        with Gaussian priors on a. With d = flux - model_flux*cont_offset, 
+        A = model_flux*X, precision P = A^T W A + prior precision and 
+        b = A^T W d:
+            ln L = ln_norm - (d^T W d - b^T P^-1 b)/2 - ln|P|/2 - ln|prior cov|/2
+
+        Parameters:
+        ----------
+        model_flux: array
+            Model flux without continuum; shape (n_pixels,) or 
+            (n_walkers,n_pixels)
+
+        Returns:
+        ----------
+        ln_likelihood: float or array
+            Marginal ln(likelihood); -inf for non-finite models
+        cont_mean: array
+            Conditional posterior mean of a; shape (...,n_cont)
+        cont_precision: array
+            Conditional posterior precision P; shape (...,n_cont,n_cont)
+        """
+        model_flux = np.asarray(model_flux,dtype=np.float64)
+        finite = np.all(np.isfinite(model_flux),axis=-1)
+        model_flux = np.where(finite[...,np.newaxis],model_flux,1.0)
+
+        d = self.flux - model_flux*self.cont_offset
+        weighted_model = model_flux*self.inv_var
+        cont_precision = (np.matmul(self.cont_design.T*(weighted_model*model_flux)[...,np.newaxis,:],
+                                    self.cont_design) + self.cont_prior_precision)
+        b = np.dot(weighted_model*d,self.cont_design)
+        cholesky = np.linalg.cholesky(cont_precision)
+        cont_mean = np.linalg.solve(cont_precision,b[...,np.newaxis])[...,0]
+
+        ln_likelihood = (self.ln_norm - 0.5*(np.dot(d**2,self.inv_var) - np.sum(b*cont_mean,axis=-1))
+                         - np.sum(np.log(np.diagonal(cholesky,axis1=-2,axis2=-1)),axis=-1)
+                         + self.cont_ln_norm)
+        ln_likelihood = np.where(finite & ~np.isnan(ln_likelihood),ln_likelihood,-np.inf)
+        if np.ndim(ln_likelihood) == 0:
+            ln_likelihood = float(ln_likelihood)
+        return ln_likelihood, cont_mean, cont_precision
+
+    def sample_continuum(self,samples,chunk_size=1000):
+        """
+        Draw the marginalized continuum coefficients from their 
+        conditional posterior given each sample of the Voigt 
+        profile parameters
+
+        Parameters:
+        ----------
+        samples: array
+            Samples with shape (n_samples,n_params)
+        chunk_size: int
+            Number of samples evaluated at once
+
+        Returns:
+        ----------
+        cont_params: array
+            Continuum coefficients with shape (n_samples,cont_nparams)
+        """
+        samples = np.atleast_2d(samples)
+        cont_params = np.empty((len(samples),self.config_params.cont_nparams))
+        for start in range(0,len(samples),chunk_size):
+            chunk = samples[start:start+chunk_size]
+            model_flux = generic_prediction(chunk,self.config_params)
+            _, cont_mean, cont_precision = self._marginalize_continuum(model_flux)
+            # a = mean + L^-T z has covariance (L L^T)^-1 = P^-1
+            cholesky = np.linalg.cholesky(cont_precision)
+            z = np.random.standard_normal(cont_mean.shape)
+            cont_params[start:start+chunk_size] = cont_mean + np.linalg.solve(
+                np.swapaxes(cholesky,-1,-2),z[...,np.newaxis])[...,0]
+        return cont_params
+
+    def _compile_priors(self):
+        """
+        Lower/upper bounds of the flat priors of all parameters (Voigt 
+        and continuum) and the indices of the component redshifts, 
+        which must not decrease so that components do not swap
+        """
+        config_params = self.config_params
+        plan = config_params.fit_plan
+        n_cont = config_params.cont_nparams if config_params.cont_normalize else 0
+        if config_params.cont_marginalize:
+            n_cont = 0
+        n_vp = config_params.n_params - n_cont
+
+        self.prior_lower = np.empty(config_params.n_params)
+        self.prior_upper = np.empty(config_params.n_params)
+        for k in range(n_vp):
+            # Type (logN, b, z) of the parameter from the fit plan
+            param_type = np.where(plan.param_index == k)[1][0]
+            self.prior_lower[k],self.prior_upper[k] = config_params.priors[param_type]
+
+        # Continuum parameters are limited to +/- cont_prior; 
+        # cont_prior is in reverse order of the parameters
+        if n_cont > 0:
+            cont_priors = np.asarray(config_params.cont_prior,dtype=float)[::-1]
+            self.prior_lower[n_vp:] = -cont_priors
+            self.prior_upper[n_vp:] = cont_priors
+
+        z_indices = []
+        for k in plan.param_index[:,2]:
+            if k >= 0 and k not in z_indices:
+                z_indices.append(k)
+        self.z_indices = np.array(z_indices,dtype=int)
+
     def lnprior(self,alpha):
         """
         Natural Log of the priors for three types of 
-        parameters [logN, b, z]
+        parameters [logN, b, z] and the continuum
 
         Note that for redshift z, the ranges are defined 
         to be [mean_z-v/c, mean_z+v/c]
@@ -74,47 +232,83 @@ class Posterior(object):
         are limited +/- 1. It is so because 'pivoting'
         is used during the fit. The value can be set
         by cont_prior flag in config file (cont_flag 2.0)
+
+        All priors are flat within [lower, upper); see 
+        _compile_priors. Parameters with shape (n_walkers, 
+        n_params) give an array with length n_walkers
         """
+        alpha = np.asarray(alpha)
+        in_prior = np.all((alpha >= self.prior_lower) & (alpha < self.prior_upper),axis=-1)
 
-        # Define these for clarity
-        min_logN,max_logN = self.config_params.priors[0] 
-        min_b,max_b       = self.config_params.priors[1]
-        min_z,max_z       = self.config_params.priors[2]
+        # Make sure multiple components do not swap
+        if len(self.z_indices) > 1:
+            in_prior &= np.all(np.diff(alpha[...,self.z_indices],axis=-1) >= 0,axis=-1)
 
-        cont_priors      = self.config_params.cont_prior # array_like
+        if np.ndim(in_prior) == 0:
+            return 0.0 if in_prior else -np.inf
+        return np.where(in_prior,0.0,-np.inf)
 
-        # Select the parameters that are free or tie (i.e not fixed)
-        final_vp_params_type = self.config_params.vp_params_type[~np.isnan(self.config_params.vp_params_flags)]
+    def lnprior_batch(self,alpha):
+        """
+        Same priors as lnprior for many walkers at once; 
+        alpha has shape (n_walkers, n_params)
+        """
+        return self.lnprior(np.atleast_2d(alpha))
 
-        sum_logN_prior = 0; sum_b_prior = 0; sum_z_prior = 0
+    def lnprob_and_grad(self,alpha):
+        """
+        Posterior and its exact gradient with respect to the 
+        parameters; the priors are flat, so only the likelihood 
+        contributes inside the priors. See 
+        vp_model.generic_prediction_jacobian for the model used; 
+        raises ValueError for configs with options of the model 
+        that have no derivatives (vp_model.unsupported_jacobian_options), 
+        so that lnprob always equals __call__.
 
-        model_redshifts = []
-        
-        for i in range(len(final_vp_params_type)):
-            if final_vp_params_type[i] == 'logN':
-                sum_logN_prior += tophat_prior(alpha[i],min_logN,max_logN)
-            elif final_vp_params_type[i] == 'b':
-                sum_b_prior += tophat_prior(alpha[i],min_b, max_b)
-            elif final_vp_params_type[i] == 'z':
-                model_redshifts.append(alpha[i])
-                sum_z_prior += tophat_prior(alpha[i],min_z,max_z)
-        
-        # Make sure multiple components do not swap
-        model_redshifts = np.array(model_redshifts)
-        if not all(sorted(model_redshifts) == model_redshifts):
-            sum_z_prior = -np.inf 
+        Parameters:
+        ----------
+        alpha: array_like
+            Parameters with shape (n_params,) or (n_walkers,n_params)
 
-        total_prior = sum_logN_prior + sum_b_prior + sum_z_prior
+        Returns
+        ---------
+        lnprob: float
+            Natural log of posterior probability; -inf outside 
+            of the priors. Array with length n_walkers for 2D alpha
+        grad: array
+            d(lnprob)/d(alpha) with the shape of alpha; zero 
+            outside of the priors
+        """
+        alpha = np.asarray(alpha,dtype=float)
+        lp = self.lnprior(alpha)
+        in_prior = np.isfinite(lp)
+        if not np.any(in_prior):
+            return lp, np.zeros(alpha.shape)
 
-        # linear continuum slope and intercept priors
-        if self.config_params.cont_normalize:
-            contiuum_prior = 0
-            for i in range(1,self.config_params.cont_nparams+1):
-                contiuum_prior += tophat_prior(alpha[-i],-cont_priors[i-1],
-                                                cont_priors[i-1])
-            total_prior = total_prior + contiuum_prior
+        if self.cont_marginalize:
+            # The data term is maximised over the continuum coefficients, 
+            # so its derivative is taken at a = cont_mean; the -ln|P|/2 
+            # term adds -model_flux*W*diag(X P^-1 X^T) per pixel
+            model_flux, jacobian = generic_prediction_jacobian(alpha,self.config_params)
+            ln_likelihood, cont_mean, cont_precision = self._marginalize_continuum(model_flux)
+            continuum = self.cont_offset + np.dot(cont_mean,self.cont_design.T)
+            resid = self.flux - model_flux*continuum
+            leverage = np.einsum('nk,...kl,nl->...n',self.cont_design,
+                                 np.linalg.inv(cont_precision),self.cont_design)
+            weight = (resid*continuum - model_flux*leverage)*self.inv_var
+            grad = np.sum(weight[...,np.newaxis,:]*jacobian,axis=-1)
+        else:
+            model_flux, jacobian = continuum_model_flux_jacobian(alpha,self.config_params)
+
+            resid = self.flux - model_flux
+            ln_likelihood = self.ln_norm - 0.5*np.dot(resid**2,self.inv_var)
+            grad = np.sum((resid*self.inv_var)[...,np.newaxis,:]*jacobian,axis=-1)
 
-        return total_prior
+        lnprob = np.where(in_prior & ~np.isnan(ln_likelihood),lp + ln_likelihood,-np.inf)
+        grad = np.where(np.isfinite(lnprob)[...,np.newaxis],grad,0.0)
+        if np.ndim(lnprob) == 0:
+            return float(lnprob), grad
+        return lnprob, grad
 
     def __call__(self,alpha):
         """
@@ -123,9 +317,18 @@ class Posterior(object):
         Returns
         ---------
         lnprob: float
-            Natural log of posterior probability
+            Natural log of posterior probability; array with 
+            length n_walkers for 2D alpha
         """
 
+        if np.ndim(alpha) > 1:
+            # Only compute the likelihood of walkers inside the priors
+            lnprob = self.lnprior_batch(alpha)
+            in_prior = np.isfinite(lnprob)
+            if np.any(in_prior):
+                lnprob[in_prior] += self.lnlike(np.asarray(alpha)[in_prior])
+            return lnprob
+
         lp = self.lnprior(alpha)
         
         if np.isinf(lp):
@@ -133,3 +336,144 @@ class Posterior(object):
         else:
             return np.atleast_1d(lp + self.lnlike(alpha))[0]
             
+
+
+def precision_report(config_fname,n_walkers=100,n_repeat=10,seed=0):
+    """
+    Benchmark and accuracy of the float32 model against the float64 
+    model for a config file. Walkers are drawn from the priors as in 
+    the MCMC initialization.
+
+    Parameters:
+    ----------
+    config_fname: str
+        Full path + the file name of the config file
+    n_walkers: int
+        Number of walkers evaluated in one batched call
+    n_repeat: int
+        Number of timed calls for each precision
+    seed: int
+        Seed of the random walkers
+
+    Returns:
+    ----------
+    report: dict
+        Time per batched posterior call [s] for each precision, the 
+        speedup, maximum absolute error of the model flux, and maximum 
+        absolute error of ln(likelihood) relative to the first walker
+    """
+    import os
+    import tempfile
+    import timeit
+    from bayesvp.config import DefineParams
+    from bayesvp.mcmc_setup import _create_walkers_init
+
+    # Same config with the model in single precision
+    config_dir = os.path.dirname(os.path.abspath(config_fname))
+    fd, config32_fname = tempfile.mkstemp(suffix='.dat',dir=config_dir)
+    with open(config_fname) as f_config, os.fdopen(fd,'w') as f_config32:
+        for line in f_config:
+            if not line.strip().startswith('precision'):
+                f_config32.write(line)
+        f_config32.write('\nprecision float32\n')
+    try:
+        config_params = {'float64': DefineParams(config_fname),
+                         'float32': DefineParams(config32_fname)}
+    finally:
+        os.remove(config32_fname)
+
+    config_params['float64'].nwalkers = n_walkers
+    np.random.seed(seed)
+    walkers = _create_walkers_init(config_params['float64'])
+
+    report = {}; flux = {}; lnlike = {}
+    for precision in ('float64','float32'):
+        posterior = Posterior(config_params[precision])
+        flux[precision] = continuum_model_flux(walkers,config_params[precision])
+        lnlike[precision] = posterior.lnlike(walkers)
+        report['time_' + precision] = timeit.timeit(lambda: posterior(walkers),
+                                                    number=n_repeat) / n_repeat
+
+    finite = np.isfinite(lnlike['float64']) & np.isfinite(lnlike['float32'])
+    dlnlike = {precision: lnlike[precision][finite] - lnlike[precision][finite][0]
+               for precision in lnlike}
+    report['speedup'] = report['time_float64'] / report['time_float32']
+    report['max_flux_error'] = np.max(np.abs(flux['float32'] - flux['float64']))
+    report['max_dlnlike_error'] = np.max(np.abs(dlnlike['float32'] - dlnlike['float64']))
+    return report
+
+def fused_report(config_fname,n_walkers=200,n_repeat=10,seed=0):
+    """
+    Benchmark of the compiled fused likelihood (numba key on the mcmc 
+    line) against the vectorised NumPy likelihood with the same 
+    Humlicek Voigt function and with the exact wofz. 
+
+    Parameters:
+    ----------
+    config_fname: str
+        Full path + the file name of the config file
+    n_walkers: int
+        Number of walkers evaluated in one batched call
+    n_repeat: int
+        Number of timed calls for each likelihood
+    seed: int
+        Seed of the random walkers
+
+    Returns:
+    ----------
+    report: dict
+        Time per batched likelihood call [s] of each likelihood, the 
+        speedups of the fused likelihood, and the maximum absolute 
+        difference of ln(likelihood) from the NumPy Humlicek likelihood
+    """
+    import timeit
+    from bayesvp.config import DefineParams
+    from bayesvp.fused import numba_available
+    from bayesvp.mcmc_setup import _create_walkers_init
+
+    if not numba_available:
+        raise ImportError('numba is required for the fused likelihood')
+
+    config_params = DefineParams(config_fname)
+    config_params.nwalkers = n_walkers
+    np.random.seed(seed)
+    walkers = _create_walkers_init(config_params)
+
+    # (jit, voigt_backend) of each likelihood
+    likelihoods = {'numpy_wofz': (False,'wofz'), 'numpy_humlicek': (False,'humlicek'),
+                   'fused': (True,'humlicek')}
+    report = {}; lnlike = {}
+    for name, (jit, backend) in likelihoods.items():
+        config_params.jit = jit
+        config_params.voigt_backend = backend
+        posterior = Posterior(config_params)
+        if jit and posterior.fused_lnlike is None:
+            raise ValueError('Config file options are not supported by the fused likelihood')
+        # First call compiles the fused loop
+        lnlike[name] = posterior.lnlike(walkers)
+        report['time_' + name] = timeit.timeit(lambda: posterior.lnlike(walkers),
+                                               number=n_repeat) / n_repeat
+
+    finite = np.isfinite(lnlike['fused']) & np.isfinite(lnlike['numpy_humlicek'])
+    report['speedup_humlicek'] = report['time_numpy_humlicek'] / report['time_fused']
+    report['speedup_wofz'] = report['time_numpy_wofz'] / report['time_fused']
+    report['max_dlnlike_error'] = np.max(np.abs(lnlike['fused'][finite] - 
+                                                lnlike['numpy_humlicek'][finite]))
+    return report
+
+def print_fused_report(config_fname,n_walkers=200,n_repeat=10):
+    report = fused_report(config_fname,n_walkers,n_repeat)
+    print('%-28s %12.3e s' % ('NumPy (wofz) time/call',report['time_numpy_wofz']))
+    print('%-28s %12.3e s' % ('NumPy (humlicek) time/call',report['time_numpy_humlicek']))
+    print('%-28s %12.3e s' % ('fused time/call',report['time_fused']))
+    print('%-28s %12.2f' % ('speedup (humlicek)',report['speedup_humlicek']))
+    print('%-28s %12.2f' % ('speedup (wofz)',report['speedup_wofz']))
+    print('%-28s %12.3e' % ('max dlnL error',report['max_dlnlike_error']))
+
+def print_precision_report(config_fname,n_walkers=100,n_repeat=10):
+    report = precision_report(config_fname,n_walkers,n_repeat)
+    print('%-20s %12.3e s' % ('float64 time/call',report['time_float64']))
+    print('%-20s %12.3e s' % ('float32 time/call',report['time_float32']))
+    print('%-20s %12.2f' % ('speedup',report['speedup']))
+    print('%-20s %12.3e' % ('max flux error',report['max_flux_error']))
+    print('%-20s %12.3e' % ('max dlnL error',report['max_dlnlike_error']))
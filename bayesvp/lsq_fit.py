@@ -0,0 +1,241 @@
+################################################################################
+#
+# lsq_fit.py        (c) Cameron Liang
+#                   University of Chicago
+#                   jwliang@oddjob.uchicago.edu
+#
+# Fast least-squares fit of the config file model (bvpfit --lsq) with a
+# Gaussian (Laplace) approximation of the posterior at the best fit. Writes
+# the same params_*.dat and spec_*.dat files as bvp_process_model; useful
+# to decide which systems need a full MCMC run.
+################################################################################
+
+import numpy as np
+import os
+import sys
+
+from scipy.optimize import least_squares
+
+from bayesvp.config import DefineParams
+from bayesvp.likelihood import Posterior
+from bayesvp.vp_model import continuum_model_flux, continuum_model_flux_jacobian,\
+                             generic_prediction, generic_prediction_jacobian,\
+                             unsupported_jacobian_options
+from bayesvp.mcmc_setup import _create_walkers_init, _order_redshifts
+from bayesvp.utilities import determine_autovp
+
+
+class LSQFit:
+    """
+    Bounded least-squares fit of the model defined by the config file,
+    started from several points drawn uniformly within the priors.
+    A marginalized continuum (continuum n marginalize) is solved for
+    at each step (its Gaussian priors add residuals a_i/sigma_i), so
+    only the Voigt profile parameters are fitted. The Jacobian is
+    exact, or from central differences of the same residuals for
+    configs whose model has no exact derivatives (see
+    vp_model.unsupported_jacobian_options).
+
+    Parameters:
+    ----------
+    config_params: obj
+        Parameters object defined by the config file
+    n_starts: int
+        Number of starting points
+
+    Attributes:
+    -----------
+    best_fit_params: array
+        Parameters (including all continuum coefficients) with the 
+        lowest chi-square; fits that violate the
+        priors (e.g. swapped redshifts) are only used if no other fit
+        converged
+    covariance: array
+        Covariance of the parameters from the inverse of the Gauss-Newton
+        Hessian (J^T J) of the normalized residuals at the best fit
+    param_errors: array
+        Square root of the diagonal of the covariance
+    model_flux: array
+        Model flux of the best fit
+    chi2: float
+        Chi-square of the best fit
+    success: bool
+        True if the best fit converged
+    """
+    def __init__(self,config_params,n_starts=8):
+        self.config_params = config_params
+        self.n_starts = n_starts
+
+        # Normalized residuals over the good pixels (see Posterior)
+        self.posterior = Posterior(config_params)
+        self.flux = np.asarray(self.posterior.flux,dtype=float)
+        self.weights = np.sqrt(self.posterior.inv_var)
+        self.exact_jacobian = not unsupported_jacobian_options(config_params)
+
+    def _solve_continuum(self,model_flux):
+        """Continuum and prior residuals at the conditional mean coefficients"""
+        _, cont_mean, _ = self.posterior._marginalize_continuum(model_flux)
+        continuum = self.posterior.cont_offset + np.dot(self.posterior.cont_design,cont_mean)
+        prior_resid = cont_mean*np.sqrt(np.diag(self.posterior.cont_prior_precision))
+        return cont_mean, continuum, prior_resid
+
+    def residuals(self,alpha):
+        if self.posterior.cont_marginalize:
+            model_flux = generic_prediction(alpha,self.config_params)
+            _, continuum, prior_resid = self._solve_continuum(model_flux)
+            return np.concatenate(((self.flux - model_flux*continuum)*self.weights,prior_resid))
+        return (self.flux - continuum_model_flux(alpha,self.config_params))*self.weights
+
+    def _numerical_jacobian(self,residuals,alpha):
+        """
+        Central differences of residuals for models without the exact 
+        Jacobian; steps are a fraction of the prior ranges suited to 
+        the precision of the model (unit range for the continuum 
+        coefficients solved for, on which the model is linear)
+        """
+        width = self.posterior.prior_upper - self.posterior.prior_lower
+        width = np.concatenate((width,np.ones(len(alpha)-len(width))))
+        steps = np.finfo(self.config_params.dtype).eps**(1/3.)*width
+        jacobian = []
+        for i in range(len(alpha)):
+            delta = np.zeros(len(alpha)); delta[i] = steps[i]
+            jacobian.append((residuals(alpha+delta) - residuals(alpha-delta))/(2*steps[i]))
+        return np.transpose(jacobian)
+
+    def residuals_jacobian(self,alpha):
+        if not self.exact_jacobian:
+            return self._numerical_jacobian(self.residuals,alpha)
+        if self.posterior.cont_marginalize:
+            # J^T r is the exact gradient of the cost since the continuum 
+            # coefficients minimize it; their dependence on alpha is dropped
+            model_flux, jacobian = generic_prediction_jacobian(alpha,self.config_params)
+            _, continuum, prior_resid = self._solve_continuum(model_flux)
+            return np.concatenate((-np.transpose(jacobian)*(continuum*self.weights)[:,np.newaxis],
+                                   np.zeros((len(prior_resid),len(alpha)))))
+        return self.residuals_jacobian_full(alpha)
+
+    def fit(self):
+        """
+        Run the fits from all starting points and keep the best one
+        """
+        starts = _create_walkers_init(self.config_params,self.n_starts)
+        lower,upper = self.posterior.prior_lower,self.posterior.prior_upper
+        starts = np.clip(_order_redshifts(starts,self.posterior.z_indices),lower,upper)
+
+        lnprior = self.posterior.lnprior
+        best = None; best_key = None
+        for x0 in starts:
+            try:
+                result = least_squares(self.residuals,x0,jac=self.residuals_jacobian,
+                                       bounds=(lower,upper),method='trf',x_scale='jac')
+            except (ValueError,np.linalg.LinAlgError):
+                continue
+            if not np.all(np.isfinite(result.fun)):
+                continue
+            key = (not np.isfinite(lnprior(result.x)), result.cost)
+            if best is None or key < best_key:
+                best = result; best_key = key
+
+        self.success = best is not None and best.status > 0
+        if best is None:
+            sys.exit('Error! Least-squares fit failed from all starting points.\n'
+                     'Exiting program...')
+
+        self.best_fit_params = best.x
+        jacobian = best.jac
+        if self.posterior.cont_marginalize:
+            # Covariance of all parameters from the Jacobian at the 
+            # coefficients of the best fit with the prior rows
+            cont_mean, _, _ = self._solve_continuum(generic_prediction(best.x,self.config_params))
+            self.best_fit_params = np.concatenate((best.x,cont_mean))
+            jacobian = np.concatenate((self.residuals_jacobian_full(self.best_fit_params),
+                                       np.hstack((np.zeros((len(cont_mean),len(best.x))),
+                                                  np.sqrt(self.posterior.cont_prior_precision)))))
+        self.model_flux = continuum_model_flux(self.best_fit_params,self.config_params)
+        self.chi2 = np.sum(((self.flux - self.model_flux)*self.weights)**2)
+
+        # Column scaling improves the conditioning of J^T J
+        scale = np.sqrt(np.sum(jacobian**2,axis=0))
+        scale[scale == 0] = 1.0
+        scaled_hessian = np.dot((jacobian/scale).T,jacobian/scale)
+        self.covariance = np.linalg.pinv(scaled_hessian)/np.outer(scale,scale)
+        self.param_errors = np.sqrt(np.abs(np.diag(self.covariance)))
+        return self.best_fit_params
+
+    def residuals_jacobian_full(self,alpha):
+        """Jacobian of the data residuals for parameters including the continuum"""
+        if not self.exact_jacobian:
+            def residuals(alpha):
+                return (self.flux - continuum_model_flux(alpha,self.config_params))*self.weights
+            return self._numerical_jacobian(residuals,alpha)
+        _, jacobian = continuum_model_flux_jacobian(alpha,self.config_params)
+        return -np.transpose(jacobian)*self.weights[:,np.newaxis]
+
+    def write_model_summary(self):
+        """
+        Write to file the best fit and the Gaussian confidence levels
+        in the columns of the MCMC summary (see utilities.write_mcmc_stats)
+        """
+        output_summary_fname = self.config_params.data_product_path_files + \
+                        '/params_'+self.config_params.chain_short_fname+'.dat'
+        f = open(output_summary_fname,'w')
+        f.write('x_med\tx_mean\tx_std\tx_cfl11\tx_cfl12\t x_cfl21\tx_cfl22\n')
+        for x,dx in zip(self.best_fit_params,self.param_errors):
+            f.write('%f\t%f\t%f\t%f\t%f\t%f\t%f\n' %
+                    (x,x,dx,x-dx,x+dx,x-1.96*dx,x+1.96*dx))
+        f.close()
+        print('--> %s' % 'params_'+self.config_params.chain_short_fname+'.dat')
+
+    def write_model_spectrum(self):
+        """
+        Write to file the input segment of spectrum for fitting and the
+        best fit model flux
+        """
+        output_fname = self.config_params.data_product_path_files +  \
+                    '/spec_' + self.config_params.chain_short_fname+'.dat'
+
+        np.savetxt(output_fname,np.c_[self.config_params.wave,
+                                      self.config_params.flux,
+                                      self.config_params.dflux,
+                                      self.model_flux],
+                                      header='wave\tflux\terror\tmodel\n')
+        print('--> %s' % 'spec_' + self.config_params.chain_short_fname+'.dat')
+
+
+def bvp_lsq_single(config_params,n_starts=8):
+    """
+    Least-squares fit of one config and write the data products
+
+    Returns
+    ----------
+    lsq: obj
+        LSQFit object with the best fit and covariance
+    """
+    lsq = LSQFit(config_params,n_starts)
+    lsq.fit()
+    print('Least-squares fit: chi2 = %.2f for %i pixels and %i parameters' %
+          (lsq.chi2,np.sum(config_params.good_pixels),len(lsq.best_fit_params)))
+    lsq.write_model_summary()
+    lsq.write_model_spectrum()
+    return lsq
+
+
+def bvp_lsq(config_fname,print_config=True):
+    """
+    Least-squares fit of the config file; in automatic mode each
+    number of components is fitted (see mcmc_setup.bvp_mcmc)
+    """
+    auto_vp, n_component_min, n_component_max = determine_autovp(config_fname)
+
+    if auto_vp:
+        basename_with_path, config_extension = os.path.splitext(config_fname)
+        for n in range(n_component_min,n_component_max+1):
+            config_params = DefineParams(basename_with_path + str(n) + config_extension)
+            if print_config:
+                config_params.print_config_params()
+            bvp_lsq_single(config_params)
+    else:
+        config_params = DefineParams(config_fname)
+        if print_config:
+            config_params.print_config_params()
+        bvp_lsq_single(config_params)
@@ -15,11 +15,13 @@ import os
 
 
 from bayesvp.config import DefineParams
+from bayesvp.diagnostics import compute_burnin_rhat
 from bayesvp.utilities import determine_autovp,model_info_criterion,\
-					  compare_model,gr_indicator 
+					  compare_model,RunningGR,autocorrelation_time,\
+					  effective_sample_size
 
 
-def _create_walkers_init(config_params):
+def _create_walkers_init(config_params,nwalkers=None):
 	"""
 	Initialize walkers with the free parameters. 
 	Note that the initialization sets the number of parameters
@@ -40,6 +42,8 @@ def _create_walkers_init(config_params):
 			initializationof the ranges.  
 		nwalkers: int
 			Number of walkers to run in MCMC.
+	nwalkers: int
+		Number of points to draw instead of config_params.nwalkers
 	
 	Returns
 	-----------
@@ -50,33 +54,37 @@ def _create_walkers_init(config_params):
 		used.
 	"""
 
+	if nwalkers is None:
+		nwalkers = config_params.nwalkers
+
 	temp_flags = config_params.vp_params_flags[~np.isnan(config_params.vp_params_flags)]
 	n_params =  len(list(set(temp_flags)))
 
 	# Get all the free parameters types
 	final_vp_params_type = config_params.vp_params_type[~np.isnan(config_params.vp_params_flags)]
 
-	p0 = np.zeros((n_params,config_params.nwalkers))
+	p0 = np.zeros((n_params,nwalkers))
 	for i in range(n_params):
 		# Match priors with the parameter types
 		if final_vp_params_type[i] == 'logN':
 			p0[i] = np.random.uniform(config_params.priors[0][0],
 									config_params.priors[0][1],
-									size=config_params.nwalkers)
+									size=nwalkers)
 		elif final_vp_params_type[i] == 'b':
 			p0[i] = np.random.uniform(config_params.priors[1][0],
 									config_params.priors[1][1],
-									size=config_params.nwalkers)
+									size=nwalkers)
 		elif final_vp_params_type[i] == 'z':
 			p0[i] = np.random.uniform(config_params.priors[2][0],
 									config_params.priors[2][1],
-									size=config_params.nwalkers)
+									size=nwalkers)
 
-	if config_params.cont_normalize:
-		p1 = np.zeros((config_params.cont_nparams,config_params.nwalkers))
+	# Marginalized continuum parameters are not sampled
+	if config_params.cont_normalize and not config_params.cont_marginalize:
+		p1 = np.zeros((config_params.cont_nparams,nwalkers))
 
 		for i in range(config_params.cont_nparams):
-			p1[i] = np.random.uniform(-1,1,size=config_params.nwalkers )
+			p1[i] = np.random.uniform(-1,1,size=nwalkers )
 
 		p = np.concatenate((p0,p1),axis=0)
 		return np.transpose(p)
@@ -84,11 +92,237 @@ def _create_walkers_init(config_params):
 	return np.transpose(p0)
 
 
+# Number of optimiser starts and size of the walker ball in units of
+# the Laplace approximation (inverse curvature) at the MAP
+map_n_starts = 8
+map_ball_scale = 0.1
+
+def _order_redshifts(p,z_indices):
+	"""
+	Copy of the points p (n_points, ndim) with the redshifts (columns 
+	z_indices) of each point sorted, as required by the priors
+	"""
+	p = np.array(p)
+	p[:,z_indices] = np.sort(p[:,z_indices],axis=1)
+	return p
+
+def _map_optimize(args):
+	"""
+	Bounded (L-BFGS-B) maximisation of the posterior from one starting
+	point, in coordinates scaled to the unit interval of the priors.
+	Models without the exact gradient (see 
+	vp_model.unsupported_jacobian_options) use the gradient free 
+	Powell method on the posterior itself.
+	Top level function so that it can be mapped by a multiprocessing pool.
+	"""
+	from scipy.optimize import minimize
+	from bayesvp.vp_model import unsupported_jacobian_options
+	lnprob, lower, upper, x0 = args
+	width = upper - lower
+
+	def negative_lnprob(u):
+		lp, grad = lnprob.lnprob_and_grad(lower + u*width)
+		if not np.isfinite(lp):
+			return 1e300, np.zeros(len(u))
+		return -lp, -grad*width
+
+	def negative_lnprob_value(u):
+		lp = lnprob(lower + u*width)
+		if not np.isfinite(lp):
+			return 1e300
+		return -lp
+
+	# Priors are half open [lower, upper)
+	u_bounds = [(0,1-1e-9)]*len(x0)
+	try:
+		if unsupported_jacobian_options(lnprob.config_params):
+			result = minimize(negative_lnprob_value,(x0-lower)/width,
+							  method='Powell',bounds=u_bounds)
+		else:
+			result = minimize(negative_lnprob,(x0-lower)/width,jac=True,
+							  method='L-BFGS-B',bounds=u_bounds)
+	except (ValueError,FloatingPointError):
+		return x0, -np.inf
+	x = lower + result.x*width
+	return x, lnprob(x)
+
+def _lnprob_gradient(lnprob,x,lower,upper,h):
+	"""
+	Gradient of the posterior at the points x (n_points, ndim) from 
+	central differences of lnprob with steps h in the coordinates 
+	scaled to the unit interval of the priors; one sided next to 
+	the bounds of the priors and zero outside of them, as for 
+	likelihood.Posterior.lnprob_and_grad
+	"""
+	width = upper - lower
+	n_points, ndim = np.shape(x)
+	u = (x - lower)/width
+	steps = h*np.eye(ndim)
+	u_plus = np.minimum(u[:,np.newaxis,:] + steps, 1-1e-9)
+	u_minus = np.maximum(u[:,np.newaxis,:] - steps, 0)
+	lnprob_plus = lnprob(lower + u_plus.reshape(-1,ndim)*width).reshape(n_points,ndim)
+	lnprob_minus = lnprob(lower + u_minus.reshape(-1,ndim)*width).reshape(n_points,ndim)
+	du_plus = np.diagonal(u_plus,axis1=1,axis2=2) - u
+	du_minus = u - np.diagonal(u_minus,axis1=1,axis2=2)
+
+	lnprob_center = np.repeat(np.reshape(lnprob(x),(n_points,1)),ndim,axis=1)
+	outside = ~np.isfinite(lnprob_plus)
+	lnprob_plus[outside] = lnprob_center[outside]; du_plus[outside] = 0
+	outside = ~np.isfinite(lnprob_minus)
+	lnprob_minus[outside] = lnprob_center[outside]; du_minus[outside] = 0
+
+	grad = (lnprob_plus - lnprob_minus)/(du_plus + du_minus)/width
+	return np.where(np.isfinite(lnprob_center) & np.isfinite(grad),grad,0.0)
+
+def _laplace_covariance(lnprob,x_map,lower,upper,max_fraction=0.1):
+	"""
+	Covariance at the MAP from the inverse of the curvature of the
+	posterior (central differences of the exact gradient, or of the 
+	gradient from _lnprob_gradient for models without it). Flat or
+	badly determined directions are limited to max_fraction of the
+	prior range.
+	"""
+	from bayesvp.vp_model import unsupported_jacobian_options
+	exact_gradient = not unsupported_jacobian_options(lnprob.config_params)
+	ndim = len(x_map); width = upper - lower
+	u_map = (x_map - lower)/width
+	h = 1e-5 if exact_gradient else 1e-4
+	u_plus = np.minimum(u_map + h, 1-1e-9)
+	u_minus = np.maximum(u_map - h, 0)
+
+	points = np.tile(u_map,(2*ndim,1))
+	points[np.arange(ndim),np.arange(ndim)] = u_plus
+	points[ndim+np.arange(ndim),np.arange(ndim)] = u_minus
+	if exact_gradient:
+		_, grad = lnprob.lnprob_and_grad(lower + points*width)
+	else:
+		grad = _lnprob_gradient(lnprob,lower + points*width,lower,upper,h)
+	grad = grad*width
+
+	hessian = (grad[:ndim] - grad[ndim:]) / (u_plus - u_minus)[:,np.newaxis]
+	hessian = 0.5*(hessian + hessian.T)
+	if not np.all(np.isfinite(hessian)):
+		return None
+
+	eigenvalues,eigenvectors = np.linalg.eigh(-hessian)
+	eigenvalues = np.maximum(eigenvalues,1/max_fraction**2)
+	cov_u = np.dot(eigenvectors/eigenvalues,eigenvectors.T)
+	return cov_u*np.outer(width,width)
 
-def bvp_mcmc_single(config_params,chain_filename_ncomp = None):
+def _create_walkers_map(config_params,lnprob):
+	"""
+	Initialize walkers in a ball around the maximum a posteriori (MAP).
+	The MAP is found by bounded optimisations (run in parallel over
+	config_params.nthreads processes) from map_n_starts uniformly drawn
+	points; the walkers are drawn from the Laplace approximation at
+	the MAP with its width scaled by map_ball_scale. Falls back to
+	_create_walkers_init if the optimiser fails.
+
+	Parameters
+	-----------
+	config_params: obj
+		Parameter object defined by the config file
+	lnprob: obj
+		Posterior of the config (see likelihood.Posterior)
+
+	Returns
+	-----------
+	p0: array; shape = (nwalkers, ndim)
+		The starting point of the walkers
+	"""
+	p_uniform = _create_walkers_init(config_params)
+	lower,upper = lnprob.prior_lower,lnprob.prior_upper
+
+	# Starting points with ordered redshifts to be inside the priors
+	starts = _order_redshifts(p_uniform[:map_n_starts],lnprob.z_indices)
+
+	tasks = [(lnprob,lower,upper,x0) for x0 in starts]
+	if config_params.nthreads > 1:
+		import multiprocessing
+		pool = multiprocessing.Pool(min(config_params.nthreads,len(tasks)))
+		results = pool.map(_map_optimize,tasks)
+		pool.close(); pool.join()
+	else:
+		results = list(map(_map_optimize,tasks))
+
+	lnprob_max = [result[1] for result in results]
+	if not np.any(np.isfinite(lnprob_max)):
+		print('MAP optimisation failed; walkers initialized uniformly.')
+		return p_uniform
+	x_map = results[int(np.argmax(lnprob_max))][0]
+
+	cov = _laplace_covariance(lnprob,x_map,lower,upper)
+	if cov is None:
+		print('Curvature at the MAP is not finite; walkers initialized uniformly.')
+		return p_uniform
+
+	# Redraw walkers that fall outside the priors
+	p0 = np.tile(x_map,(config_params.nwalkers,1))
+	invalid = np.ones(config_params.nwalkers,dtype=bool)
+	for i in range(100):
+		p0[invalid] = np.random.multivariate_normal(x_map,map_ball_scale**2*cov,
+													size=np.sum(invalid))
+		invalid = ~np.isfinite(lnprob.lnprior(p0))
+		if not np.any(invalid):
+			break
+	p0[invalid] = x_map
+	return p0
+
+
+
+class _VectorizedPool(object):
+	"""
+	Stand-in for a multiprocessing pool so that kombine evaluates 
+	the posterior of all walkers with one batched call. Other 
+	functions mapped by kombine (e.g KDE) use the built-in map.
+	"""
+	def map(self,function,points):
+		if hasattr(function,'lnpost') and hasattr(function,'kde'):
+			points = np.asarray(list(points))
+			lnpost = function.lnpost(points,*function.args)
+			lnprop = function.kde(points)
+			return list(zip(lnpost,lnprop))
+		else:
+			return list(map(function,points))
+
+	def close(self):
+		pass
+
+# Versions of kombine whose private sampler attributes are used to 
+# checkpoint and resume a run; see _kombine_state
+kombine_checkpoint_versions = ('0.8',)
+
+def _kombine_state(sampler,state=None):
+	"""
+	Get (state=None) or restore the state with which a kombine sampler 
+	continues a run: the proposal (KDE) and the walkers, lnpost and 
+	lnprop of the last step. kombine has no public interface for these, 
+	so its private attributes are only used here, and only for the 
+	versions in kombine_checkpoint_versions.
+	"""
+	import kombine
+	version = getattr(kombine,'__version__','unknown')
+	if ('.'.join(version.split('.')[:2]) not in kombine_checkpoint_versions or 
+		not hasattr(sampler,'_kde') or not hasattr(sampler,'_last_run_mcmc_result')):
+		sys.exit('Error! Checkpoints of the kombine sampler need kombine %s; found %s.\n'
+				 'Exiting program...' % (' or '.join(kombine_checkpoint_versions),version))
+	if state is None:
+		last_result = sampler._last_run_mcmc_result
+		if last_result is not None:
+			last_result = tuple(last_result[:3])
+		return {'kde': sampler._kde, 'last_result': last_result}
+	sampler._kde = state['kde']
+	sampler._last_run_mcmc_result = state['last_result']
+
+
+def bvp_mcmc_single(config_params,chain_filename_ncomp = None,resume = False):
 	"""
 	Run MCMC and save the chain based on parameters defined 
-	in config file. 
+	in config file. The chain is written to disk every 
+	checkpoint_steps steps together with the state of the 
+	sampler (chain_filename_ncomp + '_state.pkl'). Sampling stops 
+	before nsteps once converged if config_params.gr_stop or 
+	config_params.ess_stop is set.
 
 	Parameters
 	-----------
@@ -98,66 +332,264 @@ def bvp_mcmc_single(config_params,chain_filename_ncomp = None):
 	chain_filename_ncomp: str
 		Output filename without extention; '.npy' is assumed 
 		added later
+	resume: bool
+		Continue from the last checkpoint of an interrupted run 
+		(up to config_params.nsteps). With a seed in the config 
+		file, emcee, kombine and hmc give the same chain as an 
+		uninterrupted run; kombine continues with the proposal of 
+		the checkpoint without a new burn-in.
 
 	Returns
 	-----------
 	chains: python format (.npy) binary file 
 		One chain for the specified MCMC run. Use np.load
 		to load the n-dim array into memory for manipulation.
+		The Gelman-Rubin indicators are written to _GR.dat, the 
+		autocorrelation times and effective sample sizes after 
+		burn-in to _ACT.dat and the thinned chain after burn-in 
+		to _thinned.npy
 	"""
 	from bayesvp.likelihood import Posterior
+	from bayesvp.checkpoint import ChainWriter, save_checkpoint, load_checkpoint
 
 	if chain_filename_ncomp is None:
 		chain_filename_ncomp = config_params.chain_fname
-
-	# define the MCMC parameters.
-	p0 = _create_walkers_init(config_params)
-	ndim = np.shape(p0)[1]
-
+	state_fname = chain_filename_ncomp + '_state.pkl'
+	sampler_name = config_params.mcmc_sampler.lower()
+	if sampler_name not in ('emcee','kombine','hmc'):
+		sys.exit('Error! No MCMC sampler selected.\nExiting program...')
+	if sampler_name == 'hmc':
+		# HMC samples the model of the exact gradient; see 
+		# vp_model.generic_prediction_jacobian
+		from bayesvp.vp_model import unsupported_jacobian_options
+		options = unsupported_jacobian_options(config_params)
+		if options:
+			sys.exit('Error! The hmc sampler is not available with: %s\nExiting program...' 
+					% ', '.join(options))
 
 	# Define the natural log of the posterior 
 	lnprob = Posterior(config_params)
 
-	if config_params.mcmc_sampler.lower() == 'emcee':
+	state = None
+	if resume:
+		state = load_checkpoint(state_fname)
+		if state is None:
+			print('No checkpoint found for %s; starting a new run' % chain_filename_ncomp)
+		elif state['sampler'] != sampler_name:
+			sys.exit('Error! Checkpoint was written by the %s sampler.\nExiting program...' 
+					% state['sampler'])
+		else:
+			print('Resuming %s from step %i' % (chain_filename_ncomp,state['n_steps']))
+
+	if config_params.seed is not None:
+		np.random.seed(config_params.seed)
+
+	# define the MCMC parameters.
+	if state is None:
+		if config_params.walker_init == 'map':
+			p0 = _create_walkers_map(config_params,lnprob)
+		else:
+			p0 = _create_walkers_init(config_params)
+		n_done = 0
+	else:
+		p0 = state['position']
+		n_done = state['n_steps']
+	ndim = np.shape(p0)[1]
+	nwalkers = config_params.nwalkers; nsteps = config_params.nsteps
+	writer = ChainWriter(chain_filename_ncomp + '.npy',nwalkers,ndim,n_done)
+
+	# Gelman-Rubin indicators recorded every 5% of nsteps as the 
+	# chain is produced (from the saved steps for a resumed run)
+	gr_monitor = RunningGR(nwalkers,ndim,max(int(nsteps*0.05),1))
+	if n_done > 0:
+		saved_chain = np.load(chain_filename_ncomp + '.npy',mmap_mode='r')
+		for i in range(0,n_done,config_params.checkpoint_steps):
+			gr_monitor.update(saved_chain[i:i+config_params.checkpoint_steps])
+		del saved_chain
+	converged = state is not None and state.get('converged',False)
+
+	def chunks():
+		# Number of steps until the next checkpoint
+		n = n_done
+		while n < nsteps and not converged:
+			yield min(config_params.checkpoint_steps,nsteps-n)
+			n += config_params.checkpoint_steps
+
+	# Burn-in for the effective sample size
+	gr_threshold = 1.005
+	if config_params.gr_stop is not None:
+		gr_threshold = config_params.gr_stop[1]
+
+	def checkpoint(samples,**sampler_state):
+		# Save the new steps and the state of the sampler; returns 
+		# True if sampling can stop (see config_params.gr_stop 
+		# and config_params.ess_stop)
+		writer.append(samples)
+		gr_monitor.update(samples)
+		stop = config_params.gr_stop is not None or config_params.ess_stop is not None
+		if config_params.gr_stop is not None:
+			stop = gr_monitor.converged_steps(gr_threshold) >= config_params.gr_stop[0]
+		if stop and config_params.ess_stop is not None:
+			burnin = gr_monitor.burnin(gr_threshold)
+			stop = burnin is not None and burnin < writer.n_steps
+			if stop:
+				chain = np.load(chain_filename_ncomp + '.npy',mmap_mode='r')
+				stop = np.min(effective_sample_size(chain[burnin:])) >= config_params.ess_stop
+				del chain
+		if stop:
+			print('Converged; stopped at step %i' % writer.n_steps)
+		sampler_state.update({'sampler': sampler_name, 'n_steps': writer.n_steps, 
+							  'converged': stop})
+		save_checkpoint(state_fname,sampler_state)
+		return stop
+
+	if sampler_name == 'emcee':
 		import emcee
-		sampler = emcee.EnsembleSampler(config_params.nwalkers, ndim, lnprob, 
-										threads=config_params.nthreads)
-		sampler.run_mcmc(p0,config_params.nsteps)
-		np.save(chain_filename_ncomp + '.npy', np.swapaxes(sampler.chain,0,1))
+		sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, 
+										threads=config_params.nthreads,
+										vectorize=config_params.vectorize)
+		if state is None:
+			if config_params.seed is not None:
+				sampler.random_state = np.random.RandomState(config_params.seed).get_state()
+			current = emcee.State(p0)
+		else:
+			current = emcee.State(p0,log_prob=state['lnprob'],random_state=state['random_state'])
+
+		for n in chunks():
+			samples = np.empty((n,nwalkers,ndim))
+			for i,current in enumerate(sampler.sample(current,iterations=n,store=False)):
+				samples[i] = current.coords
+			if checkpoint(samples,position=current.coords,lnprob=current.log_prob,
+						  random_state=sampler.random_state):
+				break
 	
-	elif config_params.mcmc_sampler.lower() == 'kombine':
+	elif sampler_name == 'kombine':
 		import kombine
-		sampler = kombine.Sampler(config_params.nwalkers, ndim, lnprob,
-								  processes=config_params.nthreads)
-		
-		# First do a rough burn in based on accetance rate.
-		p_post_q = sampler.burnin(p0)
-		p_post_q = sampler.run_mcmc(config_params.nsteps)
-		np.save(chain_filename_ncomp + '.npy', sampler.chain)
-	
-	else:
-		sys.exit('Error! No MCMC sampler selected.\nExiting program...')
-
+		if config_params.vectorize:
+			pool = _VectorizedPool()
+		else:
+			pool = None
+		if state is None:
+			sampler = kombine.Sampler(nwalkers, ndim, lnprob,
+									  processes=config_params.nthreads,pool=pool)
+			# Exit before the burn-in if the run cannot be checkpointed
+			_kombine_state(sampler)
+			# First do a rough burn in based on accetance rate.
+			sampler.burnin(p0)
+		elif n_done < nsteps and not converged:
+			sampler = kombine.Sampler(nwalkers, ndim, lnprob,
+									  processes=config_params.nthreads,pool=pool)
+			# Continue with the proposal, walkers and random state 
+			# of the checkpoint instead of a new burn-in
+			_kombine_state(sampler,state)
+			np.random.set_state(state['random_state'])
+
+		# kombine keeps the chain of this run in memory as well
+		for n in chunks():
+			p_post_q = sampler.run_mcmc(n)
+			if checkpoint(sampler.chain[-n:],position=np.array(p_post_q[0]),
+						  random_state=np.random.get_state(),**_kombine_state(sampler)):
+				break
+
+	elif sampler_name == 'hmc':
+		from bayesvp.hmc import HMCSampler
+		sampler = HMCSampler(nwalkers, ndim, lnprob.lnprob_and_grad, seed=config_params.seed)
+
+		# Warm-up (not saved) adapts the step size and mass matrix
+		if state is None:
+			sampler.warmup(p0,nsteps//2)
+			save_checkpoint(state_fname,{'sampler': sampler_name, 'n_steps': 0,
+										 'position': p0, 'hmc_state': sampler.get_state()})
+		else:
+			sampler.set_state(state['hmc_state'])
+
+		for n in chunks():
+			samples = np.empty((n,nwalkers,ndim))
+			for i,(position,_,_) in enumerate(sampler.sample(n)):
+				samples[i] = position
+			if checkpoint(samples,position=position,hmc_state=sampler.get_state()):
+				break
+	writer.close()
+
+	print((writer.n_steps,nwalkers,ndim))
+	# Gelman-Rubin Indicator before the last step
+	n_steps = np.array(gr_monitor.steps,dtype=int)
+	Rgrs    = np.array(gr_monitor.values).reshape(len(n_steps),ndim)
+	recorded = n_steps < writer.n_steps
+
+	np.savetxt(chain_filename_ncomp+ '_GR.dat',np.c_[n_steps[recorded],Rgrs[recorded]],fmt='%.5f',
+				header='col1=steps\tcoln=gr_indicator')
 
+	# Autocorrelation time and effective sample size after burn-in; 
+	# the chain thinned by half the shortest autocorrelation time 
+	# keeps nearly independent samples
+	chain = np.load(chain_filename_ncomp + '.npy',mmap_mode='r')
+	if config_params.burnin_method == 'rhat':
+		burnin = compute_burnin_rhat(chain,config_params.burnin_threshold)
+	else:
+		burnin = gr_monitor.burnin(config_params.burnin_threshold)
+	if burnin is None or burnin >= writer.n_steps:
+		burnin = 0
+	chain = chain[burnin:]
+	tau = autocorrelation_time(chain)
+	ess = len(chain)*nwalkers/tau
+	thin = max(int(0.5*np.nanmin(tau)),1) if np.any(np.isfinite(tau)) else 1
+	np.savetxt(chain_filename_ncomp+ '_ACT.dat',np.c_[tau,ess],fmt='%.5f',
+				header='burnin=%i\tthin=%i\ncol1=autocorrelation_time\tcol2=effective_sample_size' 
+				% (burnin,thin))
+	np.save(chain_filename_ncomp + '_thinned.npy',chain[::thin])
 
-	print(np.shape(sampler.chain))
-	# Compute Gelman-Rubin Indicator
-	dnsteps = int(config_params.nsteps*0.05)
-	n_steps = []; Rgrs = []	
-	for n in range(dnsteps,config_params.nsteps):
-		if n % dnsteps == 0:
-			Rgrs.append(gr_indicator(sampler.chain[:n,:,:]))
-			n_steps.append(n)
-	n_steps = np.array(n_steps)
-	Rgrs    = np.array(Rgrs)
+	return 
 
-	np.savetxt(chain_filename_ncomp+ '_GR.dat',np.c_[n_steps,Rgrs],fmt='%.5f',
-				header='col1=steps\tcoln=gr_indicator')
 
-	return 
+def _threads_per_model(nthreads,n_models):
+	"""
+	Number of threads of each fit when n_models fits run at the 
+	same time, such that n_models*threads does not exceed the 
+	number of cores
+	"""
+	n_cores = os.cpu_count() or 1
+	if n_models > 1 and n_models*nthreads > n_cores:
+		threads = max(1,n_cores//n_models)
+		if threads < nthreads:
+			print('Reducing threads per model from %i to %i for %i cores' %
+				  (nthreads,threads,n_cores))
+		return threads
+	return nthreads
+
+def _bvp_mcmc_ncomp(config_fname_ncomp,nthreads=None,resume=False):
+	"""
+	Run the MCMC of one config with n components in automatic mode; 
+	module level function so that it can be run in a process pool
 
+	Returns
+	-----------
+	model_evidence: float
+		aic, bic or bf of the fit (see utilities.model_info_criterion)
+	"""
+	# Load config parameter object 
+	config_params = DefineParams(config_fname_ncomp)
+	if nthreads is not None:
+		config_params.nthreads = nthreads
+	config_params.print_config_params()
+	# Run MCMC
+	bvp_mcmc_single(config_params,config_params.chain_fname,resume)
+
+	# compute values of aic, bic or bf
+	return model_info_criterion(config_params)
+
+def _write_model_evidence(config_params,components_count,model_evidence):
+	"""
+	Write the aic, bic or bf of each number of components to 
+	e.g. bic_<chain name>.dat in the mcmc output path
+	"""
+	np.savetxt(config_params.mcmc_outputpath  + '/' +
+			   config_params.model_selection + '_' + 
+			   config_params.chain_short_fname[:-1]+'.dat',
+			   np.c_[components_count,model_evidence],
+			   fmt=('%d','%.4f'),header='nComponents\tValues')
 
-def bvp_mcmc(config_fname,chain_fname,print_config=True):
+def bvp_mcmc(config_fname,chain_fname,print_config=True,resume=False):
 	"""
 	Run fixed number of component fit specified by the 
 	config file or make copies of the configs and run up 
@@ -169,6 +601,12 @@ def bvp_mcmc(config_fname,chain_fname,print_config=True):
 	config_fname: str
 		Full path + the file name
 		See ./readme.md for detaieded structure of the config file
+	resume: bool
+		Continue interrupted runs from their last checkpoint; 
+		see bvp_mcmc_single
+
+	In automatic mode, the numbers of components are fitted 
+	model_processes at a time in a process pool (see config.py)
 
 	Returns
 	-----------
@@ -184,41 +622,35 @@ def bvp_mcmc(config_fname,chain_fname,print_config=True):
 
 
 	if auto_vp:
-		model_evidence = np.zeros(n_component_max-n_component_min+1)
-		for n in range(n_component_max-n_component_min+1):
-
-			# Get new config filename; 
-			basename_with_path, config_extension = os.path.splitext(config_fname)
-			config_fname_ncomp = (basename_with_path + str(n+n_component_min)
-								+ config_extension)
-
-			# Load config parameter object 
-			config_params = DefineParams(config_fname_ncomp)
-			#if print_config:
-			config_params.print_config_params()
-			# Run MCMC
-			bvp_mcmc_single(config_params,config_params.chain_fname)
-
-			# compute values of aic, bic or bf
-			model_evidence[n] = model_info_criterion(config_params)
-			components_count  = np.arange(n_component_min,n_component_max+1)
-
-			# compare with the previous fit 
-			if 0 < n <= n_component_max-1:
-
-				if config_params.model_selection.lower() in ('odds','bf'):   
-					index = np.where(model_evidence[:n+1] == np.max(model_evidence[:n+1]))[0]
-
-				if config_params.model_selection.lower() in ('aic','bic'):
-					index = np.where(model_evidence[:n+1] == np.min(model_evidence[:n+1]))[0]
-
-				# Compare BIC/AIC/Odds ratios
-				#if compare_model(model_evidence[n-1], model_evidence[n],config_params.model_selection):
-				np.savetxt(config_params.mcmc_outputpath  + '/' +
-                           config_params.model_selection + '_' + 
-                           config_params.chain_short_fname[:-1]+'.dat',
-                           np.c_[components_count[:n+1],model_evidence[:n+1]],
-                           fmt=('%d','%.4f'),header='nComponents\tValues')
+		basename_with_path, config_extension = os.path.splitext(config_fname)
+		components_count = np.arange(n_component_min,n_component_max+1)
+		config_fnames = [basename_with_path + str(n) + config_extension
+						 for n in components_count]
+
+		# Split the cores between the models and the walkers of each model
+		config_params = DefineParams(config_fnames[0])
+		n_models = min(config_params.model_processes,len(config_fnames))
+
+		if n_models > 1:
+			nthreads = _threads_per_model(config_params.nthreads,n_models)
+			import concurrent.futures
+			print('Fitting %i component counts in parallel with %i threads each' %
+				  (n_models,nthreads))
+			with concurrent.futures.ProcessPoolExecutor(n_models) as executor:
+				model_evidence = np.array(list(executor.map(_bvp_mcmc_ncomp,config_fnames,
+													[nthreads]*len(config_fnames),
+													[resume]*len(config_fnames))))
+			if len(config_fnames) > 1:
+				_write_model_evidence(config_params,components_count,model_evidence)
+		else:
+			model_evidence = np.zeros(len(config_fnames))
+			for n in range(len(config_fnames)):
+				model_evidence[n] = _bvp_mcmc_ncomp(config_fnames[n],resume=resume)
+
+				# compare with the previous fit 
+				if n > 0:
+					_write_model_evidence(config_params,components_count[:n+1],
+										  model_evidence[:n+1])
 					
 	else:
 		# Load config parameter object 
@@ -226,4 +658,4 @@ def bvp_mcmc(config_fname,chain_fname,print_config=True):
 		if print_config:
 		 config_params.print_config_params()
 		# Run fit as specified in config
-		bvp_mcmc_single(config_params,config_params.chain_fname)	
+		bvp_mcmc_single(config_params,config_params.chain_fname,resume)	
@@ -38,7 +38,8 @@ class ProcessModel:
         #print(self.config_param)
         mcmc_chain_fname = config_param.chain_fname + '.npy'
         print(config_param.chain_fname)
-        self.burnin = compute_burnin_GR(config_param.chain_fname + '_GR.dat')
+        self.burnin = compute_burnin_GR(config_param.chain_fname + '_GR.dat',
+                                        config_param.burnin_threshold,config_param.burnin_method)
         
         self.mcmc_chain = np.load(mcmc_chain_fname)
         self.mcmc_chain = self.mcmc_chain[self.burnin:, :, :]
@@ -47,6 +48,14 @@ class ProcessModel:
         
         self.burned_in_samples = self.mcmc_chain.reshape((-1, self.config_param.n_params))
 
+        # Continuum coefficients marginalized during sampling are drawn 
+        # from their conditional posterior given each sample
+        if self.config_param.cont_normalize and self.config_param.cont_marginalize:
+            from bayesvp.likelihood import Posterior
+            cont_samples = Posterior(self.config_param).sample_continuum(self.burned_in_samples)
+            self.burned_in_samples = np.hstack((self.burned_in_samples,cont_samples))
+        self.n_params = np.shape(self.burned_in_samples)[1]
+
 
         # Best fit model parameters and spectrum flux
         self.best_fit_params = np.median(self.burned_in_samples,axis=0)
@@ -61,8 +70,8 @@ class ProcessModel:
         self.plot_param_labels = []
         self.gr_param_label = []
         self.ascii_filename_label = []
-        for n in range(self.config_param.n_params):
-            if n < self.config_param.n_params-self.config_param.cont_nparams:
+        for n in range(self.n_params):
+            if n < self.n_params-self.config_param.cont_nparams:
                 if self.config_param.vp_params_type[n] == 'logN':
                     logN_counter += 1
                     temp_label = r'$\log N_{%s}$' % str(logN_counter)
@@ -128,7 +137,7 @@ class ProcessModel:
         """
 
         self.params_pdfs = []
-        for n in range(self.config_param.n_params):
+        for n in range(self.n_params):
             bin_step_size = 0.01
             if 'z' in self.ascii_filename_label[n]:
                 pdf, edges = np.histogram(self.burned_in_samples[:,n]*1e5,density=1,bins=bins)
@@ -156,7 +165,7 @@ class ProcessModel:
                                     bin_step_size)
                 self.params_pdfs.append([x_tmp,log_pdf_tmp])
 
-            if n < self.config_param.n_params-self.config_param.cont_nparams:
+            if n < self.n_params-self.config_param.cont_nparams:
                 self.save_marginalized_pdf(n)
 
         self.params_pdfs = np.array(self.params_pdfs)
@@ -210,12 +219,12 @@ class ProcessModel:
         self.truths = truths
         if self.truths:
             self.truths = np.array(truths)
-            if len(truths) != self.config_param.n_params:
+            if len(truths) != self.n_params:
                 sys.exit('Number of true values (%i) should equal number of parameters (%i)\n Exiting program...' 
-                        % (len(truths),self.config_param.n_params))
+                        % (len(truths),self.n_params))
 
-        for n in range(self.config_param.n_params):
-            if (n < (self.config_param.n_params-self.config_param.cont_nparams) 
+        for n in range(self.n_params):
+            if (n < (self.n_params-self.config_param.cont_nparams) 
                 and self.config_param.vp_params_type[n] == 'z'):
                 self.burned_in_samples[:,n] = self.burned_in_samples[:,n] * 1e5
                 
@@ -263,6 +272,26 @@ class ProcessModel:
         print('--> %s' % 'GR_' + self.config_param.chain_short_fname + '.pdf')
 
 
+    def write_convergence_summary(self):
+        """
+        Write to file the rank-normalised split R-hat and the bulk 
+        and tail effective sample sizes of the sampled parameters 
+        after burn-in; see diagnostics.py
+        """
+        from bayesvp.diagnostics import convergence_summary
+        summary = convergence_summary(self.mcmc_chain)
+        output_fname = self.config_param.data_product_path_files + \
+                       '/convergence_' + self.config_param.chain_short_fname + '.dat'
+        np.savetxt(output_fname,summary,fmt='%.5f',
+                   header='burnin=%i\nrhat\tess_bulk\tess_tail' % self.burnin)
+        print('--> %s' % 'convergence_' + self.config_param.chain_short_fname + '.dat')
+
+        rhat, ess_bulk, ess_tail = summary.T
+        if np.any(rhat > 1.01) or np.any(np.minimum(ess_bulk,ess_tail) < 400):
+            print('Warning: chains may not be converged (max R-hat = %.3f, '
+                  'min ESS = %.0f); consider a longer run' % 
+                  (np.nanmax(rhat),np.nanmin(np.minimum(ess_bulk,ess_tail))))
+
     def write_model_spectrum(self):
         """
         Write to file the input segment of spectrum for fitting and the 
@@ -286,7 +315,10 @@ class ProcessModel:
         mcmc_chain_fname = self.config_param.chain_fname + '.npy'
         output_summary_fname = self.config_param.data_product_path_files + \
                         '/params_'+self.config_param.chain_short_fname+'.dat'
-        write_mcmc_stats(self.config_param,output_summary_fname)
+        if self.config_param.cont_normalize and self.config_param.cont_marginalize:
+            write_mcmc_stats(self.config_param,output_summary_fname,self.burned_in_samples)
+        else:
+            write_mcmc_stats(self.config_param,output_summary_fname)
         print('--> %s' % 'params_'+self.config_param.chain_short_fname+'.dat')
 
 
@@ -298,6 +330,7 @@ def bvp_process(config_fname, redshift, dv):
     output_model.plot_model_comparison(redshift,dv)
     output_model.write_model_summary()
     output_model.write_model_spectrum()
+    output_model.write_convergence_summary()
     output_model.plot_gr_indicator()
     output_model.corner_plot(nbins=30)
 
@@ -338,6 +371,7 @@ def main():
     output_model.plot_model_comparison(args.redshift,args.dv)
     output_model.write_model_summary()
     output_model.write_model_spectrum()
+    output_model.write_convergence_summary()
     output_model.plot_gr_indicator()
     #output_model.corner_plot(nbins=30,truths=args.truths)
     output_model.corner_plot(nbins=30)
@@ -99,7 +99,7 @@ class WriteBayesVPConfig:
         if self.model_selection == '':
             self.model_selection = 'bic'
         
-        self.mcmc_sampler = input('MCMC sampler kombine(default), emcee: ')
+        self.mcmc_sampler = input('MCMC sampler kombine(default), emcee, hmc: ')
         if self.mcmc_sampler == '':
             self.mcmc_sampler = 'kombine'
             
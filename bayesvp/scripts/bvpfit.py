@@ -10,6 +10,7 @@
 
 import sys
 import os
+import functools
 
 from bayesvp.mcmc_setup import bvp_mcmc
 from bayesvp.utilities import MyParser
@@ -21,6 +22,10 @@ def main(config_fname = None):
                         action="store_true")
     parser.add_argument("-pc", "--printconfig",help="print config parameters to screen",
                         action="store_true")
+    parser.add_argument("--lsq",help="fast least-squares fit instead of MCMC",
+                        action="store_true")
+    parser.add_argument("--resume",help="continue an interrupted MCMC run from its last checkpoint",
+                        action="store_true")
     
     if len(sys.argv)==1:
         parser.print_help(sys.stderr)
@@ -28,16 +33,26 @@ def main(config_fname = None):
 
     args = parser.parse_args()
 
+    if args.lsq:
+        if args.resume:
+            sys.exit('--resume only applies to MCMC runs')
+        from bayesvp.lsq_fit import bvp_lsq
+        fit = bvp_lsq
+    elif args.resume:
+        fit = functools.partial(bvp_mcmc,resume=True)
+    else:
+        fit = bvp_mcmc
+
     if args.test:
         from bayesvp.utilities import get_bayesvp_Dir
         path = get_bayesvp_Dir()
         config_fname = path + '/data/example/config_OVI.dat'
         args.printconfig = True
-        bvp_mcmc(config_fname,args.printconfig)
+        fit(config_fname,args.printconfig)
 
     if args.config_fname: 
         if os.path.isfile(args.config_fname):
-            bvp_mcmc(args.config_fname,args.printconfig)
+            fit(args.config_fname,args.printconfig)
         else:
             sys.exit('Config file does not exist:\n %s' % args.config_fname)
 
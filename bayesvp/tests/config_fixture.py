@@ -0,0 +1,75 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from bayesvp.config import DefineParams
+
+###############################################################################
+# Temporary config files of OVI components fitted to the test spectrum
+###############################################################################
+
+def write_test_config(components=('14.5 30 0.0',), mcmc='100 200 4 bic kombine',
+                      regions='1030.0 1033.0', extra_lines=()):
+    """
+    Write a temporary config file with the test spectrum, the default
+    priors and OVI components
+
+    Parameters:
+    ----------
+    components: list of str
+        'logN b z' of each component (% O VI line)
+    mcmc: str
+        Parameters of the mcmc line
+    regions: str
+        Wavelength regions of the spectrum (%% OVI.spec line)
+    extra_lines: list of str
+        Optional lines (e.g. 'continuum 1') added at the end
+
+    Returns:
+    ----------
+    config_fname: str
+        Full path of the config file
+    """
+    fd, config_fname = tempfile.mkstemp(suffix='.dat')
+    with os.fdopen(fd,'w') as f:
+        f.write('spec_path test_path_to_spec\n')
+        f.write('output o6\n')
+        f.write('mcmc %s\n' % mcmc)
+        f.write('%%%% OVI.spec %s\n' % regions)
+        for component in components:
+            f.write('%% O VI %s\n' % component)
+        f.write('logN 10.0 18.0\n')
+        f.write('b    0.0 100.0\n')
+        f.write('z    0.0 100.0\n')
+        for line in extra_lines:
+            f.write(line + '\n')
+    return config_fname
+
+def remove_test_config(config_fname, config_params=None):
+    """
+    Remove the config file and the output directory of its run
+    """
+    os.remove(config_fname)
+    if config_params is not None:
+        shutil.rmtree(config_params.output_path,ignore_errors=True)
+
+
+class ConfigTestCase(unittest.TestCase):
+    """
+    Test case with a temporary config file (config_fname) and its
+    parameters object (config_params); subclasses change the
+    arguments of write_test_config with the class attributes
+    """
+    components = ('14.5 30 0.0',)
+    mcmc = '100 200 4 bic kombine'
+    regions = '1030.0 1033.0'
+    extra_lines = ()
+
+    def setUp(self):
+        self.config_fname = write_test_config(self.components,self.mcmc,
+                                              self.regions,self.extra_lines)
+        self.config_params = DefineParams(self.config_fname)
+
+    def tearDown(self):
+        remove_test_config(self.config_fname,self.config_params)
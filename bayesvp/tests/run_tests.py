@@ -1,14 +1,37 @@
 import unittest
 
 from bayesvp.tests import test_config
+from bayesvp.tests import test_diagnostics
 from bayesvp.tests import test_likelihood
 from bayesvp.tests import test_model
+from bayesvp.tests import test_voigt
 
 suites = []
 
 suites.append(unittest.TestLoader().loadTestsFromTestCase(test_config.TCConfigFile))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_config.TCFitPlan))
 suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCPosterior))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCVectorizedPosterior))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCPixelMask))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCContinuumMarginalization))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCFloat32Posterior))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCFusedLikelihood))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCPosteriorGradient))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCHMCSampler))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCMAPInit))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCLSQFit))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCCheckpoint))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_likelihood.TCAutoParallel))
 suites.append(unittest.TestLoader().loadTestsFromTestCase(test_model.TCSingleVP))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_model.TCWindowedVP))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_model.TCOversampledVP))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_model.TCLSFKernel))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_model.TCLSFOperator))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_model.TCCOSLSFCache))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_model.TCPolyContinuum))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_voigt.TCVoigtBackends))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_voigt.TCVoigtTable))
+suites.append(unittest.TestLoader().loadTestsFromTestCase(test_diagnostics.TCDiagnostics))
 
 
 # Run tests
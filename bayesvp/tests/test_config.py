@@ -5,6 +5,7 @@ import numpy as np
 
 from bayesvp.config import DefineParams
 from bayesvp.utilities import get_bayesvp_Dir
+from bayesvp.tests.config_fixture import ConfigTestCase
 
 """
 TEST CASE 1: OVI line with stock config file and spectrum
@@ -107,5 +108,64 @@ class TCConfigFile(unittest.TestCase):
         self.assertEqual(self.config_params.vp_params[0][2],'0.000000')
 
 
+class TCFitPlan(ConfigTestCase):
+    """
+    Two components of OVI over two wavelength regions; the b of the 
+    second component is fixed and the redshifts are tied.
+    """
+    components = ('14.5 30 0.0a','13.8 15B 0.0a')
+    regions = '1030.0 1033.0 1036.5 1039.0'
+
+    def setUp(self):
+        ConfigTestCase.setUp(self)
+        self.plan = self.config_params.fit_plan
+
+    def test_param_index(self):
+        self.assertEqual(self.config_params.n_params,4)
+        np.testing.assert_array_equal(self.plan.param_index,[[0,1,3],[2,-1,3]])
+        self.assertAlmostEqual(self.plan.fixed_values[1][1],15.0)
+
+    def test_component_params(self):
+        alpha = np.array([14.0,20.0,13.0,1e-4])
+        params = self.plan.component_params(alpha)
+        np.testing.assert_allclose(params,[[14.0,20.0,1e-4],[13.0,15.0,1e-4]])
+
+        # Many walkers at once
+        walkers = np.array([alpha,alpha+1])
+        params = self.plan.component_params(walkers)
+        self.assertEqual(np.shape(params),(2,2,3))
+        self.assertAlmostEqual(params[1][1][1],15.0)
+
+    def test_lines_and_regions(self):
+        # Each component has one OVI transition in each region
+        self.assertEqual(self.plan.n_lines,4)
+        np.testing.assert_array_equal(self.plan.line_component,[0,0,1,1])
+
+        wave = self.config_params.wave
+        n_pixels = 0
+        for k, region in enumerate(self.plan.region_slices):
+            self.assertTrue(np.all(wave[region] >= self.config_params.wave_begins[k]))
+            self.assertTrue(np.all(wave[region] <= self.config_params.wave_ends[k]))
+            n_pixels += len(wave[region])
+        self.assertEqual(n_pixels,len(wave))
+
+    def test_immutable(self):
+        with self.assertRaises(ValueError):
+            self.plan.fixed_values[0][0] = 1.0
+
+    def test_voigt_window(self):
+        # n_lorentz is required: Lorentz widths are much smaller than Doppler widths
+        with open(self.config_fname) as f:
+            config_lines = f.read()
+        for window, expected in (('5',None),('5 20000',(5.0,20000.0))):
+            with open(self.config_fname,'w') as f:
+                f.write(config_lines + 'voigt_window %s\n' % window)
+            if expected is None:
+                with self.assertRaises(SystemExit):
+                    DefineParams(self.config_fname)
+            else:
+                self.assertEqual(DefineParams(self.config_fname).voigt_window,expected)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import numpy as np
+
+from bayesvp.diagnostics import rhat, ess_bulk, ess_tail, split_chains,\
+                                split_rhat_streaming, compute_burnin_rhat, _rhat
+from bayesvp.utilities import gr_indicator
+
+###############################################################################
+# TEST CASE 1: Diagnostics of AR(1) chains with known autocorrelation
+###############################################################################
+
+class TCDiagnostics(unittest.TestCase):
+
+    def setUp(self):
+        # AR(1) chains with tau = (1+phi)/(1-phi)
+        random_state = np.random.RandomState(0)
+        self.phi = np.array([0.0,0.5,0.9])
+        self.chain = np.zeros((4000,8,3))
+        for t in range(1,len(self.chain)):
+            self.chain[t] = self.phi*self.chain[t-1] + random_state.randn(8,3)
+
+    def test_converged(self):
+        np.testing.assert_array_less(rhat(self.chain),1.01)
+        tau = (1+self.phi)/(1-self.phi)
+        np.testing.assert_allclose(ess_bulk(self.chain),4000*8/tau,rtol=0.15)
+        self.assertTrue(np.all(ess_tail(self.chain) > 0.1*4000*8/tau))
+
+    def test_not_converged(self):
+        # Drift within every walker
+        drift = self.chain + np.linspace(0,3,4000)[:,np.newaxis,np.newaxis]
+        self.assertTrue(np.all(rhat(drift) > 1.01))
+
+        # One walker with a different mean
+        offset = self.chain.copy(); offset[:,0] += 1.0
+        self.assertTrue(np.all(rhat(offset) > 1.01))
+
+        # Different scale in one walker is found by the folded R-hat
+        scale = self.chain.copy(); scale[:,:4,0] *= 3
+        self.assertTrue(rhat(scale)[0] > 1.01)
+
+    def test_streaming(self):
+        np.testing.assert_allclose(split_rhat_streaming(self.chain,block_size=333),
+                                   _rhat(split_chains(self.chain)),rtol=1e-10)
+
+    def test_burnin(self):
+        transient = self.chain.copy()
+        transient[:600] += np.linspace(10,0,600)[:,np.newaxis,np.newaxis]
+        burnin = compute_burnin_rhat(transient)
+        self.assertTrue(200 < burnin <= 2000)
+        self.assertEqual(compute_burnin_rhat(self.chain),0)
+
+    def test_gr_indicator(self):
+        # Same values as the loop over parameters
+        chain = self.chain + np.arange(8)[:,np.newaxis]*0.01
+        nsteps,nwalkers = map(float,chain.shape[:2])
+        for n in range(3):
+            x = chain[:,:,n]
+            W = np.mean(np.var(x,axis=0))
+            B = nsteps*np.sum((np.mean(x,axis=0) - np.mean(x))**2) / (nwalkers-1)
+            R = ((nwalkers+1)/nwalkers)*(1 - 1./nsteps + B/(W*nsteps)) - (nsteps-1)/(nwalkers*nsteps)
+            self.assertAlmostEqual(gr_indicator(chain)[n],R,places=12)
+
+
+if __name__ == '__main__':
+    unittest.main()
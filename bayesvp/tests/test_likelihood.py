@@ -5,7 +5,10 @@ import numpy as np
 
 from bayesvp.config import DefineParams
 from bayesvp.likelihood import Posterior
+from bayesvp.fused import numba_available
 from bayesvp.utilities import get_bayesvp_Dir
+from bayesvp.tests.config_fixture import ConfigTestCase, write_test_config,\
+                                         remove_test_config
 
 ###############################################################################
 # TEST CASE 1: OVI line with stock config file and spectrum
@@ -72,5 +75,708 @@ class TCPosterior(unittest.TestCase):
 
 
 
+###############################################################################
+# TEST CASE 2: Two components with continuum over two wavelength regions
+###############################################################################
+
+class TCVectorizedPosterior(ConfigTestCase):
+    components = ('14.5 30 0.0','13.8 15 0.0001')
+    mcmc = '100 200 4 bic emcee vectorize'
+    regions = '1030.0 1033.0 1036.5 1039.0'
+    extra_lines = ('continuum 1','cont_prior 1.0')
+
+    def setUp(self):
+        ConfigTestCase.setUp(self)
+        self.posterior = Posterior(self.config_params)
+
+        np.random.seed(1)
+        alpha = np.array([14.5,30,0.0,13.8,15,0.0001,0.01,0.02])
+        scale = np.array([0.2,5,1e-5,0.2,5,1e-5,0.01,0.01])
+        self.walkers = alpha + scale*np.random.randn(50,len(alpha))
+        # Outside of priors (b, z ordering)
+        self.walkers[3,1] = -10
+        self.walkers[7,2] = self.walkers[7,5] + 1e-5
+
+    def test_vectorize_flag(self):
+        self.assertTrue(self.config_params.vectorize)
+
+    def test_lnprior_batch(self):
+        single = np.array([self.posterior.lnprior(walker) for walker in self.walkers])
+        batch = self.posterior.lnprior(self.walkers)
+        np.testing.assert_array_equal(batch,single)
+        self.assertTrue(np.isinf(batch[3]) and np.isinf(batch[7]))
+
+    def test_call_batch(self):
+        single = np.array([self.posterior(walker) for walker in self.walkers])
+        batch = self.posterior(self.walkers)
+        self.assertEqual(np.shape(batch),(len(self.walkers),))
+        np.testing.assert_allclose(batch,single,rtol=1e-12)
+
+
+class TCPixelMask(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        # Copy of the example spectrum with a zero error pixel
+        self.spec_dir = tempfile.mkdtemp()
+        wave,flux,dflux = np.loadtxt(get_bayesvp_Dir() + '/data/example/OVI.spec',unpack=True)
+        self.zero_wave = wave[(wave >= 1030.0)][10]
+        dflux[wave == self.zero_wave] = 0
+        np.savetxt(self.spec_dir + '/OVI.spec',np.c_[wave,flux,dflux])
+
+        self.config_fname = self.spec_dir + '/config.dat'
+        with open(self.config_fname,'w') as f:
+            f.write('spec_path %s\n' % self.spec_dir)
+            f.write('output o6\n')
+            f.write('mcmc 100 200 4 bic emcee\n')
+            f.write('%% OVI.spec 1030.0 1033.0 1036.5 1039.0\n')
+            f.write('% O VI 14.5 30 0.0\n')
+            f.write('logN 10.0 18.0\n')
+            f.write('b    0.0 100.0\n')
+            f.write('z    0.0 100.0\n')
+            f.write('mask 1037.0 1037.5\n')
+            f.write('mask 1038.0 1038.2\n')
+        self.config_params = DefineParams(self.config_fname)
+        self.posterior = Posterior(self.config_params)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.spec_dir)
+
+    def test_good_pixels(self):
+        wave = self.config_params.wave
+        np.testing.assert_array_equal(self.config_params.mask_ranges,
+                                      [[1037.0,1037.5],[1038.0,1038.2]])
+        masked = (((wave >= 1037.0) & (wave <= 1037.5)) |
+                  ((wave >= 1038.0) & (wave <= 1038.2)) | (wave == self.zero_wave))
+        np.testing.assert_array_equal(self.config_params.good_pixels,~masked)
+
+    def test_lnlike(self):
+        from bayesvp.vp_model import continuum_model_flux
+        alpha = np.array([14.5,30,0.0])
+        good = self.config_params.good_pixels
+        flux = self.config_params.flux[good]; dflux = self.config_params.dflux[good]
+        model_flux = continuum_model_flux(alpha,self.config_params)[good]
+        correct = np.sum(0.5*np.log(2*np.pi*dflux**2) - 0.5*(flux-model_flux)**2/dflux**2)
+
+        self.assertTrue(np.isfinite(self.posterior.lnlike(alpha)))
+        self.assertAlmostEqual(self.posterior.lnlike(alpha),correct,places=8)
+        batch = self.posterior.lnlike(np.array([alpha,alpha]))
+        np.testing.assert_allclose(batch,correct,rtol=1e-12)
+        lnprob, grad = self.posterior.lnprob_and_grad(alpha)
+        self.assertAlmostEqual(lnprob,correct,places=8)
+
+
+class TCContinuumMarginalization(unittest.TestCase):
+
+    def setUp(self):
+        self.config_fnames = {}
+        for mode in ('sampled','marginalize'):
+            continuum = 'continuum 1 marginalize' if mode == 'marginalize' else 'continuum 1'
+            self.config_fnames[mode] = write_test_config(
+                ('14.5 30 0.0','13.8 15 0.0001'),'100 200 4 bic emcee',
+                '1030.0 1033.0 1036.5 1039.0',
+                ('LSF 1395 1395',continuum,'cont_prior 0.5 1.0'))
+        self.config_params = {mode: DefineParams(self.config_fnames[mode])
+                              for mode in self.config_fnames}
+        self.posterior = Posterior(self.config_params['marginalize'])
+        self.alpha = np.array([14.3,22.4,-2.3e-5,14.2,21.5,4.3e-5])
+
+    def tearDown(self):
+        for mode in self.config_fnames:
+            remove_test_config(self.config_fnames[mode],self.config_params[mode])
+
+    def test_n_params(self):
+        self.assertTrue(self.config_params['marginalize'].cont_marginalize)
+        self.assertEqual(self.config_params['marginalize'].n_params,6)
+        self.assertEqual(self.config_params['sampled'].n_params,8)
+        self.assertEqual(len(self.posterior.prior_lower),6)
+
+    def test_numerical_integral(self):
+        from scipy import integrate
+        from bayesvp.vp_model import generic_prediction
+
+        # Integrate the sampled-continuum likelihood times the Gaussian priors
+        sampled = Posterior(self.config_params['sampled'])
+        sigma = np.array([0.5,1.0]) # a0, a1 as written on the cont_prior line
+        ln_likelihood = self.posterior.lnlike(self.alpha)
+        def integrand(a1,a0):
+            ln_prior = -0.5*np.sum((np.array([a0,a1])/sigma)**2) - np.log(2*np.pi*np.prod(sigma))
+            return np.exp(sampled.lnlike(np.r_[self.alpha,a0,a1]) + ln_prior - ln_likelihood)
+
+        model_flux = generic_prediction(self.alpha,self.config_params['marginalize'])
+        _, mean, precision = self.posterior._marginalize_continuum(model_flux)
+        width = 8*np.sqrt(np.diag(np.linalg.inv(precision)))
+        integral,_ = integrate.dblquad(integrand,mean[0]-width[0],mean[0]+width[0],
+                                       mean[1]-width[1],mean[1]+width[1])
+        self.assertAlmostEqual(np.log(integral),0.0,places=6)
+
+    def test_gradient_and_batch(self):
+        lnprob, grad = self.posterior.lnprob_and_grad(self.alpha)
+        self.assertAlmostEqual(lnprob,self.posterior(self.alpha),places=8)
+        steps = np.array([1e-5,1e-4,1e-9,1e-5,1e-4,1e-9])
+        for i in range(len(self.alpha)):
+            delta = np.zeros(len(self.alpha)); delta[i] = steps[i]
+            numerical = (self.posterior(self.alpha+delta) - 
+                         self.posterior(self.alpha-delta)) / (2*steps[i])
+            self.assertTrue(abs(grad[i]-numerical) < 1e-5*max(abs(numerical),1),
+                            (i,grad[i],numerical))
+
+        walkers = np.array([self.alpha,self.alpha+[0.1,1,0,0.1,1,0]])
+        batch = self.posterior(walkers)
+        np.testing.assert_allclose(batch,[self.posterior(w) for w in walkers],rtol=1e-12)
+
+    def test_sample_continuum(self):
+        from bayesvp.vp_model import generic_prediction
+        np.random.seed(0)
+        draws = self.posterior.sample_continuum(np.tile(self.alpha,(20000,1)))
+        model_flux = generic_prediction(self.alpha,self.config_params['marginalize'])
+        _, mean, precision = self.posterior._marginalize_continuum(model_flux)
+        sigma = np.sqrt(np.diag(np.linalg.inv(precision)))
+        np.testing.assert_allclose(np.mean(draws,axis=0),mean,atol=0.05*np.max(sigma))
+        np.testing.assert_allclose(np.std(draws,axis=0),sigma,rtol=0.05)
+
+
+class TCFloat32Posterior(unittest.TestCase):
+
+    def setUp(self):
+        self.config_fnames = {}
+        for precision in ('float64','float32'):
+            self.config_fnames[precision] = write_test_config(
+                ('14.5 30 0.0','13.8 15 0.0001'),'100 200 4 bic emcee',
+                '1030.0 1033.0 1036.5 1039.0',
+                ('LSF 1395 1395','continuum 1','cont_prior 1.0','precision %s' % precision))
+        self.config_params = {precision: DefineParams(self.config_fnames[precision])
+                              for precision in self.config_fnames}
+
+        np.random.seed(1)
+        alpha = np.array([14.5,30,0.0,13.8,15,0.0001,0.01,0.02])
+        scale = np.array([0.2,5,1e-5,0.2,5,1e-5,0.01,0.01])
+        self.walkers = alpha + scale*np.random.randn(20,len(alpha))
+
+    def tearDown(self):
+        for precision in self.config_fnames:
+            remove_test_config(self.config_fnames[precision],self.config_params[precision])
+
+    def test_float32_model(self):
+        from bayesvp.vp_model import continuum_model_flux
+
+        config32 = self.config_params['float32']
+        self.assertEqual(config32.flux.dtype,np.float32)
+        self.assertEqual(config32.nu_grid.nu_offset.dtype,np.float32)
+        self.assertTrue(self.config_params['float64'].nu_grid is None)
+
+        flux32 = continuum_model_flux(self.walkers,config32)
+        flux64 = continuum_model_flux(self.walkers,self.config_params['float64'])
+        self.assertEqual(flux32.dtype,np.float32)
+        np.testing.assert_allclose(flux32,flux64,atol=1e-5)
+
+        # Likelihood is summed in float64; differences between walkers agree
+        lnlike32 = Posterior(config32).lnlike(self.walkers)
+        lnlike64 = Posterior(self.config_params['float64']).lnlike(self.walkers)
+        self.assertEqual(lnlike32.dtype,np.float64)
+        np.testing.assert_allclose(lnlike32-lnlike32[0],lnlike64-lnlike64[0],atol=0.05)
+
+    def test_precision_report(self):
+        from bayesvp.likelihood import precision_report
+
+        report = precision_report(self.config_fnames['float64'],n_walkers=10,n_repeat=1)
+        for key in ('time_float64','time_float32','speedup',
+                    'max_flux_error','max_dlnlike_error'):
+            self.assertTrue(np.isfinite(report[key]))
+        self.assertTrue(report['max_flux_error'] < 1e-4)
+
+
+class TCFusedLikelihood(ConfigTestCase):
+    components = ('14.5 30 0.0','13.8 15b 0.0001','13.5 15b 0.0002')
+    mcmc = '100 200 4 bic emcee numba'
+    regions = '1030.0 1033.0 1036.5 1039.0'
+    extra_lines = ('LSF 1395 1395','continuum 1','cont_prior 1.0','voigt_backend humlicek')
+
+    def setUp(self):
+        ConfigTestCase.setUp(self)
+
+        np.random.seed(2)
+        alpha = np.array([14.5,30,0.0,13.8,15,0.0001,13.5,0.0002,0.01,0.02])
+        scale = np.array([0.2,5,1e-5,0.2,5,1e-5,0.2,1e-5,0.01,0.01])
+        self.walkers = alpha + scale*np.random.randn(20,len(alpha))
+
+    def test_numba_flag(self):
+        self.assertTrue(self.config_params.jit)
+
+    @unittest.skipUnless(numba_available,'numba is not installed')
+    def test_fused_matches_numpy(self):
+        posterior = Posterior(self.config_params)
+        self.assertTrue(posterior.fused_lnlike is not None)
+        fused = posterior.lnlike(self.walkers)
+
+        # NumPy model with the same Voigt approximation
+        self.config_params.jit = False
+        numpy_posterior = Posterior(self.config_params)
+        self.assertTrue(numpy_posterior.fused_lnlike is None)
+        np.testing.assert_allclose(fused,numpy_posterior.lnlike(self.walkers),rtol=1e-10)
+        self.assertAlmostEqual(posterior.lnlike(self.walkers[3]),fused[3],places=8)
+        np.testing.assert_allclose(posterior(self.walkers),numpy_posterior(self.walkers),rtol=1e-10)
+
+    def test_unsupported_options(self):
+        self.config_params.voigt_window = (10,10)
+        self.assertTrue(Posterior(self.config_params).fused_lnlike is None)
+
+    @unittest.skipUnless(numba_available,'numba is not installed')
+    def test_exact_voigt_not_replaced(self):
+        # The exact default is kept unless the Humlicek error is accepted
+        self.config_params.voigt_backend = None
+        self.assertTrue(Posterior(self.config_params).fused_lnlike is None)
+        self.config_params.voigt_tol = 1e-6
+        self.assertTrue(Posterior(self.config_params).fused_lnlike is None)
+        self.config_params.voigt_tol = 1e-4
+        self.assertTrue(Posterior(self.config_params).fused_lnlike is not None)
+        self.config_params.voigt_backend = 'wofz'
+        self.assertTrue(Posterior(self.config_params).fused_lnlike is None)
+
+    @unittest.skipUnless(numba_available,'numba is not installed')
+    def test_fused_report(self):
+        from bayesvp.likelihood import fused_report
+        report = fused_report(self.config_fname,n_walkers=20,n_repeat=1)
+        self.assertTrue(report['time_fused'] > 0)
+        self.assertAlmostEqual(report['speedup_wofz'],
+                               report['time_numpy_wofz']/report['time_fused'])
+        self.assertTrue(report['max_dlnlike_error'] < 1e-6)
+
+
+class TCPosteriorGradient(ConfigTestCase):
+    components = ('14.5 30 0.0','13.8 15b 0.0001','13.5 15b 0.0002A')
+    mcmc = '100 200 4 bic emcee'
+    regions = '1030.0 1033.0 1036.5 1039.0'
+    extra_lines = ('LSF 1395 1395','continuum 2','cont_prior 1.0')
+
+    def setUp(self):
+        ConfigTestCase.setUp(self)
+        self.posterior = Posterior(self.config_params)
+        # logN1, b1, z1, logN2, z2, logN3, b2 = b3 (tied), continuum
+        self.alpha = np.array([14.5,30,0.0,13.8,0.0001,13.5,15,0.01,0.02,0.001])
+
+    def test_finite_differences(self):
+        lnprob, grad = self.posterior.lnprob_and_grad(self.alpha)
+        self.assertAlmostEqual(lnprob,self.posterior(self.alpha),places=8)
+        self.assertEqual(np.shape(grad),np.shape(self.alpha))
+
+        steps = np.array([1e-5,1e-4,1e-9,1e-5,1e-9,1e-5,1e-4,1e-6,1e-6,1e-7])
+        for i in range(len(self.alpha)):
+            delta = np.zeros(len(self.alpha)); delta[i] = steps[i]
+            numerical = (self.posterior(self.alpha+delta) - 
+                         self.posterior(self.alpha-delta)) / (2*steps[i])
+            self.assertTrue(abs(grad[i]-numerical) < 1e-5*max(abs(numerical),1),
+                            (i,grad[i],numerical))
+
+    def test_prior_bounds(self):
+        # Bounds follow the parameter types with tied parameters
+        z_range = self.config_params.priors[2]
+        np.testing.assert_allclose(self.posterior.prior_lower,
+                                   [10,0,z_range[0],10,z_range[0],10,0,-1,-1,-1])
+        np.testing.assert_allclose(self.posterior.prior_upper,
+                                   [18,100,z_range[1],18,z_range[1],18,100,1,1,1])
+        np.testing.assert_array_equal(self.posterior.z_indices,[2,4])
+
+        swapped = self.alpha.copy(); swapped[4] = -0.0001
+        self.assertEqual(self.posterior.lnprior(swapped),-np.inf)
+        batch = self.posterior.lnprior(np.array([self.alpha,swapped]))
+        np.testing.assert_array_equal(batch,[0,-np.inf])
+
+    def test_batch_and_prior(self):
+        walkers = np.array([self.alpha,self.alpha,self.alpha])
+        walkers[1,0] += 0.1
+        walkers[2,1] = -5 # outside of the b prior
+        lnprob, grad = self.posterior.lnprob_and_grad(walkers)
+        single_lnprob, single_grad = self.posterior.lnprob_and_grad(walkers[1])
+        self.assertAlmostEqual(lnprob[1],single_lnprob,places=8)
+        np.testing.assert_allclose(grad[1],single_grad,rtol=1e-10)
+        self.assertEqual(lnprob[2],-np.inf)
+        self.assertTrue(np.all(grad[2] == 0))
+
+    def test_unsupported_options(self):
+        # No gradient of a different model than the one of __call__
+        for name, value in (('oversample',(8,3.0)),('voigt_window',(50,50)),
+                            ('voigt_tol',1e-4),('voigt_backend','humlicek')):
+            setattr(self.config_params,name,value)
+            self.assertRaises(ValueError,self.posterior.lnprob_and_grad,self.alpha)
+            setattr(self.config_params,name,None)
+        self.config_params.voigt_backend = 'wofz'
+        lnprob, _ = self.posterior.lnprob_and_grad(self.alpha)
+        self.assertAlmostEqual(lnprob,self.posterior(self.alpha),places=8)
+
+
+###############################################################################
+# TEST CASE 3: Hamiltonian Monte Carlo sampler
+###############################################################################
+
+class TCHMCSampler(ConfigTestCase):
+    mcmc = '8 30 1 bic hmc'
+    extra_lines = ('LSF 1395',)
+
+    def test_gaussian_moments(self):
+        from bayesvp.hmc import HMCSampler
+        scale = np.array([1e-4,1.0,30.0])
+        def lnprob_and_grad(x):
+            lnprob = -0.5*np.sum((x/scale)**2,axis=1)
+            return lnprob, -x/scale**2
+
+        sampler = HMCSampler(10,3,lnprob_and_grad,seed=1)
+        p0 = np.random.RandomState(0).uniform(-1,1,(10,3))*scale
+        sampler.run_mcmc(p0,500)
+        self.assertEqual(sampler.chain.shape,(500,10,3))
+        samples = sampler.chain.reshape(-1,3)/scale
+        np.testing.assert_allclose(np.std(samples,axis=0),1.0,atol=0.1)
+        np.testing.assert_allclose(np.mean(samples,axis=0),0.0,atol=0.1)
+
+    def test_mcmc_single(self):
+        from bayesvp.mcmc_setup import bvp_mcmc_single
+        self.assertEqual(self.config_params.mcmc_sampler,'hmc')
+        np.random.seed(0)
+        bvp_mcmc_single(self.config_params)
+
+        chain = np.load(self.config_params.chain_fname + '.npy')
+        self.assertEqual(chain.shape,(30,8,3))
+        lnprob = Posterior(self.config_params)(chain.reshape(-1,3))
+        self.assertTrue(np.all(np.isfinite(lnprob)))
+
+    def test_sampled_posterior(self):
+        from bayesvp.mcmc_setup import bvp_mcmc_single
+        # HMC samples the posterior of __call__ 
+        posterior = Posterior(self.config_params)
+        alpha = np.array([14.5,30,0.0])
+        self.assertAlmostEqual(posterior.lnprob_and_grad(alpha)[0],posterior(alpha),places=8)
+
+        # Oversampling changes the model of a narrow line; no gradient of it
+        alpha = np.array([14.5,2,0.0])
+        lnprob = posterior(alpha)
+        self.config_params.oversample = (8,3.0)
+        self.assertTrue(abs(posterior(alpha) - lnprob) > 1)
+        self.assertRaises(ValueError,posterior.lnprob_and_grad,alpha)
+        self.assertRaises(SystemExit,bvp_mcmc_single,self.config_params)
+
+
+class TCMAPInit(ConfigTestCase):
+    components = ('14.5 30 0.0','13.8 15 0.0001')
+    mcmc = '20 30 1 bic emcee map'
+    regions = '1030.0 1033.0 1036.5 1039.0'
+    extra_lines = ('LSF 1395 1395','continuum 1','cont_prior 1.0')
+
+    def setUp(self):
+        ConfigTestCase.setUp(self)
+        self.posterior = Posterior(self.config_params)
+
+    def test_map_ball(self):
+        from bayesvp.mcmc_setup import _create_walkers_init, _create_walkers_map
+        self.assertEqual(self.config_params.walker_init,'map')
+        np.random.seed(0)
+        p0 = _create_walkers_map(self.config_params,self.posterior)
+        self.assertEqual(p0.shape,(20,8))
+
+        lnprob = self.posterior(p0)
+        self.assertTrue(np.all(np.isfinite(lnprob)))
+        # All walkers start close to the maximum; far above uniform draws
+        self.assertTrue(np.max(lnprob) - np.min(lnprob) < 10)
+        uniform_lnprob = self.posterior(_create_walkers_init(self.config_params))
+        self.assertTrue(np.min(lnprob) > np.max(uniform_lnprob))
+
+    def test_map_without_gradient(self):
+        from bayesvp.mcmc_setup import _create_walkers_init, _create_walkers_map
+        # The MAP of the oversampled model; its gradient is not available
+        self.config_params.oversample = (8,3.0)
+        self.assertRaises(ValueError,self.posterior.lnprob_and_grad,self.posterior.prior_lower)
+        np.random.seed(0)
+        p0 = _create_walkers_map(self.config_params,self.posterior)
+
+        lnprob = self.posterior(p0)
+        self.assertTrue(np.all(np.isfinite(lnprob)))
+        self.assertTrue(np.max(lnprob) - np.min(lnprob) < 10)
+        uniform_lnprob = self.posterior(_create_walkers_init(self.config_params))
+        self.assertTrue(np.min(lnprob) > np.max(uniform_lnprob))
+
+    def test_uniform_fallback(self):
+        from bayesvp import mcmc_setup
+        def failed_optimize(args):
+            return args[-1], -np.inf
+        original = mcmc_setup._map_optimize
+        mcmc_setup._map_optimize = failed_optimize
+        try:
+            np.random.seed(0)
+            p0 = mcmc_setup._create_walkers_map(self.config_params,self.posterior)
+        finally:
+            mcmc_setup._map_optimize = original
+        np.random.seed(0)
+        np.testing.assert_array_equal(p0,mcmc_setup._create_walkers_init(self.config_params))
+
+
+class TCLSQFit(ConfigTestCase):
+    mcmc = '20 30 1 bic emcee'
+    extra_lines = ('LSF 1395','continuum 1','cont_prior 1.0')
+
+    def test_fit_and_products(self):
+        from bayesvp.lsq_fit import bvp_lsq_single
+        np.random.seed(0)
+        lsq = bvp_lsq_single(self.config_params)
+        self.assertTrue(lsq.success)
+
+        # Best fit is a minimum of chi-square with a positive definite covariance
+        chi2 = np.sum(lsq.residuals(lsq.best_fit_params)**2)
+        self.assertAlmostEqual(lsq.chi2,chi2,places=6)
+        for i in range(len(lsq.best_fit_params)):
+            delta = np.zeros(len(lsq.best_fit_params)); delta[i] = lsq.param_errors[i]
+            shifted = np.clip(lsq.best_fit_params + delta,None,np.array([18,100,1,1,1]))
+            self.assertTrue(np.sum(lsq.residuals(shifted)**2) >= chi2)
+        self.assertTrue(np.all(np.linalg.eigvalsh(lsq.covariance) > 0))
+
+        prefix = self.config_params.data_product_path_files
+        params = np.loadtxt(prefix + '/params_' + self.config_params.chain_short_fname + '.dat',
+                            skiprows=1)
+        np.testing.assert_allclose(params[:,0],lsq.best_fit_params,atol=1e-6)
+        spec = np.loadtxt(prefix + '/spec_' + self.config_params.chain_short_fname + '.dat')
+        self.assertEqual(spec.shape,(len(self.config_params.wave),4))
+
+    def test_numerical_jacobian(self):
+        from bayesvp.lsq_fit import LSQFit
+        np.random.seed(0)
+        lsq = LSQFit(self.config_params)
+        lsq.fit()
+        jacobian = lsq.residuals_jacobian(lsq.best_fit_params)
+
+        # The Jacobian of the oversampled model is from its own residuals; 
+        # oversampling hardly changes a b = 30 km/s line
+        self.config_params.oversample = (8,3.0)
+        np.random.seed(0)
+        oversampled = LSQFit(self.config_params)
+        self.assertFalse(oversampled.exact_jacobian)
+        oversampled.fit()
+        self.assertTrue(oversampled.success)
+        np.testing.assert_allclose(oversampled.residuals_jacobian(lsq.best_fit_params),jacobian,
+                                   atol=1e-3*np.max(np.abs(jacobian)))
+        np.testing.assert_allclose(oversampled.best_fit_params,lsq.best_fit_params,
+                                   atol=1e-2*np.max(lsq.param_errors))
+        np.testing.assert_allclose(oversampled.param_errors,lsq.param_errors,rtol=1e-2)
+
+
+class TCCheckpoint(ConfigTestCase):
+    mcmc = '8 40 1 bic emcee'
+    extra_lines = ('LSF 1395','checkpoint 10','seed 3')
+
+    def test_chain_writer(self):
+        from bayesvp.checkpoint import ChainWriter
+        fname = self.config_params.chain_fname + '_test.npy'
+        samples = np.random.randn(5,4,3)
+        writer = ChainWriter(fname,4,3)
+        writer.append(samples[:2]); writer.append(samples[2:])
+        writer.close()
+        np.testing.assert_array_equal(np.load(fname),samples)
+
+        # Steps after the last checkpoint are discarded
+        writer = ChainWriter(fname,4,3,n_steps=3)
+        writer.append(samples[3:4])
+        writer.close()
+        chain = np.load(fname,mmap_mode='r')
+        self.assertEqual(chain.shape,(4,4,3))
+        np.testing.assert_array_equal(chain,samples[:4])
+
+    def _resumed_chain(self):
+        from bayesvp import checkpoint
+        from bayesvp.mcmc_setup import bvp_mcmc_single
+        self.assertEqual((self.config_params.checkpoint_steps,self.config_params.seed),(10,3))
+        bvp_mcmc_single(self.config_params)
+        uninterrupted = np.load(self.config_params.chain_fname + '.npy')
+
+        # Kill the run while the second checkpoint is saved; the 
+        # chain file then has 10 steps more than the saved state
+        save_checkpoint = checkpoint.save_checkpoint
+        calls = []
+        def interrupted_save(fname,state):
+            calls.append(state['n_steps'])
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            save_checkpoint(fname,state)
+        checkpoint.save_checkpoint = interrupted_save
+        try:
+            self.assertRaises(KeyboardInterrupt,bvp_mcmc_single,self.config_params)
+        finally:
+            checkpoint.save_checkpoint = save_checkpoint
+        chain = np.load(self.config_params.chain_fname + '.npy')
+        self.assertEqual(len(chain),calls[-1])
+
+        bvp_mcmc_single(self.config_params,resume=True)
+        resumed = np.load(self.config_params.chain_fname + '.npy')
+        return uninterrupted, resumed
+
+    def test_resume_emcee(self):
+        uninterrupted, resumed = self._resumed_chain()
+        self.assertEqual(uninterrupted.shape,(40,8,3))
+        np.testing.assert_array_equal(resumed,uninterrupted)
+
+    def test_resume_hmc(self):
+        self.config_params.mcmc_sampler = 'hmc'
+        uninterrupted, resumed = self._resumed_chain()
+        self.assertEqual(uninterrupted.shape,(40,8,3))
+        np.testing.assert_array_equal(resumed,uninterrupted)
+
+    def test_resume_kombine(self):
+        self.config_params.mcmc_sampler = 'kombine'
+        try:
+            uninterrupted, resumed = self._resumed_chain()
+        except ValueError as error:
+            # The burn-in of kombine 0.8 fails with the chi-square test of newer scipy 
+            if 'observed frequencies' not in str(error):
+                raise
+            self.skipTest('kombine burn-in does not run with this scipy')
+        self.assertEqual(uninterrupted.shape,(40,8,3))
+        np.testing.assert_array_equal(resumed,uninterrupted)
+
+    def test_kombine_state(self):
+        # Checkpoint after 20 of 40 steps of a kombine run without burn-in
+        import kombine
+        from bayesvp.checkpoint import ChainWriter, save_checkpoint
+        from bayesvp.mcmc_setup import bvp_mcmc_single, _create_walkers_init, _kombine_state
+        self.config_params.mcmc_sampler = 'kombine'
+        np.random.seed(1)
+        p0 = _create_walkers_init(self.config_params)
+        sampler = kombine.Sampler(8,3,Posterior(self.config_params),processes=1)
+        sampler.update_proposal(p0,max_samples=8)
+        result = sampler.run_mcmc(20,p0)
+        writer = ChainWriter(self.config_params.chain_fname + '.npy',8,3)
+        writer.append(sampler.chain)
+        writer.close()
+        state = {'sampler': 'kombine', 'n_steps': 20, 'position': result[0],
+                 'random_state': np.random.get_state()}
+        state.update(_kombine_state(sampler))
+
+        # Resumed runs continue the proposal and random state (no burn-in)
+        chains = []
+        for k in range(2):
+            save_checkpoint(self.config_params.chain_fname + '_state.pkl',state)
+            bvp_mcmc_single(self.config_params,resume=True)
+            chains.append(np.load(self.config_params.chain_fname + '.npy'))
+        self.assertEqual(chains[0].shape,(40,8,3))
+        np.testing.assert_array_equal(chains[0][:20],sampler.chain)
+        np.testing.assert_array_equal(chains[0],chains[1])
+
+        # A complete run is not sampled again
+        bvp_mcmc_single(self.config_params,resume=True)
+        np.testing.assert_array_equal(np.load(self.config_params.chain_fname + '.npy'),chains[1])
+
+        # Private attributes of other kombine versions are not used
+        version = kombine.__version__
+        kombine.__version__ = '0.9.0'
+        try:
+            self.assertRaises(SystemExit,_kombine_state,sampler)
+        finally:
+            kombine.__version__ = version
+
+    def test_running_gr(self):
+        from bayesvp.utilities import RunningGR, gr_indicator
+        chain = np.random.RandomState(0).randn(100,6,3) + np.arange(6)[:,np.newaxis]*0.1
+        monitor = RunningGR(6,3,interval=10)
+        for i in range(0,100,7):
+            monitor.update(chain[i:i+7])
+        self.assertEqual(monitor.steps,list(range(10,101,10)))
+        for n,values in zip(monitor.steps,monitor.values):
+            np.testing.assert_allclose(values,gr_indicator(chain[:n]),rtol=1e-12)
+
+    def test_gr_stop(self):
+        from bayesvp.checkpoint import load_checkpoint
+        from bayesvp.mcmc_setup import bvp_mcmc_single
+        self.config_params.mcmc_sampler = 'hmc'
+        self.config_params.nsteps = 1000
+        self.config_params.gr_stop = (40,1.15)
+        bvp_mcmc_single(self.config_params)
+
+        chain = np.load(self.config_params.chain_fname + '.npy')
+        self.assertTrue(len(chain) < 1000)
+        gr = np.loadtxt(self.config_params.chain_fname + '_GR.dat')
+        self.assertTrue(np.all(gr[-1,1:] <= 1.15))
+        self.assertTrue(load_checkpoint(self.config_params.chain_fname + '_state.pkl')['converged'])
+
+        # A converged run is not extended when resumed
+        bvp_mcmc_single(self.config_params,resume=True)
+        self.assertEqual(len(np.load(self.config_params.chain_fname + '.npy')),len(chain))
+
+    def test_autocorrelation_time(self):
+        from bayesvp.utilities import autocorrelation_time, effective_sample_size
+        # AR(1) chains with tau = (1+phi)/(1-phi)
+        random_state = np.random.RandomState(0)
+        phi = np.array([0.0,0.5,0.9])
+        chain = np.zeros((20000,8,3))
+        for t in range(1,len(chain)):
+            chain[t] = phi*chain[t-1] + random_state.randn(8,3)
+        np.testing.assert_allclose(autocorrelation_time(chain),(1+phi)/(1-phi),rtol=0.1)
+        np.testing.assert_allclose(effective_sample_size(chain),
+                                   20000*8/autocorrelation_time(chain))
+
+    def test_ess_stop(self):
+        from bayesvp.mcmc_setup import bvp_mcmc_single
+        self.config_params.mcmc_sampler = 'hmc'
+        self.config_params.nsteps = 1000
+        self.config_params.gr_stop = (40,1.15)
+        self.config_params.ess_stop = 100
+        bvp_mcmc_single(self.config_params)
+
+        chain = np.load(self.config_params.chain_fname + '.npy')
+        self.assertTrue(len(chain) < 1000)
+        act = np.loadtxt(self.config_params.chain_fname + '_ACT.dat')
+        self.assertEqual(act.shape,(3,2))
+        self.assertTrue(np.all(act[:,1] >= 100))
+
+        with open(self.config_params.chain_fname + '_ACT.dat') as f:
+            header = dict(item.split('=') for item in f.readline()[2:].split())
+        burnin, thin = int(header['burnin']), int(header['thin'])
+        thinned = np.load(self.config_params.chain_fname + '_thinned.npy')
+        np.testing.assert_array_equal(thinned,chain[burnin::thin])
+
+
+
+class TCAutoParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.config_fname = write_test_config(mcmc='16 40 1 bic emcee',
+                                              extra_lines=('LSF 1395','seed 3','! auto 1 2'))
+        self.config_params = None
+
+    def tearDown(self):
+        # Configs of each number of components written by bvp_mcmc
+        basename, extension = os.path.splitext(self.config_fname)
+        for n in (1,2):
+            if os.path.isfile(basename + str(n) + extension):
+                os.remove(basename + str(n) + extension)
+        remove_test_config(self.config_fname,self.config_params)
+
+    def _run(self,model_processes):
+        from bayesvp.mcmc_setup import bvp_mcmc
+        with open(self.config_fname,'a') as f:
+            f.write('model_processes %i\n' % model_processes)
+        bvp_mcmc(self.config_fname,None)
+
+        basename, extension = os.path.splitext(self.config_fname)
+        self.config_params = DefineParams(basename + '1' + extension)
+        self.assertEqual(self.config_params.model_processes,model_processes)
+        return np.loadtxt(self.config_params.mcmc_outputpath + '/bic_' +
+                          self.config_params.chain_short_fname[:-1] + '.dat')
+
+    def test_parallel_models(self):
+        # Same summary as the sequential fits of each number of components
+        sequential = self._run(1)
+        parallel = self._run(2)
+        self.assertEqual(parallel.shape,(2,2))
+        np.testing.assert_array_equal(parallel[:,0],[1,2])
+        np.testing.assert_allclose(parallel,sequential)
+        for n in (1,2):
+            chain = np.load(self.config_params.mcmc_outputpath + '/' +
+                            self.config_params.chain_short_fname[:-1] + str(n) + '.npy')
+            self.assertEqual(chain.shape,(40,16,3*n))
+
+    def test_threads_per_model(self):
+        from bayesvp.mcmc_setup import _threads_per_model
+        n_cores = os.cpu_count() or 1
+        self.assertEqual(_threads_per_model(4*n_cores,1),4*n_cores)
+        self.assertEqual(_threads_per_model(4*n_cores,2),max(1,n_cores//2))
+        self.assertEqual(_threads_per_model(1,2),1)
+
+
 if __name__ == '__main__':
     unittest.main()
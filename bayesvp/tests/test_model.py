@@ -7,6 +7,8 @@ import numpy as np
 from bayesvp.vp_model import general_intensity
 from bayesvp.vp_model import wavelength_array
 from bayesvp.vp_model import simple_spec
+from bayesvp.utilities import get_bayesvp_Dir
+from bayesvp.tests.config_fixture import ConfigTestCase
 
 ###############################################################################
 # TEST CASE 1: OVI line with stock config file and spectrum
@@ -35,6 +37,255 @@ class TCSingleVP(unittest.TestCase):
         self.assertEqual(np.shape(flux),np.shape(wave))
 
 
+class TCWindowedVP(ConfigTestCase):
+    components = ('14.5 30 0.0','13.8 15 0.0001')
+    regions = '1025.0 1045.0'
+
+    def setUp(self):
+        ConfigTestCase.setUp(self)
+        self.alpha = np.array([14.5,30,0.0,13.8,15,0.0001])
+
+    def test_window_matches_full_evaluation(self):
+        from bayesvp.vp_model import generic_prediction
+
+        full_flux = generic_prediction(self.alpha,self.config_params)
+        self.config_params.voigt_window = (50,50)
+        windowed_flux = generic_prediction(self.alpha,self.config_params)
+        np.testing.assert_allclose(windowed_flux,full_flux,atol=1e-6)
+
+    def test_damping_window_at_high_redshift(self):
+        from bayesvp.vp_model import windowed_intensity, lines_intensity
+
+        # Damping wings of a strong line; in Lorentz widths of the observed 
+        # profile the optical depth left out does not depend on redshift
+        plan = self.config_params.fit_plan
+        errors = []
+        for z in (0.0,2.0):
+            component_params = np.array([[19.0,30,z],[13.8,15,z+0.0001]])
+            wave = self.config_params.wave*(1+z)
+            tau = windowed_intensity(component_params,plan,wave,0,3e4)
+            errors.append(np.max(np.abs(tau - lines_intensity(component_params,plan,wave))))
+        self.assertTrue(errors[1] < 1.5*errors[0],errors)
+
+    def test_zero_outside_window(self):
+        from bayesvp.vp_model import windowed_intensity
+
+        plan = self.config_params.fit_plan
+        wave = self.config_params.wave
+        tau = windowed_intensity(plan.component_params(self.alpha),plan,wave,5,0)
+
+        # 5 Doppler widths of the widest component (b = 30 km/s)
+        half_width = 5*1037.6*30/299792.458
+        far = np.ones(len(wave),dtype=bool)
+        for wave0 in plan.line_params[:,1]:
+            for z in (0.0,0.0001):
+                far &= np.abs(wave - wave0*(1+z)) > half_width
+        self.assertTrue(np.any(far))
+        self.assertTrue(np.all(tau[far] == 0))
+        for wave0 in plan.line_params[:,1]:
+            self.assertTrue(tau[np.argmin(np.abs(wave-wave0))] > 0)
+
+    def test_broadcast_matches_line_sum(self):
+        from bayesvp import vp_model
+
+        plan = self.config_params.fit_plan
+        wave = self.config_params.wave
+        component_params = plan.component_params(self.alpha)
+        tau = vp_model.lines_intensity(component_params,plan,wave)
+
+        tau_sum = np.zeros(len(wave))
+        for n in range(plan.n_lines):
+            logN,b,z = component_params[plan.line_component[n]]
+            tau_sum += vp_model.general_intensity(logN,b,z,wave,plan.line_params[n])
+        np.testing.assert_allclose(tau,tau_sum,rtol=1e-12,atol=1e-300)
+
+        # Chunked evaluation over walkers gives the same fluxes
+        walkers = np.array([self.alpha,self.alpha+0.01,self.alpha-0.01])
+        flux = vp_model.generic_prediction(walkers,self.config_params)
+        default_size = vp_model.max_broadcast_size
+        try:
+            vp_model.max_broadcast_size = 1
+            chunked_flux = vp_model.generic_prediction(walkers,self.config_params)
+        finally:
+            vp_model.max_broadcast_size = default_size
+        np.testing.assert_allclose(chunked_flux,flux,rtol=1e-14)
+        np.testing.assert_allclose(flux[0],vp_model.generic_prediction(self.alpha,self.config_params))
+
+
+class TCLSFKernel(unittest.TestCase):
+
+    def setUp(self):
+        code_path = get_bayesvp_Dir()
+        self.lsf = np.loadtxt(code_path + '/data/example/database/1395')
+        wave = np.linspace(1030.,1033.,500)
+        self.flux = 1 - 0.8*np.exp(-0.5*((wave-1031.5)/0.02)**2)
+
+    def test_methods_match_convolve_lsf(self):
+        from bayesvp.utilities import LSFKernel, convolve_lsf
+
+        for n_pixels in (500,100):
+            flux = self.flux[:n_pixels]
+            kernel = LSFKernel(self.lsf,n_pixels)
+            expected = convolve_lsf(flux,self.lsf)
+            for method in ('direct','fft'):
+                kernel.method = method
+                np.testing.assert_allclose(kernel.convolve(flux),expected,atol=1e-12)
+
+            # Batched spectra
+            fluxes = np.array([flux,flux**2])
+            conv_fluxes = kernel.convolve(fluxes)
+            np.testing.assert_allclose(conv_fluxes[1],convolve_lsf(flux**2,self.lsf),atol=1e-12)
+
+    def test_identity_and_choice(self):
+        from bayesvp.utilities import LSFKernel
+
+        kernel = LSFKernel(1.0,len(self.flux))
+        self.assertEqual(kernel.method,'identity')
+        np.testing.assert_array_equal(kernel.convolve(self.flux),self.flux)
+
+        # Wide kernel on a long region uses FFT; short kernel is direct
+        self.assertEqual(LSFKernel(self.lsf,20000).method,'fft')
+        self.assertEqual(LSFKernel(np.ones(3),20000).method,'direct')
+        self.assertTrue(LSFKernel(self.lsf,500).n_fft >= 500+len(self.lsf)-1)
+
+
+class TCLSFOperator(ConfigTestCase):
+    regions = '1030.0 1033.0 1036.5 1039.0'
+    extra_lines = ('cos_lsf aa_LSFTable_G130M_1300_LP1_cn.dat 05i1639ml_disp.fits 1300',)
+
+    def setUp(self):
+        ConfigTestCase.setUp(self)
+        self.alpha = np.array([14.5,30,0.0])
+
+    def test_operator_matches_convolve_lsf_new(self):
+        from bayesvp.vp_model import generic_prediction
+        from bayesvp.utilities import convolve_lsf_new
+
+        database = self.config_params.spec_path + '/database/'
+        self.assertEqual(self.config_params.cos_lsf[2:],(1300,'FUV'))
+        conv_flux = generic_prediction(self.alpha,self.config_params)
+
+        # Unconvolved model flux through the original per-call convolution
+        lsf_operator = self.config_params.lsf_operator
+        self.config_params.lsf_operator = None
+        model_flux = generic_prediction(self.alpha,self.config_params)
+        for region in self.config_params.fit_plan.region_slices:
+            wave = self.config_params.wave[region]
+            wave_cos,spec_cos = convolve_lsf_new(wave,model_flux[region],
+                                    database + self.config_params.cos_lsf[0],
+                                    database + self.config_params.cos_lsf[1],cenwave=1300)
+            np.testing.assert_allclose(conv_flux[region],np.interp(wave,wave_cos,spec_cos),
+                                       atol=1e-12)
+        self.assertTrue(np.min(conv_flux) > np.min(model_flux))
+
+        # Batched flux
+        walkers = np.array([self.alpha,self.alpha])
+        self.config_params.lsf_operator = lsf_operator
+        np.testing.assert_allclose(generic_prediction(walkers,self.config_params)[1],conv_flux)
+
+
+class TCCOSLSFCache(unittest.TestCase):
+
+    def setUp(self):
+        from bayesvp.utilities import clear_cos_lsf_cache
+        database = get_bayesvp_Dir() + '/data/example/database/'
+        self.lsf_file = database + 'aa_LSFTable_G130M_1300_LP1_cn.dat'
+        self.disptab = database + '05i1639ml_disp.fits'
+        clear_cos_lsf_cache()
+
+    def test_cached_kernels(self):
+        from bayesvp import utilities
+
+        new_lsf, new_w, step = utilities.redefine_lsf(self.lsf_file,1300,self.disptab)
+        self.assertEqual(len(utilities.redefined_lsf_cache.items),1)
+        self.assertEqual(len(utilities.disp_params_cache.items),2) # FUVA and FUVB
+
+        # Same arrays are returned without reading the files again
+        cached_lsf, cached_w, cached_step = utilities.redefine_lsf(self.lsf_file,1300,self.disptab)
+        self.assertTrue(cached_lsf is new_lsf)
+        self.assertEqual(step,cached_step)
+        self.assertFalse(cached_lsf.flags.writeable)
+
+        uncached_lsf, uncached_w, _ = utilities._redefine_lsf(self.lsf_file,1300,self.disptab)
+        np.testing.assert_array_equal(new_lsf,uncached_lsf)
+        np.testing.assert_array_equal(new_w,uncached_w)
+
+    def test_eviction(self):
+        from bayesvp.utilities import LRUCache
+
+        cache = LRUCache(maxsize=2)
+        cache.put('a',1); cache.put('b',2)
+        self.assertEqual(cache.get('a'),1)
+        cache.put('c',3)
+        self.assertTrue(cache.get('b') is None)
+        self.assertEqual(cache.get('a'),1)
+        self.assertEqual(cache.get('c'),3)
+
+
+class TCOversampledVP(ConfigTestCase):
+    components = ('14.0 2 0.0','13.8 30 0.0005')
+    extra_lines = ('oversample 8',)
+
+    def setUp(self):
+        ConfigTestCase.setUp(self)
+        self.alpha = np.array([14.0,2,0.0,13.8,30,0.0005])
+
+    def test_oversampled_flux(self):
+        from bayesvp.vp_model import generic_prediction, lines_intensity
+
+        self.assertEqual(self.config_params.oversample,(8,3.0))
+        plan = self.config_params.fit_plan
+        wave = self.config_params.wave
+        oversampled_flux = generic_prediction(self.alpha,self.config_params)
+
+        # Optical depth averaged over a fine sub-grid of every pixel
+        offsets = (np.arange(64) + 0.5)/64 - 0.5
+        sub_wave = (wave[:,np.newaxis] + plan.pixel_width[:,np.newaxis]*offsets).ravel()
+        tau_fine = lines_intensity(plan.component_params(self.alpha),plan,sub_wave)
+        exact_flux = np.exp(-np.mean(tau_fine.reshape(len(wave),64),axis=1))
+
+        self.config_params.oversample = None
+        center_flux = generic_prediction(self.alpha,self.config_params)
+        error_center = np.max(np.abs(center_flux-exact_flux))
+        error_oversampled = np.max(np.abs(oversampled_flux-exact_flux))
+        self.assertTrue(error_center > 0.05)
+        self.assertTrue(error_oversampled < 0.01*error_center)
+
+        # Resolved component (b = 30 km/s) is not sub-sampled
+        far = np.abs(wave - 1031.93) > 0.2
+        np.testing.assert_allclose(oversampled_flux[far],center_flux[far],rtol=1e-12)
+
+        # Batched walkers
+        self.config_params.oversample = (8,3.0)
+        walkers = np.array([self.alpha,self.alpha])
+        np.testing.assert_allclose(generic_prediction(walkers,self.config_params)[1],
+                                   oversampled_flux,rtol=1e-12)
+
+
+class TCPolyContinuum(unittest.TestCase):
+
+    def setUp(self):
+        self.wave = np.linspace(1030.0,1039.0,500)
+        self.flux = 1 + 0.1*np.sin(self.wave)
+
+    def test_matches_poly_continuum(self):
+        from bayesvp.vp_model import PolyContinuum, poly_continuum
+
+        cont_model = PolyContinuum(self.wave,self.flux,3)
+        self.assertEqual(cont_model.design.shape,(500,3))
+        params = np.array([0.02,-0.01,0.003])
+        np.testing.assert_allclose(cont_model(params),
+                                   poly_continuum(self.wave,self.flux,*params),rtol=1e-14)
+
+        # Batched coefficients
+        walkers = np.array([params,2*params,np.zeros(3)])
+        continuum = cont_model(walkers)
+        self.assertEqual(continuum.shape,(3,500))
+        for walker,cont in zip(walkers,continuum):
+            np.testing.assert_allclose(cont,poly_continuum(self.wave,self.flux,*walker),rtol=1e-14)
+        np.testing.assert_allclose(continuum[2],np.median(self.flux))
+
+
 if __name__ == '__main__':
 
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,74 @@
+import unittest
+import os
+import numpy as np
+from scipy.special import wofz
+
+from bayesvp.voigt import voigt_function, select_backend, validation_table
+from bayesvp.voigt import VoigtTable
+from bayesvp.vp_model import voigt_shape
+
+###############################################################################
+# TEST CASE 1: Voigt function backends against the Faddeeva function
+###############################################################################
+
+class TCVoigtBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.linspace(-50,50,10001)
+
+    def test_default_is_exact(self):
+        a = 1e-3
+        np.testing.assert_array_equal(voigt_shape(self.x,a),wofz(self.x+1j*a).real)
+
+    def test_validation_table(self):
+        # every backend stays within its stated error bound
+        backends = ['wofz','humlicek','tepper_garcia']
+        for name,a,error,bound in validation_table(backends=backends):
+            self.assertLessEqual(error,bound,msg='%s at a = %.1e' % (name,a))
+
+    def test_select_backend(self):
+        self.assertEqual(select_backend(None,1e-3).name,'wofz')
+        self.assertEqual(select_backend(1e-3,1e-3).name,'tepper_garcia')
+        self.assertEqual(select_backend(1e-4,1e-2).name,'humlicek')
+        self.assertEqual(select_backend(1e-8,1e-2).name,'wofz')
+
+    def test_tolerance(self):
+        for a in [1e-6,1e-3,0.05]:
+            for tol in [1e-3,1e-4]:
+                H = voigt_function(self.x,a,tol=tol)
+                np.testing.assert_allclose(H,wofz(self.x+1j*a).real,rtol=0,atol=tol)
+
+
+class TCVoigtTable(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache_file(self):
+        table = VoigtTable(n_a=11,a_max=0.1,cache_dir=self.cache_dir)
+        self.assertTrue(os.path.isfile(table.fname))
+        self.assertLessEqual(table.max_error,table.error_bound)
+
+        # second instance maps the same file
+        table = VoigtTable(n_a=11,a_max=0.1,cache_dir=self.cache_dir)
+        self.assertIsInstance(table.table,np.memmap)
+
+    def test_interpolation(self):
+        table = VoigtTable(n_a=11,a_max=0.1,cache_dir=self.cache_dir)
+        x = np.linspace(-50,50,10001)
+        for a in [0,1e-5,3.3e-2,0.1,0.5]:
+            np.testing.assert_allclose(table(x,a),wofz(x+1j*a).real,
+                                       rtol=0,atol=table.error_bound)
+
+    def test_error_bound(self):
+        with self.assertRaises(ValueError):
+            VoigtTable(n_x=101,cache_dir=self.cache_dir,error_bound=1e-8)
+
+
+if __name__ == '__main__':
+    unittest.main()
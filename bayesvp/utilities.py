@@ -12,8 +12,12 @@ import re
 import os
 import sys
 import argparse
+from collections import OrderedDict
 from scipy.special import gamma
 from scipy.interpolate import interp1d
+from scipy.signal import fftconvolve
+from scipy import fft as sp_fft
+from scipy import sparse
 from astropy.convolution import convolve
 import matplotlib.pyplot as plt
 font = {'family' : 'serif', 'weight' : 'normal', 'size'   : 11}
@@ -107,7 +111,7 @@ def model_info_criterion(obs_spec_obj):
 	# Define the posterior function based on data
 	lnprob = Posterior(obs_spec_obj)
 
-	data_length = len(obs_spec_obj.flux)
+	data_length = np.sum(obs_spec_obj.good_pixels)
 
 	chain = np.load(obs_spec_obj.chain_fname + '.npy')
 	n_params = np.shape(chain)[-1]
@@ -233,21 +237,29 @@ def read_mcmc_fits(config_params_obj,para_name):
 	my_dict = {'logN':0, 'b':1,'z':2}
 	col_num = my_dict[para_name]
 	chain = np.load(config_params_obj.chain_fname + '.npy')
-	burnin = compute_burnin_GR(config_params_obj.chain_fname + '_GR.dat')
+	burnin = compute_burnin_GR(config_params_obj.chain_fname + '_GR.dat',
+								   config_params_obj.burnin_threshold,config_params_obj.burnin_method)
 	x = chain[burnin:,:,col_num].flatten()
 	xmed,xm,xsd,xcfl11, xcfl12, xcfl21,xcfl22 = compute_stats(x)
 	return xmed 
 
-def write_mcmc_stats(config_params_obj,output_fname):
-	chain = np.load(config_params_obj.chain_fname + '.npy')
-	burnin = compute_burnin_GR(config_params_obj.chain_fname + '_GR.dat')
+def write_mcmc_stats(config_params_obj,output_fname,samples=None):
+	"""
+	Write the statistics of each parameter after burn-in; samples 
+	(n_samples, n_params) are used instead of the chain if given
+	"""
+	if samples is None:
+		chain = np.load(config_params_obj.chain_fname + '.npy')
+		burnin = compute_burnin_GR(config_params_obj.chain_fname + '_GR.dat',
+								   config_params_obj.burnin_threshold,config_params_obj.burnin_method)
+		samples = chain[burnin:].reshape((-1,np.shape(chain)[-1]))
 	
 	f = open(output_fname,'w')
 	f.write('x_med\tx_mean\tx_std\tx_cfl11\tx_cfl12\t x_cfl21\tx_cfl22\n')
 	
-	n_params = np.shape(chain)[-1]
+	n_params = np.shape(samples)[-1]
 	for i in range(n_params):
-		x            = chain[burnin:,:,i].flatten()
+		x            = samples[:,i]
 		output_stats = compute_stats(x)
 		f.write('%f\t%f\t%f\t%f\t%f\t%f\t%f\n' % 
 				(output_stats[0],output_stats[1],
@@ -315,6 +327,15 @@ def gaussian_kernel(std):
     return norm*np.exp(-(x**2/(2*std**2)))
 
 def convolve_lsf(flux,lsf):
+	if np.ndim(flux) > 1:
+		# Many spectra with shape (n_spectra, n_pixels); the central part 
+		# of the full convolution is the same as mode='same' with padding 
+		# used below for the single spectrum 
+		lsf = np.atleast_1d(lsf)
+		n_pixels = np.shape(flux)[-1]; i0 = (len(lsf)-1)//2
+		conv_flux = fftconvolve(1-flux,lsf[np.newaxis,:],mode='full',axes=-1)
+		return 1-conv_flux[:,i0:i0+n_pixels] / np.sum(lsf)
+
 	if len(flux) < len(np.atleast_1d(lsf)):
 		# Add padding to make sure to return the same length in flux.
 		padding = np.ones(len(lsf)-len(flux)+1)
@@ -327,6 +348,156 @@ def convolve_lsf(flux,lsf):
 		# convolve 1-flux to remove edge effects wihtout using padding
 		return 1-np.convolve(1-flux,lsf,mode='same') /np.sum(lsf)
 
+# Relative cost of FFT against direct convolution in units of one 
+# multiply-add of the direct convolution, measured with numpy/scipy.fft
+lsf_fft_cost_ratio = 10.0
+lsf_fft_overhead = 1.5e5
+
+class LSFKernel:
+    """
+    LSF of one wavelength region, convolved with the model flux either 
+    directly or with FFT, whichever is estimated to be faster. The 
+    kernel spectrum at the padded FFT length is computed once so that 
+    each call only transforms 1 - flux. The result is the same as 
+    convolve_lsf(flux,lsf).
+
+    Parameters:
+    ----------
+    lsf: array_like
+        LSF kernel of the region; a single value leaves flux unchanged
+    n_pixels: int
+        Number of pixels in the region
+    dtype: numpy dtype
+        Precision of the kernel and of its spectrum
+
+    Attributes:
+    -----------
+    kernel: 1D array
+        LSF kernel
+    n_fft: int
+        Padded length of the FFT, at least n_pixels + len(kernel) - 1
+    kernel_fft: 1D array
+        Real FFT of the normalized kernel with length n_fft
+    method: str
+        'identity', 'direct' or 'fft' for a single spectrum
+    """
+    def __init__(self,lsf,n_pixels,dtype=np.float64):
+        self.kernel = np.atleast_1d(np.asarray(lsf,dtype=dtype))
+        self.n_pixels = int(n_pixels)
+        self.norm = np.sum(self.kernel)
+        self.offset = (len(self.kernel)-1)//2
+
+        self.n_fft = sp_fft.next_fast_len(self.n_pixels+len(self.kernel)-1,real=True)
+        if len(self.kernel) > 1:
+            self.kernel_fft = sp_fft.rfft(self.kernel/self.norm,self.n_fft)
+        else:
+            self.kernel_fft = None
+        self.method = self.choose_method(1)
+
+    def choose_method(self,n_spectra):
+        """Convolution method for n_spectra spectra of this region"""
+        if len(self.kernel) == 1:
+            return 'identity'
+        direct_cost = n_spectra*self.n_pixels*len(self.kernel)
+        # single precision FFT takes about half the time of double
+        fft_cost = (n_spectra*lsf_fft_cost_ratio*self.n_fft*np.log2(self.n_fft) 
+                    * self.kernel.itemsize/8 + lsf_fft_overhead)
+        if fft_cost < direct_cost:
+            return 'fft'
+        else:
+            return 'direct'
+
+    def convolve(self,flux):
+        """
+        Parameters:
+        ----------
+        flux: array_like
+            Model flux with shape (n_pixels,) or (n_spectra,n_pixels)
+
+        Returns:
+        ----------
+        conv_flux: array
+            Flux convolved with the LSF with the same shape as flux
+        """
+        if np.shape(flux)[-1] != self.n_pixels:
+            return convolve_lsf(flux,self.kernel)
+        if len(self.kernel) == 1:
+            return np.array(flux,dtype=self.kernel.dtype)
+        # convolve 1-flux to remove edge effects wihtout using padding
+        return 1-self.apply(1-flux)
+
+    def apply(self,values):
+        """
+        Normalized kernel applied along the last axis of values, i.e 
+        the linear part of convolve (e.g for derivatives of the flux)
+
+        Parameters:
+        ----------
+        values: array_like
+            shape = (..., n_pixels)
+
+        Returns:
+        ----------
+        conv_values: array
+            Convolved values with the same shape
+        """
+        values = np.asarray(values)
+        n_spectra = int(np.prod(values.shape[:-1]))
+        method = self.method if values.ndim == 1 else self.choose_method(n_spectra)
+        i0 = self.offset; i1 = self.offset + self.n_pixels
+        if method == 'identity':
+            return np.array(values,dtype=self.kernel.dtype)
+        elif method == 'fft':
+            values_fft = sp_fft.rfft(values,self.n_fft,axis=-1)
+            return sp_fft.irfft(values_fft*self.kernel_fft,self.n_fft,axis=-1)[...,i0:i1]
+        elif values.ndim == 1:
+            return np.convolve(values,self.kernel,mode='full')[i0:i1] / self.norm
+        else:
+            flat_values = values.reshape(-1,self.n_pixels)
+            conv_values = np.empty(flat_values.shape,dtype=self.kernel.dtype)
+            for i in range(len(flat_values)):
+                conv_values[i] = np.convolve(flat_values[i],self.kernel,mode='full')[i0:i1] / self.norm
+            return conv_values.reshape(values.shape)
+
+class LRUCache:
+    """
+    Dictionary of at most maxsize items; the least recently used 
+    item is removed when a new item exceeds the size.
+    """
+    def __init__(self,maxsize=32):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self,key):
+        """Return the cached value of key or None"""
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self,key,value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+# Process-wide caches of DISPTAB dispersion solutions and rebinned LSF 
+# kernels, keyed by file path and modification time 
+disp_params_cache = LRUCache(maxsize=64)
+redefined_lsf_cache = LRUCache(maxsize=16)
+
+def file_cache_key(filename):
+    """(absolute path, modification time) identifying a file's content"""
+    return (os.path.abspath(filename), os.path.getmtime(filename))
+
+def clear_cos_lsf_cache():
+    """Empty the caches of get_disp_params() and redefine_lsf()"""
+    disp_params_cache.clear()
+    redefined_lsf_cache.clear()
+
 def read_lsf(filename):
     # This is the table of all the LSFs: called "lsf"
     # The first column is a list of the wavelengths corresponding to the line profile, so we set our header accordingly
@@ -359,21 +530,28 @@ def get_disp_params(disptab, cenwave, segment, x=[]):
     Returns:
     disp_coeff (list): Coefficients of the relevant polynomial dispersion relationship
     wavelength (list; if applicable): Wavelengths corresponding to input x pixels 
+    Results are cached by (disptab path, mtime, cenwave, segment); the 
+    returned arrays are read-only.
     """
-    with fits.open(disptab) as d:
-        wh_disp = np.where(
-            (d[1].data["cenwave"] == cenwave)
-            & (d[1].data["segment"] == segment)
-            & (d[1].data["aperture"] == "PSA")
-        )[0]
-        disp_coeff = d[1].data[wh_disp]["COEFF"][0] # 0 is needed as this returns nested list [[arr]]
-        d_tv03 = d[1].data[wh_disp]["D_TV03"]  # Offset from WCA to PSA in Thermal Vac. 2003 data
-        d_orbit = d[1].data[wh_disp]["D"]  # Current offset from WCA to PSA
-
-    delta_d = d_tv03 - d_orbit
-
-    if len(x):  # If given a pixel range, build up a polynomial wvln solution pix -> λ
+    key = file_cache_key(disptab) + (cenwave, segment)
+    cached = disp_params_cache.get(key)
+    if cached is None:
+        with fits.open(disptab) as d:
+            wh_disp = np.where(
+                (d[1].data["cenwave"] == cenwave)
+                & (d[1].data["segment"] == segment)
+                & (d[1].data["aperture"] == "PSA")
+            )[0]
+            disp_coeff = np.array(d[1].data[wh_disp]["COEFF"][0]) # 0 is needed as this returns nested list [[arr]]
+
+        # Polynomial wvln solution pix -> λ
         wavelength = np.polyval(p=disp_coeff[::-1], x=np.arange(16384))
+        disp_coeff.setflags(write=False); wavelength.setflags(write=False)
+        cached = (disp_coeff, wavelength)
+        disp_params_cache.put(key, cached)
+    disp_coeff, wavelength = cached
+
+    if len(x):  # If given a pixel range, return the wavelength solution
         return disp_coeff, wavelength
     else:  # If x is empty:
         return disp_coeff
@@ -391,8 +569,21 @@ def redefine_lsf(lsf_file, cenwave, disptab, detector="FUV"):
     new_lsf (numpy.ndarray): Remapped LSF kernels.
     new_w (numpy.ndarray): New LSF kernel's LSF wavelengths.
     step (float): first order coefficient of the FUVA dispersion relationship; proxy for Δλ/Δpixel.
+    Results are cached by the paths and mtimes of both files, cenwave 
+    and detector; the returned kernels are read-only.
     """
-
+    key = file_cache_key(lsf_file) + file_cache_key(disptab) + (cenwave, detector)
+    cached = redefined_lsf_cache.get(key)
+    if cached is None:
+        new_lsf, new_w, step = _redefine_lsf(lsf_file, cenwave, disptab, detector=detector)
+        new_lsf = np.array(new_lsf, dtype=float); new_w = np.array(new_w)
+        new_lsf.setflags(write=False); new_w.setflags(write=False)
+        cached = (new_lsf, new_w, step)
+        redefined_lsf_cache.put(key, cached)
+    return cached
+
+def _redefine_lsf(lsf_file, cenwave, disptab, detector="FUV"):
+    """Uncached redefine_lsf()"""
     if detector == "FUV":
         xfull = np.arange(16384)
 
@@ -432,7 +623,7 @@ def redefine_lsf(lsf_file, cenwave, disptab, detector="FUV"):
                 orig_lsf_wvln_key = lsf.keys()[lsf_index]  # column name corresponding to closest orig LSF wvln
                 new_lsf[:, i] = np.array(lsf[orig_lsf_wvln_key])  # assign new LSF wvln the kernel of the closest original lsf wvln
         else:
-            new_lsf = lsf
+            new_lsf = np.transpose(lsf_array)
             new_w = w
         return new_lsf, new_w, step
 
@@ -531,6 +722,140 @@ def convolve_lsf_new(wavelength, spec, lsf_file, disptab, cenwave=1300, detector
     return wave_cos, final_spec  # Remember, not the same length as input spectrum data!
 
 
+def interpolation_matrix(x, x_new):
+    """
+    Sparse matrix of linear interpolation from sorted points x onto 
+    x_new; values beyond the ends of x are those at the ends.
+
+    Returns:
+    ----------
+    matrix: scipy.sparse.csr_matrix
+        (len(x_new), len(x)) matrix with two weights in each row
+    """
+    x = np.asarray(x,dtype=float); x_new = np.asarray(x_new,dtype=float)
+    i = np.clip(np.searchsorted(x,x_new,side='right')-1,0,len(x)-2)
+    t = np.clip((x_new - x[i]) / (x[i+1] - x[i]),0,1)
+
+    rows = np.repeat(np.arange(len(x_new)),2)
+    cols = np.column_stack([i,i+1]).ravel()
+    weights = np.column_stack([1-t,t]).ravel()
+    return sparse.csr_matrix((weights,(rows,cols)),shape=(len(x_new),len(x)))
+
+class LSFOperator:
+    """
+    Wavelength dependent COS LSF as one sparse matrix acting on the model 
+    flux. It is built once and applies the same steps as convolve_lsf_new: 
+    resample the flux of each wavelength region onto the COS pixel scale, 
+    convolve the range of each LSF kernel with that kernel (normalized, 
+    with extended boundaries), and resample back onto the observed 
+    wavelengths.
+
+    Parameters:
+    ----------
+    wave: 1D array
+        Observed wavelengths of all regions
+    region_slices: list
+        Slice of each wavelength region in wave
+    lsf_file: str
+        Path to the LSF table
+    disptab: str
+        Path to the DISPTAB file
+    cenwave: int
+        Cenwave for calculation of dispersion relationship
+    detector: str
+        'FUV' or 'NUV'
+    dtype: numpy dtype
+        Precision of the operator
+
+    Attributes:
+    -----------
+    matrix: scipy.sparse.csr_matrix
+        (n_pixels, n_pixels) block diagonal operator, one block per region
+    """
+    def __init__(self, wave, region_slices, lsf_file, disptab, 
+                 cenwave=1300, detector='FUV', dtype=np.float64):
+        new_lsf, new_w, step = redefine_lsf(lsf_file, cenwave, disptab, detector=detector)
+
+        blocks = [self.region_matrix(wave[region],new_lsf,new_w,step)
+                  for region in region_slices]
+        self.matrix = sparse.block_diag(blocks,format='csr').astype(dtype)
+
+    @staticmethod
+    def region_matrix(wave, new_lsf, new_w, step):
+        """Operator of one wavelength region; see convolve_lsf_new"""
+        nstep = int(round((max(wave) - min(wave)) / step)) - 1
+        if len(wave) < 2 or nstep < 2:
+            return sparse.identity(len(wave),format='csr')
+        wave_cos = min(wave) + np.arange(nstep) * step
+
+        rows = []; cols = []; weights = []
+        convolved = np.zeros(nstep,dtype=bool)
+        for i, w in enumerate(new_w):
+            # Range of the spectrum where this kernel applies
+            if i == 0:
+                diff_wave_left = 500
+            else:
+                diff_wave_left = (w - new_w[i - 1]) / 2.0
+            if i == len(new_w) - 1:
+                diff_wave_right = 500
+            else:
+                diff_wave_right = (new_w[i + 1] - w) / 2.0
+            chunk = np.where((wave_cos < w + diff_wave_right) & 
+                             (wave_cos >= w - diff_wave_left))[0]
+
+            kernel = np.asarray(new_lsf[:, i],dtype=float)
+            if len(chunk) == 0 or len(chunk) < len(kernel):
+                continue
+            kernel = kernel / np.sum(kernel)
+
+            # out[l] = sum_j kernel[j] * spec[l - j + center] within the 
+            # chunk, extending the edge values beyond its boundaries 
+            center = len(kernel) // 2
+            local = np.arange(len(chunk))
+            inds = np.clip(local[:,np.newaxis] - np.arange(len(kernel)) + center,
+                           0,len(chunk)-1)
+            rows.append(np.repeat(chunk,len(kernel)))
+            cols.append(chunk[inds].ravel())
+            weights.append(np.tile(kernel,len(chunk)))
+            convolved[chunk] = True
+
+        # Pixels outside of all convolved chunks are unchanged
+        identity = np.where(~convolved)[0]
+        rows.append(identity); cols.append(identity); weights.append(np.ones(len(identity)))
+        conv = sparse.csr_matrix((np.concatenate(weights),
+                                  (np.concatenate(rows),np.concatenate(cols))),
+                                 shape=(nstep,nstep))
+
+        resample = interpolation_matrix(wave,wave_cos)
+        resample_back = interpolation_matrix(wave_cos,wave)
+        return (resample_back @ conv @ resample).tocsr()
+
+    def convolve(self, flux):
+        """
+        Parameters:
+        ----------
+        flux: array_like
+            Model flux with shape (n_pixels,) or (n_spectra,n_pixels)
+
+        Returns:
+        ----------
+        conv_flux: array
+            Flux convolved with the LSF with the same shape as flux
+        """
+        return self.apply(flux)
+
+    def apply(self, values):
+        """
+        Operator applied along the last axis of values; the operator is 
+        linear, so this also applies to derivatives of the flux
+        """
+        values = np.asarray(values)
+        if values.ndim == 1:
+            return self.matrix.dot(values)
+        flat_values = values.reshape(-1,values.shape[-1])
+        return np.asarray(self.matrix.dot(flat_values.T)).T.reshape(values.shape)
+
+
 ###############################################################################
 # Convergence 
 ###############################################################################
@@ -551,25 +876,160 @@ def gr_indicator(chain):
 	"""
 	nsteps,nwalkers,ndim = np.shape(chain)
 	nsteps = float(nsteps); nwalkers = float(nwalkers)
-    
-	Rgrs = np.zeros(ndim)
-	for n in range(ndim):
-		x = chain[:,:,n]
-		#print(x)
-		# average of within-chain variance over all walkers
-		W = np.mean(np.var(x,axis=0)) # i.e within-chain variance
-		mean_x_per_chain = np.mean(x,axis=0)
-		mean_x = np.mean(mean_x_per_chain) 
+	chain = np.asarray(chain)
 
-		# Variance between chains 
-		B = nsteps*np.sum((mean_x_per_chain - mean_x)**2) / (nwalkers-1)
-		var_per_W = 1 - 1./nsteps + B/(W*nsteps) 
+	# average of within-chain variance over all walkers
+	W = np.mean(np.var(chain,axis=0),axis=0) # i.e within-chain variance
+	mean_x_per_chain = np.mean(chain,axis=0)
+	mean_x = np.mean(mean_x_per_chain,axis=0) 
 
-		Rgrs[n] = ((nwalkers+1)/nwalkers) * var_per_W - (nsteps-1)/(nwalkers*nsteps)
-        
+	# Variance between chains 
+	B = nsteps*np.sum((mean_x_per_chain - mean_x)**2,axis=0) / (nwalkers-1)
+	var_per_W = 1 - 1./nsteps + B/(W*nsteps) 
+
+	Rgrs = ((nwalkers+1)/nwalkers) * var_per_W - (nsteps-1)/(nwalkers*nsteps)
 	return Rgrs 
 
-def compute_burnin_GR(gr_fname,gr_threshold=1.005):
+class RunningGR:
+	"""
+	Gelman-Rubin indicator of gr_indicator updated as the chain 
+	is produced, from running means and variances of each walker 
+	(Welford's algorithm, merged chunk by chunk). The cost of an 
+	update does not depend on the length of the chain.
+
+	Parameters:
+	-----------
+	nwalkers: int
+		Number of walkers
+	ndim: int
+		Number of parameters
+	interval: int
+		Number of steps between recorded values of the indicator
+
+	Attributes:
+	-----------
+	n_steps: int
+		Number of steps added
+	steps: list
+		Steps at which the indicator was recorded
+	values: list
+		Recorded indicators; arrays with length ndim
+	"""
+	def __init__(self,nwalkers,ndim,interval):
+		self.interval = interval
+		self.n_steps = 0
+		self.mean = np.zeros((nwalkers,ndim))
+		self.m2 = np.zeros((nwalkers,ndim))
+		self.steps = []; self.values = []
+
+	def _add(self,samples):
+		n = len(samples)
+		chunk_mean = np.mean(samples,axis=0)
+		chunk_m2 = np.sum((samples - chunk_mean)**2,axis=0)
+		total = self.n_steps + n
+		delta = chunk_mean - self.mean
+		self.mean = self.mean + delta*n/total
+		self.m2 = self.m2 + chunk_m2 + delta**2*self.n_steps*n/total
+		self.n_steps = total
+
+	def update(self,samples):
+		"""
+		Add steps with shape (n,nwalkers,ndim); the indicator is 
+		recorded at every multiple of interval
+		"""
+		samples = np.asarray(samples,dtype=float)
+		i = 0
+		while i < len(samples):
+			n_next = (self.n_steps//self.interval + 1)*self.interval
+			j = min(len(samples),i + n_next - self.n_steps)
+			self._add(samples[i:j]); i = j
+			if self.n_steps % self.interval == 0:
+				self.steps.append(self.n_steps)
+				self.values.append(self.indicator())
+
+	def indicator(self):
+		"""Gelman-Rubin indicator of all steps added; length ndim"""
+		nsteps = float(self.n_steps); nwalkers = float(len(self.mean))
+		# average of within-chain variance over all walkers
+		W = np.mean(self.m2/nsteps,axis=0)
+		mean_x = np.mean(self.mean,axis=0)
+		# Variance between chains 
+		B = nsteps*np.sum((self.mean - mean_x)**2,axis=0) / (nwalkers-1)
+		var_per_W = 1 - 1./nsteps + B/(W*nsteps)
+		return ((nwalkers+1)/nwalkers) * var_per_W - (nsteps-1)/(nwalkers*nsteps)
+
+	def burnin(self,gr_threshold=1.005):
+		"""
+		Step where the least converged parameter has first crossed 
+		gr_threshold (as compute_burnin_GR); None if a parameter has 
+		not crossed it
+		"""
+		if len(self.values) == 0:
+			return None
+		crossed = np.array(self.values) <= gr_threshold
+		if not np.all(np.any(crossed,axis=0)):
+			return None
+		return int(np.max(np.array(self.steps)[np.argmax(crossed,axis=0)]))
+
+	def converged_steps(self,gr_threshold=1.005):
+		"""
+		Number of steps since the recorded indicators of all 
+		parameters have stayed below gr_threshold; 0 if the 
+		last recorded indicators are not converged
+		"""
+		converged = [np.all(values <= gr_threshold) for values in self.values]
+		if len(converged) == 0 or not converged[-1]:
+			return 0
+		first = len(converged) - 1
+		while first > 0 and converged[first-1]:
+			first -= 1
+		return self.n_steps - self.steps[first]
+
+def autocorrelation_time(chain,c=5.0):
+	"""
+	Integrated autocorrelation time of each parameter. The 
+	autocovariance of every walker is computed with FFT, averaged 
+	over walkers and summed up to the window of Sokal (1989); 
+	see also Foreman-Mackey et al. (2013)
+
+	Parameters:
+	-----------
+	chain: array_like
+		Multi-dimensional array of the chain with shape (nsteps,nwalkers,ndim)
+	c: float
+		The sum stops at the first lag M >= c * tau(M)
+
+	Returns
+	-----------
+	tau: array_like
+		Autocorrelation time in steps with length of (ndim)
+	"""
+	x = np.asarray(chain,dtype=float)
+	nsteps = len(x)
+	x = x - np.mean(x,axis=0)
+
+	# Zero padding to 2*nsteps avoids the circular correlation
+	n_fft = sp_fft.next_fast_len(2*nsteps)
+	x_fft = sp_fft.rfft(x,n=n_fft,axis=0)
+	acov = sp_fft.irfft(x_fft*np.conjugate(x_fft),n=n_fft,axis=0)[:nsteps]
+	acov = np.mean(acov,axis=1)	# shape = (nsteps,ndim)
+
+	with np.errstate(invalid='ignore',divide='ignore'):
+		taus = 2*np.cumsum(acov/acov[0],axis=0) - 1
+	window = np.arange(nsteps)[:,np.newaxis] >= c*taus
+	lag = np.where(np.any(window,axis=0),np.argmax(window,axis=0),nsteps-1)
+	return taus[lag,np.arange(np.shape(taus)[1])]
+
+def effective_sample_size(chain,c=5.0):
+	"""
+	Number of independent samples of each parameter in the chain 
+	(nsteps,nwalkers,ndim): nsteps*nwalkers/tau; see 
+	autocorrelation_time
+	"""
+	nsteps,nwalkers,ndim = np.shape(chain)
+	return nsteps*nwalkers/autocorrelation_time(chain,c)
+
+def compute_burnin_GR(gr_fname,gr_threshold=1.005,method='gr'):
 	"""
 	Calculate the steps where the chains are 
 	converged given a Gelman-Rubin (GR) threshod. 
@@ -582,12 +1042,21 @@ def compute_burnin_GR(gr_fname,gr_threshold=1.005):
 	gr_threshold:float
 		The threshold for chains to be considered as converged.
 		Default value = 1.01
+	method: str
+		'gr' for the GR file; 'rhat' for the rank-normalised split 
+		R-hat of the chain next to the GR file (chain_fname.npy); 
+		see diagnostics.compute_burnin_rhat
 	Returns
 	----------
 	burnin_steps: int
 		The step number where the least converged parameter has 
 		converged; (maxiumn of the steps of all parameters) 
 	"""
+	if method == 'rhat':
+		from bayesvp.diagnostics import compute_burnin_rhat
+		chain = np.load(gr_fname[:-len('_GR.dat')] + '.npy',mmap_mode='r')
+		return compute_burnin_rhat(chain,gr_threshold)
+
 	data = np.loadtxt(gr_fname,unpack=True)
 	steps = data[0]; grs = data[1:]
 	indices = np.argmax(grs<=gr_threshold,axis=1)
@@ -849,7 +1318,7 @@ def print_config_help():
 	printline()
 	print('spec_path full_path_to_spectrum')
 	print('output mcmc_chain_filename')
-	print('mcmc walkers steps_per_walker parallel_threads MCMC_evidence_criterion MCMC_sampler')
+	print('mcmc walkers steps_per_walker parallel_threads MCMC_evidence_criterion MCMC_sampler [vectorize] [numba]')
 	print('%% spectrum_file_name wave_begin1 wave_end1 wave_begin2 wave_end2 ...')
 	print('% Atom State logN_guess b_guess z_guess')
 	print('logN min_logN max_logN')
@@ -869,12 +1338,100 @@ def print_config_help():
 	print('where lsf = line spread function to be convolved with model')
 	print('lsf_file_name is assumed to be in spec_path/database')
 
+	printline()
+	print('cos_lsf lsf_table disptab cenwave [detector]\n')
+	print('Convolve with the wavelength dependent COS LSF from the LSF')
+	print('table and DISPTAB file in spec_path/database (detector: FUV or NUV)')
+
 	printline()
 	print('continuum n \n')
 	print('where n = polynomial degree; number of parameter = n+1')
 
+	printline()
+	print('continuum n marginalize\n')
+	print('Integrate over the n+1 continuum parameters analytically')
+	print('instead of sampling them (Gaussian priors of width cont_prior);')
+	print('bvp_process_model draws them from their conditional posterior')
 
+	printline()
+	print('mask wave_begin1 wave_end1 wave_begin2 wave_end2 ...\n')
+	print('Exclude pixels in the wavelength ranges (e.g bad pixels or')
+	print('geocoronal lines) from the likelihood; pixels with zero')
+	print('error are always excluded')
 
+	printline()
+	print('checkpoint n_steps\n')
+	print('Write the chain and sampler state to disk every n_steps')
+	print('(default 100); bvpfit --resume continues an interrupted run')
+
+	printline()
+	print('seed n\n')
+	print('Seed of the random numbers for reproducible runs')
+
+	printline()
+	print('gr_stop n_steps [threshold]\n')
+	print('Stop sampling before nsteps once the Gelman-Rubin indicators')
+	print('of all parameters have stayed below threshold (default 1.005)')
+	print('for n_steps steps')
+
+	printline()
+	print('ess_stop n_samples\n')
+	print('Stop sampling before nsteps once the effective sample size')
+	print('after burn-in of all parameters is at least n_samples; with')
+	print('gr_stop, both conditions must be met')
+
+	printline()
+	print('convergence gr|rhat [threshold]\n')
+	print('Burn-in of the data products from the Gelman-Rubin indicators')
+	print('(gr; default threshold 1.005) or from the rank-normalised split')
+	print('R-hat of the chain (rhat; default threshold 1.01)')
+
+	printline()
+	print('model_processes n\n')
+	print('In automatic mode (! auto), fit n component counts at the same')
+	print('time in separate processes; the threads of the mcmc line are')
+	print('shared between them')
+
+	printline()
+	print('voigt_window n_doppler n_lorentz\n')
+	print('Evaluate each line only within n_doppler Doppler widths plus')
+	print('n_lorentz Lorentz widths of its centre; the damping wings of')
+	print('saturated lines need n_lorentz of order 1e4 or more')
+
+	printline()
+	print('voigt_tol tolerance\n')
+	print('Use the fastest approximation of the Voigt function with')
+	print('absolute error below tolerance (default: exact)')
+
+	printline()
+	print('precision float32\n')
+	print('Compute the model and likelihood terms in single precision;')
+	print('the likelihood is summed in double precision')
+
+	printline()
+	print('oversample n_sub [threshold]\n')
+	print('Average the optical depth of lines narrower than threshold')
+	print('pixels (default: 3) over n_sub sub-pixels')
+
+	printline()
+	print('voigt_backend name\n')
+	print('Use a named Voigt function backend: wofz, humlicek,')
+	print('tepper_garcia or table (cached lookup table)')
+	print('The numba key on the mcmc line needs voigt_backend humlicek')
+	print('(or voigt_tol >= 5e-5); otherwise the exact NumPy model is used')
+
+	printline()
+	print('mcmc walkers steps threads bic kombine map\n')
+	print('Start the walkers in a ball around the maximum a posteriori')
+	print('found by a multi-start bounded optimiser (uniform if it fails)')
+
+	printline()
+	print('mcmc walkers steps threads bic hmc\n')
+	print('Sample with Hamiltonian Monte Carlo using the exact gradient;')
+	print('each walker is an independent chain; steps//2 warm-up steps')
+	print('adapt the step size and mass matrix and are not saved;')
+	print('not available with voigt_window, voigt_tol, voigt_backend,')
+	print('oversample or precision float32')
 
 	printline()
 	print('! auto n\n')
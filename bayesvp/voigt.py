@@ -0,0 +1,394 @@
+################################################################################
+#
+# voigt.py   	    (c) Cameron Liang 
+#						University of Chicago
+#     				    jwliang@oddjob.uchicago.edu
+#
+# Backends for the Voigt function H(a,x) = Re[w(x + ia)], where w is the 
+# Faddeeva function. Each backend states its cost and a bound on its 
+# absolute error; the cheapest one that meets a requested tolerance is used.
+################################################################################
+
+import numpy as np
+import os
+from scipy.special import wofz
+
+sqrt_pi = np.sqrt(np.pi)
+
+###############################################################################
+# H(a,x) approximations 
+###############################################################################
+
+def wofz_voigt(x, a):
+    """
+    Exact H(a,x) from the real part of scipy's Faddeeva function; 
+    evaluated in double precision, which scipy computes faster than 
+    single precision
+    """
+    return wofz(np.asarray(x,dtype=float) + 1j*np.asarray(a,dtype=float)).real
+
+def humlicek_voigt(x, a):
+    """
+    Humlicek (1982, JQSRT, 27, 437) four region rational 
+    approximation (W4) of the Faddeeva function. 
+    """
+    x, a = np.broadcast_arrays(np.asarray(x,dtype=float),np.asarray(a,dtype=float))
+    t = a - 1j*x
+    s = np.abs(x) + a
+    w = np.empty(x.shape,dtype=complex)
+
+    # Region I: asymptotic (one-point Gauss-Hermite)
+    region = s >= 15
+    u = t[region]
+    w[region] = u*0.5641896 / (0.5 + u*u)
+
+    # Region II
+    region_2 = (s < 15) & (s >= 5.5)
+    u = t[region_2]; u2 = u*u
+    w[region_2] = u*(1.410474 + u2*0.5641896) / (0.75 + u2*(3.0 + u2))
+    region |= region_2
+
+    # Region III
+    region_3 = ~region & (a >= 0.195*np.abs(x) - 0.176)
+    u = t[region_3]
+    w[region_3] = ((16.4955 + u*(20.20933 + u*(11.96482 + u*(3.778987 + u*0.5642236)))) / 
+                   (16.4955 + u*(38.82363 + u*(39.27121 + u*(21.69274 + u*(6.699398 + u))))))
+    region |= region_3
+
+    # Region IV: near the line core for small a
+    region_4 = ~region
+    u = t[region_4]; u2 = u*u
+    w[region_4] = np.exp(u2) - u*(36183.31 - u2*(3321.9905 - u2*(1540.787 - u2*(219.0313 - 
+                  u2*(35.76683 - u2*(1.320522 - u2*0.56419)))))) / \
+                  (32066.6 - u2*(24322.84 - u2*(9022.228 - u2*(2186.181 - u2*(364.2191 - 
+                  u2*(61.57037 - u2*(1.841439 - u2)))))))
+    return w.real
+
+def tepper_garcia_voigt(x, a):
+    """
+    Tepper-Garcia (2006, MNRAS, 369, 2025) approximation of H(a,x) 
+    to first order in a; valid for small damping parameters. 
+    """
+    x2 = np.asarray(x,dtype=float)**2
+    H0 = np.exp(-x2)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        Q = 1.5/x2
+        correction = H0*H0*(4*x2*x2 + 7*x2 + 4 + Q) - Q - 1
+        correction = correction/x2
+    # Limit of the correction at the line centre 
+    correction = np.where(x2 < 1e-4,2.0,correction)
+    return H0 - a/sqrt_pi*correction
+
+###############################################################################
+# Lookup table 
+###############################################################################
+
+class VoigtTable(object):
+    """
+    H(a,x) tabulated on a regular (a,x) grid together with its exact 
+    derivatives dH/dx, dH/da and d2H/dxda, interpolated with bicubic 
+    Hermite polynomials. H is even in x, so only x >= 0 is stored; 
+    beyond x_max the asymptotic expansion of w(z) to order z^-5 is used 
+    and beyond a_max the exact wofz.
+
+    The table is stored as one (n_a,n_x,4) array, so that the 16 values 
+    of the cell around each point are read with a single gather. It is 
+    written once to cache_dir and then memory-mapped, so all processes 
+    share the same copy. With numpy arrays the interpolation takes 
+    about as long as wofz, so the table brings no speed-up; it is kept 
+    as a backend with a fixed, validated error. It is checked against 
+    wofz when loaded and a ValueError is raised if the interpolation 
+    error exceeds error_bound. 
+
+    Attributes:
+    -----------
+    a_max: float
+        Largest damping parameter in the table (a_min = 0)
+    n_a: int
+        Number of grid points in a
+    x_max: float
+        Largest |x| in the table
+    n_x: int
+        Number of grid points in x
+    error_bound: float
+        Maximum absolute interpolation error allowed
+    max_error: float
+        Largest absolute error found against wofz
+    fname: str
+        Full path of the cache file
+    """
+    def __init__(self, a_max=1.0, n_a=51, x_max=20.0, n_x=1001, 
+                 error_bound=1e-6, cache_dir=None):
+
+        self.a_max = float(a_max); self.n_a = int(n_a)
+        self.x_max = float(x_max); self.n_x = int(n_x)
+        self.da = self.a_max/(self.n_a-1)
+        self.dx = self.x_max/(self.n_x-1)
+        self.error_bound = error_bound
+
+        if cache_dir is None:
+            cache_dir = os.environ.get('BAYESVP_CACHE',
+                            os.path.join(os.path.expanduser('~'),'.cache','bayesvp'))
+        self.fname = os.path.join(cache_dir,'voigt_table_v2_a%g_%i_x%g_%i.npy' % 
+                                  (self.a_max,self.n_a,self.x_max,self.n_x))
+
+        if not os.path.isfile(self.fname):
+            self._write_table(cache_dir)
+        # shape = (n_a,n_x,4); [H, dH/dx, dH/da, d2H/dxda]
+        self.table = np.load(self.fname,mmap_mode='r')
+        if np.shape(self.table) != (self.n_a,self.n_x,4):
+            raise ValueError('Voigt table %s does not match its grid' % self.fname)
+        # Plain ndarray view of the memory map (no copy) with one row per 
+        # grid point; the four grid points of a cell are at these offsets
+        self._rows = np.asarray(self.table).reshape(-1,4)
+        self._cell_offsets = np.array([0,1,self.n_x,self.n_x+1])
+
+        self.max_error = self._validate()
+        if self.max_error > self.error_bound:
+            raise ValueError('Voigt table interpolation error %.2e exceeds the bound %.2e' 
+                             % (self.max_error,self.error_bound))
+
+    def _write_table(self, cache_dir):
+        a = np.linspace(0,self.a_max,self.n_a)[:,np.newaxis]
+        x = np.linspace(0,self.x_max,self.n_x)[np.newaxis,:]
+        z = x + 1j*a
+        w = wofz(z)
+        dw = -2*z*w + 2j/sqrt_pi  # dw/dz
+        d2w = -2*w - 2*z*dw       # d2w/dz2
+
+        # w is analytic in z = x + ia, so d/da = i d/dz
+        table = np.stack([w.real, dw.real, -dw.imag, -d2w.imag],axis=-1)
+
+        try: 
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+        # Write to a temporary file first so that other processes 
+        # never load a partial table
+        tmp_fname = '%s.%i.tmp' % (self.fname,os.getpid())
+        with open(tmp_fname,'wb') as f:
+            np.save(f,table)
+        os.replace(tmp_fname,self.fname)
+
+    def _validate(self):
+        # Largest Hermite errors are near the middle of the cells
+        a = np.concatenate(((np.arange(self.n_a-1) + 0.5)*self.da,[self.a_max]))
+        x = np.concatenate(((np.arange(self.n_x-1) + 0.5)*self.dx,
+                            np.linspace(self.x_max,10*self.x_max,101)))
+        a, x = np.meshgrid(a,x,indexing='ij')
+        return np.max(np.abs(self(x,a) - wofz_voigt(x,a)))
+
+    def __call__(self, x, a):
+        """
+        Interpolated H(a,x)
+        """
+        x, a = np.broadcast_arrays(np.abs(np.asarray(x,dtype=float)),
+                                   np.asarray(a,dtype=float))
+        if np.any(a < 0):
+            raise ValueError('Damping parameter of the Voigt function must be >= 0')
+
+        H = np.empty(x.shape)
+        # Outside of the table in a: use the exact function
+        exact = a > self.a_max
+        if np.any(exact):
+            H[exact] = wofz_voigt(x[exact],a[exact])
+
+        wing = ~exact & (x >= self.x_max)
+        z_wing = x[wing] + 1j*a[wing]
+        z2 = z_wing*z_wing
+        H[wing] = (1j/(sqrt_pi*z_wing)*(1 + 0.5/z2 + 0.75/(z2*z2))).real
+
+        core = ~exact & ~wing
+        u = x[core]/self.dx; v = a[core]/self.da
+        i = np.minimum(u.astype(int),self.n_x-2)
+        j = np.minimum(v.astype(int),self.n_a-2)
+        t = u - i; s = v - j
+
+        # The 16 values of the cell around each point in one gather; 
+        # columns ordered by corner (a row, x column) and value
+        c = np.take(self._rows,(j*self.n_x + i)[:,np.newaxis] + self._cell_offsets,axis=0)
+        c = c.reshape(-1,16)
+
+        # Cubic Hermite basis functions
+        t2 = t*t; s2 = s*s
+        ht1 = t2*(3 - 2*t); ht0 = 1 - ht1
+        ht2 = t*(t - 1)**2*self.dx; ht3 = t2*(t - 1)*self.dx
+        hs1 = s2*(3 - 2*s); hs0 = 1 - hs1
+        hs2 = s*(s - 1)**2*self.da; hs3 = s2*(s - 1)*self.da
+
+        # Interpolate H and dH/da along x on both rows, then along a
+        H_row = [ht0*c[:,8*q] + ht1*c[:,8*q+4] + ht2*c[:,8*q+1] + ht3*c[:,8*q+5] 
+                 for q in range(2)]
+        dH_row = [ht0*c[:,8*q+2] + ht1*c[:,8*q+6] + ht2*c[:,8*q+3] + ht3*c[:,8*q+7] 
+                  for q in range(2)]
+        H[core] = hs0*H_row[0] + hs1*H_row[1] + hs2*dH_row[0] + hs3*dH_row[1]
+        return H
+
+_voigt_table = None
+
+def voigt_table():
+    """
+    Voigt lookup table of this process; built or loaded on first use
+    """
+    global _voigt_table
+    if _voigt_table is None:
+        _voigt_table = VoigtTable()
+    return _voigt_table
+
+def table_voigt(x, a):
+    """
+    H(a,x) interpolated from the Voigt lookup table
+    """
+    return voigt_table()(x,a)
+
+###############################################################################
+# Registry 
+###############################################################################
+
+class VoigtBackend(object):
+    """
+    A method to compute H(a,x)
+
+    Attributes:
+    -----------
+    name: str
+    function: callable
+        function(x,a) returning H(a,x)
+    cost: float
+        Relative cost per evaluated pixel (wofz = 1)
+    error_bound: callable
+        error_bound(a_max) returning the maximum absolute error 
+        of H for all x and a <= a_max
+    max_a: float
+        Largest damping parameter the backend is valid for
+    auto_select: bool
+        True if the backend can be chosen by select_backend()
+    """
+    def __init__(self, name, function, cost, error_bound, max_a=np.inf, 
+                 auto_select=True):
+        self.name = name
+        self.function = function
+        self.cost = cost
+        self.error_bound = error_bound
+        self.max_a = max_a
+        self.auto_select = auto_select
+
+    def meets(self, tol, a_max):
+        return a_max <= self.max_a and self.error_bound(a_max) <= tol
+
+VOIGT_BACKENDS = {}
+
+def register_backend(name, function, cost, error_bound, max_a=np.inf, 
+                     auto_select=True):
+    """
+    Add a method to compute H(a,x) to the registry; see VoigtBackend
+    """
+    VOIGT_BACKENDS[name] = VoigtBackend(name,function,cost,error_bound,
+                                        max_a,auto_select)
+
+# Error bounds from validation_table() over 1e-8 < a < 1 and |x| < 1e4, 
+# rounded up; costs measured relative to wofz with numpy arrays 
+register_backend('wofz',wofz_voigt,1.0,lambda a_max: 1e-13)
+register_backend('humlicek',humlicek_voigt,0.6,lambda a_max: 5e-5)
+register_backend('tepper_garcia',tepper_garcia_voigt,0.4,
+                 lambda a_max: 0.1*a_max,max_a=0.1)
+# Needs a cache file on disk and is no faster than wofz (see VoigtTable); 
+# only used when chosen by name
+register_backend('table',table_voigt,1.1,lambda a_max: voigt_table().error_bound,
+                 auto_select=False)
+
+def select_backend(tol, a_max):
+    """
+    Cheapest registered backend with error bound within tolerance
+
+    Parameters:
+    ----------
+    tol: float
+        Maximum absolute error allowed for H(a,x); None for the 
+        exact wofz
+    a_max: float
+        Largest damping parameter to be evaluated
+
+    Returns:
+    ----------
+    backend: VoigtBackend
+    """
+    if tol is None:
+        return VOIGT_BACKENDS['wofz']
+
+    candidates = [backend for backend in VOIGT_BACKENDS.values() 
+                  if backend.auto_select and backend.meets(tol,a_max)]
+    if len(candidates) == 0:
+        return VOIGT_BACKENDS['wofz']
+    return min(candidates,key=lambda backend: backend.cost)
+
+def voigt_function(x, a, tol=None, backend=None):
+    """
+    Voigt function H(a,x) using either the named backend or 
+    the cheapest backend that meets the tolerance. 
+
+    Parameters:
+    ----------
+    x: array_like
+        Frequency offset in units of the Doppler width
+    a: array_like
+        Damping parameter
+    tol: float
+        Maximum absolute error allowed; None for exact
+    backend: str
+        Name of a registered backend; overrides tol
+
+    Returns:
+    ----------
+    H: array_like
+    """
+    if backend is None:
+        selected = select_backend(tol,np.max(a))
+    else:
+        selected = VOIGT_BACKENDS[backend]
+    return selected.function(x,a)
+
+def validation_table(a_values=None, x_values=None, backends=None):
+    """
+    Compare each backend against wofz over the range of (a,x) 
+    used by the lines in ./data/atom.dat (b = 1 - 100 km/s)
+
+    Parameters:
+    ----------
+    a_values: array_like
+        Damping parameters to test; default 1e-8 to 1
+    x_values: array_like
+        Frequency offsets in Doppler widths to test; default 0 to 1e4
+    backends: list
+        Names of the backends to test; default all registered
+
+    Returns:
+    ----------
+    table: list
+        Rows of (backend name, a, max absolute error, error bound) 
+    """
+    if a_values is None:
+        a_values = 10**np.arange(-8.,0.5,1.0)
+    if x_values is None:
+        x_values = np.concatenate((np.linspace(0,20,20001),
+                                   np.logspace(np.log10(20),4,2000)))
+
+    if backends is None:
+        backends = sorted(VOIGT_BACKENDS)
+
+    table = []
+    for a in a_values:
+        exact = wofz_voigt(x_values,a)
+        for name in backends:
+            backend = VOIGT_BACKENDS[name]
+            if a > backend.max_a:
+                continue
+            error = np.max(np.abs(backend.function(x_values,a) - exact))
+            table.append((name,a,error,backend.error_bound(a)))
+    return table
+
+def print_validation_table():
+    print('%-15s %10s %12s %12s' % ('backend','a','max_error','bound'))
+    for name,a,error,bound in validation_table():
+        print('%-15s %10.1e %12.3e %12.3e' % (name,a,error,bound))
@@ -10,11 +10,12 @@
 ################################################################################
 
 import numpy as np
-from scipy.special import wofz
 import sys
 import os
 
-from bayesvp.utilities import convolve_lsf,get_transitions_params, convolve_lsf_new
+from bayesvp.utilities import convolve_lsf,get_transitions_params
+from bayesvp.voigt import voigt_function
+from scipy.special import wofz
 
 # constants [cgs units]
 h  = 6.6260755e-27   # planck constant
@@ -31,6 +32,13 @@ km_cm = 1.e5   # Convert km to cm
 ang_cm = 1.e-8 # Convert Angstrom to cm
 kpc_cm = 3.0856e21 # Convert kpc to cm 
 
+# Largest number of (walker, line, pixel) elements evaluated at once
+max_broadcast_size = 2**22
+
+# Half width [Doppler widths] of the core of an unresolved line 
+# that is sub-sampled when oversampling
+oversample_n_doppler = 5.0
+
 def wavelength_array(wave_start, wave_end, dv):
     """
     Create Wavelength array with resolution dv
@@ -60,15 +68,18 @@ def wavelength_array(wave_start, wave_end, dv):
     # Return wavelength array
     return wave_start * ((1 + dv/c)**array_index)
 
-def voigt_shape(x, a):
+def voigt_shape(x, a, tol=None, backend=None):
     """
     Real part of Faddeeva function, where    
     w(z) = exp(-z^2) erfc(jz)
+
+    tol sets the maximum absolute error allowed; the cheapest 
+    backend that meets it is used (see ./voigt.py). None is exact.
+    A named backend (e.g 'table') overrides tol.
     """
-    z = x + 1j*a
-    return wofz(z).real
+    return voigt_function(x,a,tol=tol,backend=backend)
 
-def voigt_profile_line(b, z, nu, nu0, Gamma):
+def voigt_profile_line(b, z, nu, nu0, Gamma, tol=None, backend=None):
     """
     Generate Voigt Profile for a given transition
 
@@ -84,6 +95,10 @@ def voigt_profile_line(b, z, nu, nu0, Gamma):
         rest frame frequency of transition [1/s]
     Gamma: float
         Damping coefficient (transition specific)
+    tol: float
+        Maximum absolute error of the Voigt function; None for exact
+    backend: str
+        Name of the Voigt function backend; overrides tol
 
     Returns:
     ----------
@@ -98,7 +113,7 @@ def voigt_profile_line(b, z, nu, nu0, Gamma):
     x = delta_nu/delta_nuD
     a = Gamma/(4*np.pi*delta_nuD)
 
-    return prefactor * voigt_shape(x,a)  
+    return prefactor * voigt_shape(x,a,tol,backend)  
 
 def b_parameter(logT, b_nt, mass):
     """
@@ -123,7 +138,7 @@ def b_parameter(logT, b_nt, mass):
     return np.sqrt(b_thermal**2 + b_nt**2)
 
 
-def general_intensity(logN, b, z, wave, atomic_params):
+def general_intensity(logN, b, z, wave, atomic_params, tol=None, backend=None):
     """
     Takes a general combination of atomic 
     parameters, without specifying the name of the transition 
@@ -141,6 +156,10 @@ def general_intensity(logN, b, z, wave, atomic_params):
         observed wavelength array
     atomic_params: array
         array of oscillator strength, rest frame wavelength [A], damping coefficient, mass [grams] of the transition
+    tol: float
+        Maximum absolute error of the Voigt function; None for exact
+    backend: str
+        Name of the Voigt function backend; overrides tol
 
     Returns:
     ----------
@@ -157,13 +176,273 @@ def general_intensity(logN, b, z, wave, atomic_params):
     nu      = c/(wave*ang_cm) # Frequency array 
 
     # Compute Optical depth
-    tau = N*sigma0*f*voigt_profile_line(b,z,nu,nu0,gamma)
+    tau = N*sigma0*f*voigt_profile_line(b,z,nu,nu0,gamma,tol,backend)
 
     # Return Normalized intensity
     #return np.exp(-tau.astype(np.float))
     #Return optical density
     return tau
 
+def lines_intensity(component_params, plan, wave, tol=None, backend=None,
+                    sum_lines=True):
+    """
+    Optical depth of all lines in the fit plan from one broadcast 
+    evaluation over (line, pixel), summed over lines.
+
+    Parameters:
+    ----------
+    component_params: array_like
+        [logN, b, z] of each component; shape = (n_component,3) or 
+        (n_walkers,n_component,3)
+    plan: FitPlan
+        Lines and wavelength regions of the model; see config.py
+    wave: 1D array
+        observed wavelength array
+    tol: float
+        Maximum absolute error of the Voigt function; None for exact
+    backend: str
+        Name of the Voigt function backend; overrides tol
+    sum_lines: bool
+        If False, the optical depth of each line is returned with 
+        shape (..., n_lines, n_pixels)
+
+    Returns:
+    ----------
+    tau: array
+        optical depth with shape (n_pixels,) or (n_walkers,n_pixels)
+    """
+    # Columns of (logN, b, z) and atomic data with shape (..., n_lines, 1)
+    line_params = component_params[...,plan.line_component,:]
+    logN,b,z = np.moveaxis(line_params,-1,0)[...,np.newaxis]
+    atomic_params = plan.line_params.T[...,np.newaxis]
+
+    tau = general_intensity(logN,b,z,wave,atomic_params,tol,backend)
+    if not sum_lines:
+        return tau
+    return np.sum(tau,axis=-2)
+
+def windowed_intensity(component_params, plan, wave, n_doppler, n_lorentz, 
+                       tol=None, backend=None, sum_lines=True):
+    """
+    Optical depth of all lines in the fit plan, where each line is only 
+    evaluated on the pixels within a window around its observed centre. 
+    The optical depth outside the window is taken to be zero. 
+
+    Parameters:
+    ----------
+    component_params: array_like
+        [logN, b, z] of each component; shape = (n_component,3)
+    plan: FitPlan
+        Lines and wavelength regions of the model; see config.py
+    wave: 1D array
+        observed wavelength array; sorted within each region
+    n_doppler: float
+        Half width of the window in units of Doppler width
+    n_lorentz: float
+        Additional half width of the window in units of Lorentz width 
+        (HWHM of the damping wings)
+    tol: float
+        Maximum absolute error of the Voigt function; None for exact
+    backend: str
+        Name of the Voigt function backend; overrides tol
+    sum_lines: bool
+        If False, the optical depth of each line is returned with 
+        shape (n_lines, n_pixels)
+
+    Returns:
+    ----------
+    tau: array
+        optical depth summed over all lines
+    """
+    if sum_lines:
+        tau = np.zeros(len(wave))
+    else:
+        tau = np.zeros((plan.n_lines,len(wave)))
+    for n in range(plan.n_lines):
+        logN,b,z = component_params[plan.line_component[n]]
+        f,wave0,gamma,mass = plan.line_params[n]
+        line_tau = tau if sum_lines else tau[n]
+
+        # Widths [A] in the observed frame; the damping parameter a of 
+        # general_intensity is gamma/(4 pi) over the Doppler width in 
+        # observed frequency, like the Doppler width
+        line_center   = wave0*(1+z)
+        doppler_width = line_center*(b*km_cm)/c
+        lorentz_width = line_center**2*ang_cm*gamma/(4*np.pi*c)
+        half_width    = n_doppler*doppler_width + n_lorentz*lorentz_width
+
+        for region in plan.region_slices:
+            # Binary search for the pixels inside the window
+            region_wave = wave[region]
+            i0 = np.searchsorted(region_wave,line_center-half_width,side='left')
+            i1 = np.searchsorted(region_wave,line_center+half_width,side='right')
+            if i1 > i0:
+                window = slice(region.start+i0,region.start+i1)
+                line_tau[window] += general_intensity(logN,b,z,wave[window],
+                                                      plan.line_params[n],tol,backend)
+    return tau
+
+class FrequencyGrid:
+    """
+    Frequencies of the pixels for the reduced precision model. Each 
+    pixel frequency is stored as a float64 reference frequency of its 
+    wavelength region plus an offset in the model precision, so that 
+    the offset of a pixel from a line centre (a difference of two 
+    large numbers) is computed without loss of precision.
+
+    Parameters:
+    ----------
+    wave: 1D array
+        observed wavelength array
+    region_slices: tuple
+        Slices of the pixels in each wavelength region
+    dtype: numpy dtype
+        Precision of the model (e.g np.float32)
+
+    Attributes:
+    -----------
+    nu: 1D array
+        Frequency of each pixel [1/s]
+    nu_ref: 1D array
+        float64 reference frequency of each region 
+    nu_offset: 1D array
+        nu - nu_ref of the pixel's region
+    region_index: 1D array
+        Region of each pixel
+    """
+    def __init__(self, wave, region_slices, dtype=np.float32):
+        nu = c/(np.asarray(wave,dtype=np.float64)*ang_cm)
+
+        region_index = np.zeros(len(nu),dtype=int)
+        nu_ref = np.zeros(len(region_slices))
+        for k,region in enumerate(region_slices):
+            region_index[region] = k
+            nu_ref[k] = np.median(nu[region])
+
+        self.dtype        = np.dtype(dtype)
+        self.nu           = nu.astype(dtype)
+        self.nu_ref       = nu_ref
+        self.nu_offset    = (nu - nu_ref[region_index]).astype(dtype)
+        self.region_index = region_index
+
+def grid_intensity(component_params, plan, grid, tol=None, backend=None,
+                   sum_lines=True):
+    """
+    Same as lines_intensity, computed in the precision of the 
+    frequency grid (e.g float32). The line centres and amplitudes are 
+    computed in float64 before the conversion.
+
+    Parameters:
+    ----------
+    component_params: array_like
+        [logN, b, z] of each component; shape = (n_component,3) or 
+        (n_walkers,n_component,3)
+    plan: FitPlan
+        Lines and wavelength regions of the model; see config.py
+    grid: FrequencyGrid
+        Pixel frequencies in the model precision
+    tol: float
+        Maximum absolute error of the Voigt function; None for exact
+    backend: str
+        Name of the Voigt function backend; overrides tol
+    sum_lines: bool
+        If False, the optical depth of each line is returned with 
+        shape (..., n_lines, n_pixels)
+
+    Returns:
+    ----------
+    tau: array
+        optical depth with shape (n_pixels,) or (n_walkers,n_pixels)
+    """
+    dtype = grid.dtype
+    line_params = component_params[...,plan.line_component,:]
+    logN,b,z = np.moveaxis(line_params,-1,0)[...,np.newaxis]
+    f,wave0,gamma,mass = plan.line_params.T[...,np.newaxis]
+
+    # Observed line centre relative to each region's reference frequency
+    nu_center = c/(wave0*ang_cm)/(1+z)
+    center_offset = (grid.nu_ref - nu_center).astype(dtype)
+    delta_nu = grid.nu_offset + center_offset[...,grid.region_index]
+
+    delta_nuD = (b*km_cm/c).astype(dtype) * grid.nu
+    x = delta_nu/delta_nuD
+    a = (gamma/(4*np.pi)).astype(dtype)/delta_nuD
+    H = voigt_shape(x,a,tol,backend).astype(dtype,copy=False)
+
+    amplitude = (10**logN*sigma0*f/np.sqrt(np.pi)).astype(dtype)
+    tau = amplitude*H/delta_nuD
+    if not sum_lines:
+        return tau
+    return np.sum(tau,axis=-2)
+
+def oversampled_correction(component_params, plan, wave, n_sub, threshold,
+                           tau_lines, tol=None, backend=None):
+    """
+    Correction to the pixel-centre optical depth of unresolved lines, 
+    i.e lines with Doppler width below threshold pixels. Pixels in the 
+    core of these lines are divided into n_sub sub-pixels, and the 
+    optical depth averaged over the sub-pixels replaces the value at 
+    the pixel centre. Resolved lines are left unchanged.
+
+    Parameters:
+    ----------
+    component_params: array_like
+        [logN, b, z] of each component; shape = (n_component,3)
+    plan: FitPlan
+        Lines, wavelength regions and pixel widths; see config.py
+    wave: 1D array
+        observed wavelength array; sorted within each region
+    n_sub: int
+        Number of sub-pixels per pixel
+    threshold: float
+        Lines with Doppler width below threshold pixels are sub-sampled
+    tau_lines: array
+        Pixel-centre optical depth of each line (e.g lines_intensity 
+        with sum_lines=False); shape = (n_lines,n_pixels)
+    tol: float
+        Maximum absolute error of the Voigt function; None for exact
+    backend: str
+        Name of the Voigt function backend; overrides tol
+
+    Returns:
+    ----------
+    dtau: array
+        optical depth to be added to the pixel-centre optical depth
+    """
+    dtau = np.zeros(len(wave))
+    if n_sub < 2:
+        return dtau
+
+    # Sub-pixel offsets in units of pixel width 
+    offsets = (np.arange(n_sub) + 0.5)/n_sub - 0.5
+    for n in range(plan.n_lines):
+        logN,b,z = component_params[plan.line_component[n]]
+        wave0 = plan.line_params[n][1]
+        line_center   = wave0*(1+z)
+        doppler_width = line_center*(b*km_cm)/c
+
+        for region in plan.region_slices:
+            region_wave = wave[region]
+            pixel = region.start + np.clip(np.searchsorted(region_wave,line_center),
+                                           0,len(region_wave)-1)
+            pixel_width = plan.pixel_width[pixel]
+            if pixel_width == 0 or doppler_width >= threshold*pixel_width:
+                continue
+
+            # Pixels in the core of the line, plus one pixel on each side
+            half_width = oversample_n_doppler*doppler_width + pixel_width
+            i0 = np.searchsorted(region_wave,line_center-half_width,side='left')
+            i1 = np.searchsorted(region_wave,line_center+half_width,side='right')
+            if i1 <= i0:
+                continue
+            core = slice(region.start+i0,region.start+i1)
+
+            sub_wave = (wave[core,np.newaxis] + 
+                        plan.pixel_width[core,np.newaxis]*offsets)
+            tau_sub = general_intensity(logN,b,z,sub_wave,plan.line_params[n],tol,backend)
+            dtau[core] += np.mean(tau_sub,axis=-1) - tau_lines[n,core]
+    return dtau
+
 def simple_spec(logN, b, z, wave, atom=None, state=None, lsf=1):
     """
     Generate a single component absorption for all transitions
@@ -215,7 +494,8 @@ def generic_prediction(alpha, obs_spec_obj):
     alpha: array_like
         One dimensional array of n parameters; The structure 
         of the array needs to match the ones specified in the 
-        config file  
+        config file. A 2D array with shape (n_walkers, n) 
+        evaluates all walkers at once
     obs_spec_obj:
         Paramters object defined by the config file
         see ./config.py
@@ -224,75 +504,286 @@ def generic_prediction(alpha, obs_spec_obj):
     ----------
     Model flux: 1D array;
         Predicted flux based on the paramters with length equal to 
-        the length of the input wavelength array
-        """
-    disp_tab = '/home/aiswarya/bayesvp/bayesvp/data/example/database/05i1639ml_disp.fits'
-    lsf_file = '/home/aiswarya/bayesvp/bayesvp/data/example/database/aa_LSFTable_G130M_1300_LP1_cn.dat'
-    component_flags = obs_spec_obj.vp_params_flags.reshape(obs_spec_obj.n_component,3)
-    
-    tauk=0
-    for i in range(obs_spec_obj.n_component):
-        # Re-group parameters intro [logN, b, z] for each component
-
-        temp_alpha = np.zeros(3)
-        for j in range(3):
-            # NaN indicates parameter has been fixed
-            if np.isnan(component_flags[i][j]): 
-                # access the fixed value from vp_params after removing the upper case letter 
-                temp_alpha[j] = float(obs_spec_obj.vp_params[i][j][:-1])
-            else: 
-                # access the index map from flags to alpha 
-                temp_alpha[j] = alpha[int(component_flags[i][j])] 
-
-
-        # Compute spectrum for each component, region, and transition.
-        n_wavelength_regions = len(obs_spec_obj.wave_begins)
-        #print(obs_spec_obj.wave_begins)
-        
-        for k in range(n_wavelength_regions):  
-            n_transitions = len(obs_spec_obj.transitions_params_array[i][k])
-            
-            for l in range(n_transitions):
-                if not np.isnan(obs_spec_obj.transitions_params_array[i][k][l]).any():
-                    taul = general_intensity(temp_alpha[0],temp_alpha[1],temp_alpha[2],obs_spec_obj.wave,obs_spec_obj.transitions_params_array[i][k][l])
-                    tauk += taul
-    flux = np.array([])
-    model_flux = np.exp(-tauk)
-    for k in range(n_wavelength_regions):
-        wave_ind0 = np.where(obs_spec_obj.wave>=obs_spec_obj.wave_begins[k])[0][0]
-        wave_ind1 = np.where(obs_spec_obj.wave<=obs_spec_obj.wave_ends[k])[0][-1]
-        
-        speci = convolve_lsf(model_flux[wave_ind0:wave_ind1+1],obs_spec_obj.lsf[k])
-        flux = np.append(flux,speci)
-        
+        the length of the input wavelength array; 
+        shape = (n_walkers, n_pixels) for 2D alpha
         """
+    # Mapping of alpha -> (logN, b, z) and the valid transitions are 
+    # compiled once by DefineParams; see config.FitPlan
+    plan = obs_spec_obj.fit_plan
+    component_params = plan.component_params(alpha)
+
+    # Optical depth of each line is kept to average unresolved 
+    # lines over sub-pixels (see oversampled_correction)
+    sum_lines = obs_spec_obj.oversample is None
+
+    def oversampled(params,tau_lines):
+        n_sub, threshold = obs_spec_obj.oversample
+        tau = np.sum(tau_lines,axis=-2)
+        if np.ndim(params) > 2:
+            for i in range(len(params)):
+                tau[i] += oversampled_correction(params[i],plan,obs_spec_obj.wave,
+                                                 n_sub,threshold,tau_lines[i],
+                                                 obs_spec_obj.voigt_tol,
+                                                 obs_spec_obj.voigt_backend)
+        else:
+            tau += oversampled_correction(params,plan,obs_spec_obj.wave,
+                                          n_sub,threshold,tau_lines,
+                                          obs_spec_obj.voigt_tol,obs_spec_obj.voigt_backend)
+        return tau
+
+    # Compute optical depth for all components and transitions
+    if obs_spec_obj.voigt_window is None:
+        def intensity(params):
+            if obs_spec_obj.nu_grid is not None:
+                # Reduced precision model (e.g float32)
+                tau = grid_intensity(params,plan,obs_spec_obj.nu_grid,
+                                     obs_spec_obj.voigt_tol,obs_spec_obj.voigt_backend,
+                                     sum_lines)
+            else:
+                tau = lines_intensity(params,plan,obs_spec_obj.wave,
+                                      obs_spec_obj.voigt_tol,obs_spec_obj.voigt_backend,
+                                      sum_lines)
+            if sum_lines:
+                return tau
+            return oversampled(params,tau)
+
+        n_pixels = len(obs_spec_obj.wave)
+        if np.ndim(alpha) > 1 and len(alpha)*plan.n_lines*n_pixels > max_broadcast_size:
+            # Split walkers to bound the size of the (walker,line,pixel) arrays
+            n_chunk = max(1,int(max_broadcast_size // (plan.n_lines*n_pixels)))
+            tauk = np.concatenate([intensity(component_params[i:i+n_chunk])
+                                   for i in range(0,len(alpha),n_chunk)])
+        else:
+            tauk = intensity(component_params)
+    elif np.ndim(alpha) > 1:
+        # Windows differ between walkers
+        return np.array([generic_prediction(walker,obs_spec_obj) for walker in alpha])
+    else:
+        n_doppler, n_lorentz = obs_spec_obj.voigt_window
+        tauk = windowed_intensity(component_params,plan,obs_spec_obj.wave,
+                                  n_doppler,n_lorentz,obs_spec_obj.voigt_tol,
+                                  obs_spec_obj.voigt_backend,sum_lines)
+        if not sum_lines:
+            tauk = oversampled(component_params,tauk)
+        tauk = tauk.astype(obs_spec_obj.dtype)
+
     model_flux = np.exp(-tauk)
-    speci = convolve_lsf(model_flux,obs_spec_obj.lsf[k])
-    spec *= speci 
-    """
+
     # Return the convolved model flux with LSF
+    if obs_spec_obj.lsf_operator is not None:
+        return obs_spec_obj.lsf_operator.convolve(model_flux)
+
+    flux = []
+    for k in range(len(plan.region_slices)):
+        speci = obs_spec_obj.lsf_kernels[k].convolve(model_flux[...,plan.region_slices[k]])
+        flux.append(speci)
+    return np.concatenate(flux,axis=-1)
     
-    #spec = convolve_lsf(model_flux,obs_spec_obj.lsf[-1])
-    #new_wave, spec = convolve_lsf_new(obs_spec_obj.wave,model_flux,1300,lsf_file,disp_tab)
-    
-    return flux
-    #return model_flux
-    
+
+def unsupported_jacobian_options(obs_spec_obj):
+    """
+    Config options that change the model of generic_prediction 
+    but are not implemented by generic_prediction_jacobian; the 
+    derivatives are only consistent with the model without them.
+
+    Parameters:
+    ----------
+    obs_spec_obj:
+        Paramters object defined by the config file
+
+    Returns:
+    ----------
+    options: list
+        Config keywords in use, e.g ['oversample','voigt_window']
+    """
+    options = []
+    if obs_spec_obj.voigt_window is not None:
+        options.append('voigt_window')
+    if obs_spec_obj.voigt_tol is not None:
+        options.append('voigt_tol')
+    if obs_spec_obj.voigt_backend not in (None,'wofz'):
+        options.append('voigt_backend')
+    if obs_spec_obj.oversample is not None:
+        options.append('oversample')
+    if obs_spec_obj.precision != 'float64':
+        options.append('precision')
+    return options
+
+def generic_prediction_jacobian(alpha, obs_spec_obj):
+    """
+    Model flux of generic_prediction and its exact derivatives with 
+    respect to the parameters. Uses the derivatives of the Faddeeva 
+    function, w'(u) = -2uw + 2i/sqrt(pi) with u = x + ia, so that 
+
+        dH/dx = -2(xH - aL),  dH/da = 2(xL + aH) - 2/sqrt(pi)
+
+    where H + iL = w. The LSF convolution is linear and is applied to 
+    the derivatives of the unconvolved flux. The model is the exact 
+    (wofz) Voigt profile over all pixels in float64; a ValueError is 
+    raised for configs that set other options of the model, see 
+    unsupported_jacobian_options.
+
+    Parameters:
+    ----------
+    alpha: array_like
+        Parameters with shape (n,) or (n_walkers,n); see generic_prediction
+    obs_spec_obj:
+        Paramters object defined by the config file
+
+    Returns:
+    ----------
+    model_flux: array
+        shape = (n_pixels,) or (n_walkers,n_pixels)
+    jacobian: array
+        d(model_flux)/d(alpha); shape = (n,n_pixels) or (n_walkers,n,n_pixels)
+    """
+    options = unsupported_jacobian_options(obs_spec_obj)
+    if options:
+        raise ValueError('Model derivatives are not implemented with: %s' 
+                         % ', '.join(options))
+
+    plan = obs_spec_obj.fit_plan
+    alpha = np.asarray(alpha,dtype=float)
+    n_alpha = alpha.shape[-1]
+
+    # Line parameters with shape (..., n_lines, 1)
+    line_params = plan.component_params(alpha)[...,plan.line_component,:]
+    logN,b,z = np.moveaxis(line_params,-1,0)[...,np.newaxis]
+    f,wave0,gamma,mass = plan.line_params.T[...,np.newaxis]
+
+    nu = c/(np.asarray(obs_spec_obj.wave,dtype=float)*ang_cm)
+    nu_center = c/(wave0*ang_cm)/(1+z)
+    delta_nuD = b*km_cm*nu/c
+    x = (nu - nu_center)/delta_nuD
+    a = gamma/(4*np.pi*delta_nuD)
+
+    w = wofz(x + 1j*a)
+    H = w.real; L = w.imag
+    dH_dx = -2*(x*H - a*L)
+    dH_da = 2*(x*L + a*H) - 2/np.sqrt(np.pi)
+
+    # Optical depth of each line and its derivatives; shape (..., n_lines, n_pixels)
+    amplitude = 10**logN*sigma0*f/np.sqrt(np.pi)/delta_nuD
+    tau = amplitude*H
+    dtau_dlogN = np.log(10)*tau
+    dtau_db = -(tau + amplitude*(x*dH_dx + a*dH_da))/b
+    dtau_dz = amplitude*dH_dx*nu_center/((1+z)*delta_nuD)
+    dtau = np.stack([dtau_dlogN,dtau_db,dtau_dz],axis=-2)
+    dtau = dtau.reshape(dtau.shape[:-3] + (3*plan.n_lines,len(nu)))
+
+    # Sum over lines sharing (free or tied) parameters 
+    line_index = plan.param_index[plan.line_component].ravel()
+    free = line_index >= 0
+    selection = np.zeros((n_alpha,len(line_index)))
+    np.add.at(selection,(line_index[free],np.where(free)[0]),1)
+    dtau_dalpha = np.matmul(selection,dtau)
+
+    model_flux = np.exp(-np.sum(tau,axis=-2))
+    dflux_dalpha = -model_flux[...,np.newaxis,:]*dtau_dalpha
+
+    # Convolve the flux and its derivatives with LSF
+    if obs_spec_obj.lsf_operator is not None:
+        return (obs_spec_obj.lsf_operator.convolve(model_flux),
+                obs_spec_obj.lsf_operator.apply(dflux_dalpha))
+    flux = []; jacobian = []
+    for k,region in enumerate(plan.region_slices):
+        lsf_kernel = obs_spec_obj.lsf_kernels[k]
+        flux.append(lsf_kernel.convolve(model_flux[...,region]).astype(float))
+        jacobian.append(lsf_kernel.apply(dflux_dalpha[...,region]).astype(float))
+    return np.concatenate(flux,axis=-1), np.concatenate(jacobian,axis=-1)
 
 def poly_continuum(wave,flux, *params):
     # arbitrary polynomial continuum
     x = wave-np.median(wave)
     return sum([p*(x**i) for i, p in enumerate(params)]) + np.median(flux)
 
+class PolyContinuum:
+    """
+    Polynomial continuum of poly_continuum with the pivots 
+    (median wavelength and flux) and the powers of x computed once 
+    for the spectrum, so that the continuum is one matrix product.
+
+    Parameters:
+    ----------
+    wave: 1D array
+        observed wavelength array
+    flux: 1D array
+        observed flux array
+    n_params: int
+        Number of coefficients (polynomial degree + 1)
+
+    Attributes:
+    -----------
+    wave_pivot: float
+        Median wavelength; x = wave - wave_pivot
+    offset: float
+        Median flux added to the polynomial
+    x: 1D array
+        Wavelength relative to the pivot
+    design: 2D array
+        Vandermonde matrix x^i; shape = (n_pixels,n_params)
+    """
+    def __init__(self, wave, flux, n_params):
+        self.n_params   = n_params
+        self.wave_pivot = np.median(wave)
+        self.offset     = np.median(flux)
+        self.x          = np.asarray(wave,dtype=np.float64) - self.wave_pivot
+        self.design     = self.x[:,np.newaxis]**np.arange(n_params)
+
+    def __call__(self, cont_params):
+        """
+        Parameters:
+        ----------
+        cont_params: array_like
+            Coefficients (a_0, a_1, ...); shape = (n_params,) or 
+            (n_walkers,n_params)
+
+        Returns:
+        ----------
+        continuum: array
+            shape = (n_pixels,) or (n_walkers,n_pixels)
+        """
+        return np.dot(cont_params,self.design.T) + self.offset
+
 def continuum_model_flux(alpha,obs_spec_obj):
     """
     Model function that includes continuum (linear order)
+
+    alpha may have shape (n_walkers, n_params) to evaluate 
+    all walkers at once
     """
     if obs_spec_obj.cont_normalize:
+        alpha = np.asarray(alpha)
         num_boundary = obs_spec_obj.cont_nparams
-        model_flux = generic_prediction(alpha[:-num_boundary],obs_spec_obj)
-        local_continuum = poly_continuum(obs_spec_obj.wave,obs_spec_obj.flux,*alpha[-num_boundary:])
-        return model_flux * local_continuum
+        model_flux = generic_prediction(alpha[...,:-num_boundary],obs_spec_obj)
+        local_continuum = obs_spec_obj.cont_model(alpha[...,-num_boundary:])
+        return model_flux * local_continuum.astype(model_flux.dtype,copy=False)
     else:
         model_flux = generic_prediction(alpha,obs_spec_obj)
         return model_flux
+
+def continuum_model_flux_jacobian(alpha,obs_spec_obj):
+    """
+    Model flux of continuum_model_flux and its derivatives with 
+    respect to all parameters, including the continuum coefficients; 
+    see generic_prediction_jacobian
+
+    Returns:
+    ----------
+    model_flux: array
+        shape = (n_pixels,) or (n_walkers,n_pixels)
+    jacobian: array
+        shape = (n_params,n_pixels) or (n_walkers,n_params,n_pixels)
+    """
+    alpha = np.asarray(alpha,dtype=float)
+    if not obs_spec_obj.cont_normalize:
+        return generic_prediction_jacobian(alpha,obs_spec_obj)
+
+    num_boundary = obs_spec_obj.cont_nparams
+    model_flux, jacobian = generic_prediction_jacobian(alpha[...,:-num_boundary],obs_spec_obj)
+    local_continuum = obs_spec_obj.cont_model(alpha[...,-num_boundary:])
+
+    # d(model)/d(a_i) = model_flux * x^i for the polynomial a_i x^i
+    cont_jacobian = model_flux[...,np.newaxis,:]*obs_spec_obj.cont_model.design.T
+    jacobian = np.concatenate([jacobian*local_continuum[...,np.newaxis,:],cont_jacobian],axis=-2)
+    return model_flux*local_continuum, jacobian
@@ -25,4 +25,5 @@ setup(name='bayesvp',
         'matplotlib', 
         'kombine','emcee'
         ],
+    extras_require={'numba': ['numba']},
     zip_safe=False)